@@ -0,0 +1,269 @@
+"""Офлайн нагрузочный тест: хендлеры main.py против фейкового Bot API.
+
+Поднимает локальный HTTP-сервер, который отвечает как Bot API (с задержкой,
+долей ответов 429 и «заблокировавших бота» на релее), собирает приложение через main.build_app() с
+BOT_API_URL на этот сервер и прогоняет синтетический поток апдейтов:
+каждый пользователь заполняет анкету, ищет, переписывается и жмёт
+/next или /stop. Апдейты идут через process_update с тем же ограничением
+параллельности, что и в боте. Печатает апдейтов/с, p50/p99 обработки по
+типам апдейтов, Redis round trip-ов и вызовов Bot API на апдейт.
+
+По умолчанию исходящие ограничены лимитами Telegram (TG_GLOBAL_RATE и
+TG_CHAT_RATE), и при быстром потоке апдейтов упор будет именно в них;
+--send-rate/--chat-rate 0 снимают лимиты, чтобы мерить сам бот.
+--sequential-fanout отправляет уведомления обоим участникам по очереди, как
+до main.fan_out, — для сравнения p50/p99 search/next/stop.
+
+Redis — локальный сервер (пустая база) или in-process fakeredis:
+
+    REDIS_URL=redis://localhost:6379/15 python -m bench.load_test --users 50000 --flush
+    python -m bench.load_test --redis fake --users 5000 --latency 0.05 --p429 0.01
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qs
+
+from telegram import Update
+
+import main
+
+# ===== Фейковый Bot API =====
+class FakeBotApi:
+    def __init__(self, latency: float, p429: float, retry_after: int, seed: int, p403: float = 0.0):
+        self.latency, self.p429, self.retry_after, self.p403 = latency, p429, retry_after, p403
+        self.rnd = random.Random(seed)
+        self.calls: dict = {}
+        self.throttled = self.forbidden = 0
+        self.msg_ids = itertools.count(1)
+
+    def result(self, method: str, params: dict):
+        chat_id = int(params.get("chat_id") or 0)
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if method == "copyMessage":
+            return {"message_id": next(self.msg_ids)}
+        if method in ("sendMessage", "sendPhoto", "sendInvoice", "editMessageText"):
+            msg = {"message_id": int(params.get("message_id") or next(self.msg_ids)), "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+            if method == "sendPhoto":
+                msg["photo"] = [{"file_id": "fake-photo", "file_unique_id": "fake", "width": 1, "height": 1}]
+            return msg
+        return True
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+                path = head[0].split(" ", 2)[1]
+                headers = {k.strip().lower(): v.strip() for k, v in (l.split(":", 1) for l in head[1:] if ":" in l)}
+                body = await reader.readexactly(int(headers.get("content-length") or 0))
+                method = path.rsplit("/", 1)[-1]
+                ctype = headers.get("content-type", "")
+                if ctype.startswith("application/json"):
+                    params = json.loads(body or b"{}")
+                elif ctype.startswith("multipart/form-data"):  # загрузка файла
+                    form = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {ctype}\r\n\r\n".encode() + body)
+                    params = {p.get_param("name", header="content-disposition"):
+                              "<upload>" if p.get_filename() else p.get_content() for p in form.iter_parts()}
+                else:
+                    params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+                self.calls[method] = self.calls.get(method, 0) + 1
+
+                await asyncio.sleep(self.rnd.expovariate(1 / self.latency) if self.latency else 0)
+                if method != "getMe" and self.rnd.random() < self.p429:
+                    self.throttled += 1
+                    code, resp = "429 Too Many Requests", {
+                        "ok": False, "error_code": 429, "parameters": {"retry_after": self.retry_after},
+                        "description": f"Too Many Requests: retry after {self.retry_after}"}
+                elif method == "sendPhoto" and not str(params.get("photo", "")).startswith(
+                        ("<upload>", "http", "fake-photo")):
+                    code, resp = "400 Bad Request", {
+                        "ok": False, "error_code": 400, "description": "Bad Request: wrong file identifier/HTTP URL specified"}
+                elif method == "copyMessage" and self.rnd.random() < self.p403:
+                    self.forbidden += 1
+                    code, resp = "403 Forbidden", {
+                        "ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+                else:
+                    code, resp = "200 OK", {"ok": True, "result": self.result(method, params)}
+                data = json.dumps(resp).encode()
+                writer.write(f"HTTP/1.1 {code}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, IndexError):
+            pass
+        finally:
+            writer.close()
+
+# ===== Синтетические апдейты =====
+_update_ids = itertools.count(1)
+
+def _user(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": f"u{uid}"}
+
+def message(uid: int, text: str) -> dict:
+    msg = {"message_id": next(_update_ids), "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+           "from": _user(uid), "text": text}
+    if text.startswith("/"):
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"update_id": next(_update_ids), "message": msg}
+
+def callback(uid: int, data: str) -> dict:
+    bot_msg = {"message_id": next(_update_ids), "date": int(time.time()),
+               "chat": {"id": uid, "type": "private"}, "text": "…"}
+    return {"update_id": next(_update_ids), "callback_query": {
+        "id": str(next(_update_ids)), "from": _user(uid), "chat_instance": "bench", "data": data,
+        "message": bot_msg}}
+
+def session(uid: int, rnd: random.Random, rounds: int, msgs: int) -> list:
+    # [(тип, апдейт)] одного пользователя по порядку
+    steps = [("start", message(uid, "/start")),
+             ("gender", callback(uid, f"gender:{rnd.choice(main.GENDERS)}")),
+             ("age", callback(uid, f"age:{rnd.choice(main.AGE_RANGES)}"))]
+    steps.append(("search", message(uid, "/search")))
+    for i in range(rounds):
+        steps += [("msg", message(uid, f"hi {j}")) for j in range(rnd.randint(0, msgs * 2))]
+        if i < rounds - 1 and rnd.random() < 0.7:
+            steps.append(("next", message(uid, "/next")))
+        else:
+            steps.append(("stop", message(uid, "/stop")))
+            if i < rounds - 1:
+                steps.append(("search", message(uid, "/search")))
+    return steps
+
+def pct(vals: list, p: float) -> float:
+    return vals[min(len(vals) - 1, int(len(vals) * p))] if vals else 0.0
+
+def redis_round_trips() -> dict:
+    return {cmd: sum(s[:-1]) for (cmd,), s in main.redis_latency.series.items()}
+
+# ===== Прогон =====
+async def drive(app, sessions: list, concurrency: int, rnd: random.Random) -> dict:
+    lat: dict = {}
+    sem = asyncio.Semaphore(concurrency)
+    # Пользователи чередуются случайно, шаги одного пользователя — по порядку
+    # (порядок внутри пользователя держат «полосы» OrderedApplication)
+    cursors = [iter(s) for s in sessions]
+    tasks = set()
+
+    async def one(kind: str, raw: dict):
+        try:
+            t0 = time.perf_counter()
+            done = await app.submit(Update.de_json(raw, app.bot))
+            if done:
+                await done
+            lat.setdefault(kind, []).append(time.perf_counter() - t0)
+        finally:
+            sem.release()
+
+    while cursors:
+        i = rnd.randrange(len(cursors))
+        step = next(cursors[i], None)
+        if step is None:
+            cursors[i] = cursors[-1];  cursors.pop()
+            continue
+        await sem.acquire()
+        t = asyncio.create_task(one(*step))
+        tasks.add(t);  t.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+    return lat
+
+async def sequential_fan_out(sends: dict, what: str):
+    # Прежнее поведение: второму участнику — только после первого
+    for chat_id, coro in sends.items():
+        try:
+            await coro
+        except Exception as e:
+            main.log.error(f"{what} → {chat_id} failed: {e}")
+
+async def run(args):
+    api = FakeBotApi(args.latency, args.p429, args.retry_after, args.seed, args.p403)
+    server = await asyncio.start_server(api.handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    main.TOKEN = main.TOKEN or "1:bench"
+    main.BOT_API_URL = f"http://127.0.0.1:{port}/bot"
+    main.BOT_MODE = "polling"
+    if args.send_rate is not None:
+        main.TG_GLOBAL_RATE = args.send_rate or 1e9
+    if args.chat_rate is not None:
+        main.TG_CHAT_RATE = args.chat_rate or 1e9
+        main.TG_CHAT_BURST = max(main.TG_CHAT_BURST, main.TG_CHAT_RATE)
+    if args.sequential_fanout:
+        main.fan_out = sequential_fan_out
+
+    if args.redis == "fake":
+        try:
+            import fakeredis
+        except ImportError:
+            sys.exit("--redis fake: нужен пакет fakeredis[lua]")
+        await main.connect_redis("", fakeredis.FakeAsyncRedis(decode_responses=True))
+    else:
+        await main.connect_redis(os.environ["REDIS_URL"])
+        if await main.r.dbsize():
+            if not args.flush:
+                sys.exit("Redis не пустой — укажите отдельную базу и --flush")
+            await main.r.flushdb()
+
+    rnd = random.Random(args.seed)
+    sessions = [session(uid, rnd, args.rounds, args.msgs) for uid in range(1, args.users + 1)]
+    total = sum(len(s) for s in sessions)
+
+    app = main.build_app()
+    async with server:
+        await app.initialize()
+        await app.post_init(app)
+        rt0, calls0 = sum(redis_round_trips().values()), sum(api.calls.values())
+        t0 = time.perf_counter()
+        lat = await drive(app, sessions, args.concurrency, rnd)
+        elapsed = time.perf_counter() - t0
+        # Хвост исходящих: релей и планировщик ещё могут отправлять
+        while main.outbox.queue_depth() or await main.relay_backlog():
+            await asyncio.sleep(0.05)
+        drained = time.perf_counter() - t0
+        rts = redis_round_trips()
+        await app.post_shutdown(app)
+        await app.shutdown()
+
+    print(f"{total} updates from {args.users} users in {elapsed:.1f}s → {total / elapsed:.0f} upd/s "
+          f"(outbox drained at {drained:.1f}s)")
+    all_lat = sorted(x for v in lat.values() for x in v)
+    print(f"  update latency ms (incl. per-user lane wait): p50={pct(all_lat, .5) * 1000:.1f} p99={pct(all_lat, .99) * 1000:.1f}")
+    for kind, vals in sorted(lat.items()):
+        vals.sort()
+        print(f"    {kind:7s} n={len(vals):7d} p50={pct(vals, .5) * 1000:7.1f} p99={pct(vals, .99) * 1000:7.1f}")
+    print(f"  redis round trips/update: {(sum(rts.values()) - rt0) / total:.2f}  "
+          f"top: {', '.join(f'{c}={n}' for c, n in sorted(rts.items(), key=lambda x: -x[1])[:5])}")
+    relayed = ", ".join(f"{k}={n}" for (k,), n in sorted(main.relay_outcomes.series.items()))
+    dropped = ", ".join(f"{k}={n}" for (k,), n in sorted(main.flood_dropped.series.items())) or "none"
+    print(f"  relay: {relayed}; flood-dropped: {dropped}")
+    print(f"  bot api calls/update: {(sum(api.calls.values()) - calls0) / total:.2f}  "
+          f"429s={api.throttled} 403s={api.forbidden}  "
+          f"handler errors={sum(main.handler_errors.series.values())}")
+    await main.r.flushdb()
+    await main.r.close()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--users", type=int, default=5000)
+    ap.add_argument("--rounds", type=int, default=3, help="поисков на пользователя")
+    ap.add_argument("--msgs", type=int, default=5, help="среднее число сообщений в диалоге")
+    ap.add_argument("--concurrency", type=int, default=main.UPDATE_CONCURRENCY or 1)
+    ap.add_argument("--latency", type=float, default=0.03, help="средняя задержка Bot API, с")
+    ap.add_argument("--p429", type=float, default=0.0, help="доля ответов 429")
+    ap.add_argument("--retry-after", type=int, default=1)
+    ap.add_argument("--p403", type=float, default=0.0, help="доля релеев в «заблокировавших бота»")
+    ap.add_argument("--send-rate", type=float, help="TG_GLOBAL_RATE, 0 — без лимита")
+    ap.add_argument("--chat-rate", type=float, help="TG_CHAT_RATE, 0 — без лимита")
+    ap.add_argument("--sequential-fanout", action="store_true", help="уведомления участникам по очереди")
+    ap.add_argument("--redis", choices=("url", "fake"), default="url", help="url — REDIS_URL, fake — fakeredis")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--flush", action="store_true", help="разрешить очистку непустой базы")
+    asyncio.run(run(ap.parse_args()))
@@ -0,0 +1,136 @@
+"""Симулятор матчинга: распределение ожидания и качество пар.
+
+Гоняет настоящий матчинг-скрипт из main.py на синтетической популяции в
+виртуальном времени: пользователи ищут, общаются случайное время, жмут
+/stop и через паузу ищут снова. Для каждого режима (MATCH_MODE) и способа
+подбора (MATCH_SCHEDULER: request — в каждом поиске, batch — тиками) печатает
+перцентили ожидания, долю пар с одинаковым ярусом репутации и возрастом и
+сколько пар в секунду реального времени успевает собрать матчинг.
+
+Нужен ПУСТОЙ Redis — база очищается перед каждым прогоном:
+
+    REDIS_URL=redis://localhost:6379/15 python -m bench.match_sim --users 5000 --flush
+"""
+import argparse
+import asyncio
+import heapq
+import os
+import random
+import sys
+import time
+
+import main
+
+
+def pct(vals: list, p: float) -> float:
+    return vals[min(len(vals) - 1, int(len(vals) * p))] if vals else 0.0
+
+
+def make_population(n: int, rnd: random.Random) -> dict:
+    users = {}
+    for uid in range(1, n + 1):
+        premium = rnd.random() < 0.1
+        users[uid] = {
+            "profile": {"gender": rnd.choice(main.GENDERS), "age_range": rnd.choice(main.AGE_RANGES)},
+            "want": rnd.choice(main.GENDERS) if premium and rnd.random() < 0.5 else main.WANT_ANY,
+            "premium": premium,
+            "rep": rnd.choices(main.REP_TIERS, weights=(1, 6, 3))[0],
+        }
+    return users
+
+
+async def simulate(users: dict, mode: str, duration_s: float, dialog_s: float, think_s: float,
+                   seed: int, scheduler: str = "request", tick_ms: int = 500) -> dict:
+    await main.r.flushdb()
+    main.MATCH_MODE = mode
+    main.MATCH_SCHEDULER = scheduler
+
+    rnd = random.Random(seed)
+    events = [(rnd.uniform(0, think_s * 1000), "search", uid) for uid in users]
+    if scheduler == "batch":
+        events.append((tick_ms, "tick", 0))
+    heapq.heapify(events)
+    enq_at, waits, rep_same, age_same = {}, [], 0, 0
+    end_ms = duration_s * 1000
+    match_wall = 0.0
+
+    def paired(a: int, b: int, t: float):
+        nonlocal rep_same, age_same
+        # Ожидание считаем для обоих: кто нашёл сразу, ждал 0
+        for x in (a, b):
+            waits.append((t - enq_at.pop(x, t)) / 1000)
+        rep_same += users[a]["rep"] == users[b]["rep"]
+        age_same += users[a]["profile"]["age_range"] == users[b]["profile"]["age_range"]
+        heapq.heappush(events, (t + rnd.expovariate(1 / dialog_s) * 1000, "stop", a))
+
+    while events and events[0][0] < end_ms:
+        t, kind, uid = heapq.heappop(events)
+        if kind == "tick":
+            t0 = time.perf_counter()
+            pairs = await main.batch_match_tick(at_ms=int(t))
+            match_wall += time.perf_counter() - t0
+            for a, b in pairs:
+                paired(a, b, t)
+            heapq.heappush(events, (t + tick_ms, "tick", 0))
+        elif kind == "search":
+            u = users[uid]
+            t0 = time.perf_counter()
+            peer = await main.match_or_enqueue(uid, u["profile"], u["want"], u["premium"], u["rep"], at_ms=int(t))
+            match_wall += time.perf_counter() - t0
+            if peer <= 0:
+                enq_at[uid] = t
+            else:
+                paired(uid, peer, t)
+        else:  # stop: оба участника уходят подумать и ищут снова
+            peer = await main.clear_pair(uid)
+            for x in (uid, peer):
+                if x:
+                    heapq.heappush(events, (t + rnd.expovariate(1 / think_s) * 1000, "search", x))
+
+    # Кто так и не дождался — ждёт до конца симуляции (это тоже ожидание)
+    starving = sorted((end_ms - t) / 1000 for t in enq_at.values())
+    waits.sort()
+    n = len(waits) // 2 or 1
+    return {
+        "matches": len(waits) // 2,
+        "matches_per_s": len(waits) / 2 / match_wall if match_wall else 0.0,
+        "wait_p50": pct(waits, .5), "wait_p90": pct(waits, .9), "wait_p99": pct(waits, .99),
+        "wait_max": waits[-1] if waits else 0.0,
+        "still_waiting": len(starving), "still_waiting_max": starving[-1] if starving else 0.0,
+        "same_rep": rep_same / n, "same_age": age_same / n,
+    }
+
+
+async def run(args):
+    await main.connect_redis(os.environ["REDIS_URL"])
+    r = main.r
+    try:
+        if await r.dbsize() and not args.flush:
+            sys.exit("Redis не пустой — укажите отдельную базу и --flush")
+        users = make_population(args.users, random.Random(args.seed))
+        runs = [(m, sch) for m in args.modes.split(",") for sch in args.schedulers.split(",")]
+        for mode, scheduler in runs:
+            res = await simulate(users, mode, args.duration, args.dialog, args.think, args.seed,
+                                 scheduler, args.tick)
+            print(f"[{mode}/{scheduler}] matches={res['matches']} ({res['matches_per_s']:.0f}/s wall) "
+                  f"wait p50={res['wait_p50']:.1f}s p90={res['wait_p90']:.1f}s "
+                  f"p99={res['wait_p99']:.1f}s max={res['wait_max']:.1f}s | "
+                  f"still waiting={res['still_waiting']} (max {res['still_waiting_max']:.1f}s) | "
+                  f"same rep tier={res['same_rep']:.1%} same age={res['same_age']:.1%}")
+        await r.flushdb()
+    finally:
+        await r.close()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--users", type=int, default=2000)
+    ap.add_argument("--duration", type=float, default=3600, help="виртуальных секунд")
+    ap.add_argument("--dialog", type=float, default=120, help="средняя длина диалога, с")
+    ap.add_argument("--think", type=float, default=60, help="средняя пауза до нового поиска, с")
+    ap.add_argument("--modes", default="fifo,reputation")
+    ap.add_argument("--schedulers", default="request,batch")
+    ap.add_argument("--tick", type=int, default=500, help="MATCH_TICK_MS для batch")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--flush", action="store_true", help="разрешить очистку непустой базы")
+    asyncio.run(run(ap.parse_args()))
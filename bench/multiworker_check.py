@@ -0,0 +1,173 @@
+"""Проверка корректности при нескольких воркерах на одном Redis.
+
+Запускает N процессов; каждый подключается к Redis так же, как бот
+(main.connect_redis), и гонит синтетический поток операций по общему пулу
+пользователей: поиск, стоп, оплата (часть платежей — повторы того же
+charge_id), плюс каждый держит run_as_leader для тестовой задачи. После
+прогона проверяются инварианты:
+
+  * пары симметричны, никто не в паре и в очереди одновременно;
+  * индекс q:where совпадает с содержимым шардов;
+  * каждый платёж применён ровно один раз, сроки премиума сходятся;
+  * задачу-синглтон одновременно держал не больше чем один воркер.
+
+Нужен ПУСТОЙ Redis:
+
+    REDIS_URL=redis://localhost:6379/15 python -m bench.multiworker_check --workers 8 --ops 20000 --flush
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+import main
+
+ACTIVE_KEY = "harness:active"
+VIOLATIONS_KEY = "harness:violations"
+PAY_DAYS = 7
+
+
+async def singleton_job():
+    # Если ключ уже занят другим воркером — значит, лидеров двое
+    if not await main.r.set(ACTIVE_KEY, main.WORKER_ID, nx=True):
+        await main.r.incr(VIOLATIONS_KEY)
+    try:
+        while True:
+            await asyncio.sleep(0.05)
+    finally:
+        if await main.r.get(ACTIVE_KEY) == main.WORKER_ID:
+            await main.r.delete(ACTIVE_KEY)
+
+
+async def worker(idx: int, users: int, ops: int, seed: int) -> dict:
+    main.LEADER_TTL_MS = 600
+    await main.connect_redis(os.environ["REDIS_URL"])
+    leader = asyncio.create_task(main.run_as_leader("harness", singleton_job))
+    rnd = random.Random(seed * 1000 + idx)
+    stats = {"search": 0, "paired": 0, "stop": 0, "pay": 0}
+
+    async def one_op():
+        uid = rnd.randint(1, users)
+        op = rnd.random()
+        if op < 0.6:
+            p = {"gender": main.GENDERS[uid % 2], "age_range": main.AGE_RANGES[uid % 3]}
+            want = main.GENDERS[(uid // 2) % 2] if uid % 5 == 0 else main.WANT_ANY
+            stats["search"] += 1
+            stats["paired"] += await main.match_or_enqueue(uid, p, want, rep=str(uid % 3)) > 0
+        elif op < 0.95:
+            stats["stop"] += 1
+            await main.remove_from_queue(uid)
+            await main.clear_pair(uid)
+        else:
+            # charge_id общий для всех воркеров — часть платежей придут «повторно»
+            stats["pay"] += 1
+            await main.extend_premium(uid, days=PAY_DAYS, charge_id=f"c{uid}:{rnd.randint(1, 20)}")
+
+    t0 = time.perf_counter()
+    for _ in range(ops // 50):
+        await asyncio.gather(*(one_op() for _ in range(50)))
+    stats["elapsed"] = time.perf_counter() - t0
+    await asyncio.sleep(main.LEADER_TTL_MS / 1000)  # дать аренде перейти к другим
+    leader.cancel()
+    await asyncio.gather(leader, return_exceptions=True)
+    await main.r.close()
+    return stats
+
+
+def worker_proc(idx: int, users: int, ops: int, seed: int, out):
+    out.put(asyncio.run(worker(idx, users, ops, seed)))
+
+
+async def scan_all(r, match: str) -> list:
+    keys, cursor = [], 0
+    while True:
+        cursor, batch = await r.scan(cursor, match=match, count=1000)
+        keys += batch
+        if cursor == 0:
+            return keys
+
+
+async def verify(users: int, t_start: int, t_end: int) -> list:
+    r = main.r
+    errors = []
+    peers = {}
+    prem = {}
+    for k in await scan_all(r, main.user_k("") + "*"):
+        uid = int(k.split(":")[1])
+        peer, until = await r.hmget(k, main.F_PEER, main.F_PREMIUM)
+        if peer:
+            peers[uid] = int(peer)
+        if until:
+            prem[uid] = int(until)
+    errors += [f"asymmetric pair {a}->{b}" for a, b in peers.items() if peers.get(b) != a]
+
+    where = {int(u): k for u, k in (await r.hgetall(main.QUEUE_WHERE)).items()}
+    errors += [f"{u} is paired and queued" for u in where if u in peers]
+    in_shards = {}
+    for k in main.all_shards():
+        for u in await r.zrange(k, 0, -1):
+            if int(u) in in_shards:
+                errors.append(f"{u} in two shards")
+            in_shards[int(u)] = k
+    if in_shards != where:
+        errors.append(f"q:where mismatch: {len(set(in_shards.items()) ^ set(where.items()))} entries")
+
+    charges = {}
+    for k in await scan_all(r, main.PAYMENT_KEY.format(charge="") + "*"):
+        uid = int(k.split(":")[1][1:])
+        charges[uid] = charges.get(uid, 0) + 1
+    for uid in set(charges) | set(prem):
+        # срок = время первой оплаты + PAY_DAYS на каждый уникальный платёж
+        first = prem.get(uid, 0) - charges.get(uid, 0) * PAY_DAYS * 86400
+        if not (t_start - 1 <= first <= t_end + 1):
+            errors.append(f"premium of {uid} off: {charges.get(uid)} payments, until {prem.get(uid)}")
+
+    violations = int(await r.get(VIOLATIONS_KEY) or 0)
+    if violations:
+        errors.append(f"singleton job had {violations} concurrent leaders")
+    return errors
+
+
+async def run(args):
+    await main.connect_redis(os.environ["REDIS_URL"])
+    if await main.r.dbsize():
+        if not args.flush:
+            sys.exit("Redis не пустой — укажите отдельную базу и --flush")
+        await main.r.flushdb()
+
+    t_start = int(time.time())
+    out = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=worker_proc, args=(i, args.users, args.ops, args.seed, out))
+             for i in range(args.workers)]
+    for p in procs:
+        p.start()
+    results = [out.get() for _ in procs]
+    for p in procs:
+        p.join()
+    t_end = int(time.time())
+
+    total_ops = sum(x["search"] + x["stop"] + x["pay"] for x in results)
+    wall = max(x["elapsed"] for x in results)
+    print(f"{args.workers} workers: {total_ops} ops in {wall:.1f}s → {total_ops / wall:.0f} ops/s; "
+          f"searches={sum(x['search'] for x in results)} paired={sum(x['paired'] for x in results)} "
+          f"stops={sum(x['stop'] for x in results)} payments={sum(x['pay'] for x in results)}")
+    errors = await verify(args.users, t_start, t_end)
+    for e in errors[:20]:
+        print("FAIL:", e)
+    print("OK: all invariants hold" if not errors else f"{len(errors)} invariant violations")
+    await main.r.flushdb()
+    await main.r.close()
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--workers", type=int, default=4)
+    ap.add_argument("--users", type=int, default=2000)
+    ap.add_argument("--ops", type=int, default=10000, help="операций на воркер")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--flush", action="store_true", help="разрешить очистку непустой базы")
+    asyncio.run(run(ap.parse_args()))
@@ -0,0 +1,112 @@
+"""Задержка поиска в зависимости от глубины очереди.
+
+Для каждой глубины N очередь заполняется N ожидающими (напрямую, одним
+пайплайном на пачку — как их оставил бы матчинг), и замеряется
+match_or_enqueue двумя видами проб:
+
+  * hit  — ожидающие подходят пробе, она забирает голову шарда
+           (ожидающий, которого забрали, тут же возвращается в очередь);
+  * miss — ожидающие пробе не подходят (они ищут только девушек),
+           проба встаёт в очередь и сразу снимается.
+
+При шардированной очереди обе задержки не должны расти с N.
+Нужен ПУСТОЙ Redis — база очищается перед каждой глубиной:
+
+    REDIS_URL=redis://localhost:6379/15 python -m bench.queue_depth --depths 0,1000,10000,100000 --flush
+    python -m bench.queue_depth --redis fake --depths 0,1000,10000
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+import main
+
+PREFILL_BATCH = 5000
+PROBE = {"gender": "M", "age_range": "21-30"}
+
+
+def pct(vals: list, p: float) -> float:
+    return vals[min(len(vals) - 1, int(len(vals) * p))] if vals else 0.0
+
+
+async def prefill(n: int, gender: str, want: str, rnd: random.Random):
+    # uid ожидающих — с 10^9, чтобы не пересекаться с пробами
+    ts = main.now_ms() - n
+    for start in range(0, n, PREFILL_BATCH):
+        pipe = main.r.pipeline(transaction=False)
+        for i in range(start, min(n, start + PREFILL_BATCH)):
+            uid = 10 ** 9 + i
+            k = main.queue_k(gender, rnd.choice(main.AGE_RANGES), want, rnd.choice(main.REP_TIERS))
+            pipe.zadd(k, {uid: ts + i})
+            pipe.hset(main.QUEUE_WHERE, uid, k)
+            pipe.hset(main.user_k(uid), main.F_QUEUED, ts + i)
+        await pipe.execute()
+
+
+async def probe_hit(uid: int) -> float:
+    t0 = time.perf_counter()
+    peer = await main.match_or_enqueue(uid, PROBE)
+    dt = time.perf_counter() - t0
+    if peer > 0:  # вернуть забранного в очередь, чтобы глубина не менялась
+        await main.clear_pair(uid)
+        shard = main.queue_k("F", PROBE["age_range"], main.WANT_ANY, main.REP_DEFAULT)
+        pipe = main.r.pipeline(transaction=False)
+        pipe.zadd(shard, {peer: main.now_ms()})
+        pipe.hset(main.QUEUE_WHERE, peer, shard)
+        pipe.hset(main.user_k(peer), main.F_QUEUED, main.now_ms())
+        await pipe.execute()
+    else:
+        await main.remove_from_queue(uid)
+    return dt
+
+
+async def probe_miss(uid: int) -> float:
+    t0 = time.perf_counter()
+    await main.match_or_enqueue(uid, PROBE)
+    dt = time.perf_counter() - t0
+    await main.remove_from_queue(uid)
+    return dt
+
+
+async def run(args):
+    if args.redis == "fake":
+        try:
+            import fakeredis
+        except ImportError:
+            sys.exit("--redis fake: нужен пакет fakeredis[lua]")
+        await main.connect_redis("", fakeredis.FakeAsyncRedis(decode_responses=True))
+    else:
+        await main.connect_redis(os.environ["REDIS_URL"])
+        if await main.r.dbsize() and not args.flush:
+            sys.exit("Redis не пустой — укажите отдельную базу и --flush")
+    rnd = random.Random(args.seed)
+    try:
+        for depth in (int(x) for x in args.depths.split(",")):
+            res = {}
+            for kind, gender, want, probe in (("hit", "F", main.WANT_ANY, probe_hit),
+                                              ("miss", "M", "F", probe_miss)):
+                await main.r.flushdb()
+                await prefill(depth, gender, want, rnd)
+                for uid in range(1, args.warmup + 1):
+                    await probe(uid)
+                lat = sorted([await probe(uid) for uid in range(1, args.probes + 1)])
+                res[kind] = lat
+            print(f"depth={depth:>8d} " + " | ".join(
+                f"{k} p50={pct(v, .5) * 1000:.2f}ms p99={pct(v, .99) * 1000:.2f}ms" for k, v in res.items()))
+        await main.r.flushdb()
+    finally:
+        await main.r.aclose()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--depths", default="0,1000,10000,100000")
+    ap.add_argument("--probes", type=int, default=500)
+    ap.add_argument("--warmup", type=int, default=20)
+    ap.add_argument("--redis", choices=("url", "fake"), default="url", help="url — REDIS_URL, fake — fakeredis")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--flush", action="store_true", help="разрешить очистку непустой базы")
+    asyncio.run(run(ap.parse_args()))
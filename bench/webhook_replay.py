@@ -0,0 +1,74 @@
+"""Нагрузочный тест webhook-режима: проигрывает записанные апдейты.
+
+Файл с апдейтами — JSONL, по одному JSON апдейта Telegram в строке.
+Бот должен быть запущен с BOT_MODE=webhook на том же WEBHOOK_PATH/секрете.
+
+    python -m bench.webhook_replay updates.jsonl --url http://127.0.0.1:8443/telegram \\
+        --concurrency 200 --repeat 10
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import time
+
+import httpx
+
+
+def pct(sorted_vals: list, p: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    return sorted_vals[min(len(sorted_vals) - 1, int(len(sorted_vals) * p))]
+
+
+async def replay(updates: list, url: str, secret: str, concurrency: int, repeat: int):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    # update_id должны расти, иначе это уже не «поток» апдейтов
+    ids = itertools.count(1)
+    work = asyncio.Queue()
+    for _ in range(repeat):
+        for u in updates:
+            work.put_nowait(dict(u, update_id=next(ids)))
+
+    lat, codes = [], {}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        async def sender():
+            while not work.empty():
+                body = work.get_nowait()
+                t0 = time.perf_counter()
+                try:
+                    resp = await client.post(url, json=body, headers=headers)
+                    code = resp.status_code
+                except httpx.HTTPError as e:
+                    code = type(e).__name__
+                lat.append(time.perf_counter() - t0)
+                codes[code] = codes.get(code, 0) + 1
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(sender() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - t0
+
+    lat.sort()
+    print(f"sent {len(lat)} updates in {elapsed:.2f}s → {len(lat) / elapsed:.0f} upd/s")
+    print(f"ack latency ms: p50={pct(lat, .5) * 1000:.1f} p99={pct(lat, .99) * 1000:.1f} max={lat[-1] * 1000:.1f}")
+    print(f"status codes: {codes}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("updates", help="JSONL с записанными апдейтами")
+    ap.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    ap.add_argument("--secret", default=os.environ.get("WEBHOOK_SECRET", ""), help="по умолчанию — WEBHOOK_SECRET")
+    ap.add_argument("--concurrency", type=int, default=100)
+    ap.add_argument("--repeat", type=int, default=1)
+    args = ap.parse_args()
+
+    with open(args.updates, encoding="utf-8") as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    asyncio.run(replay(updates, args.url, args.secret, args.concurrency, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,18 @@
 import os
+import asyncio
+import bisect
+import collections
+import heapq
+import hmac
+import itertools
 import json
 import logging
+import multiprocessing
 import re
+import signal
+import socket
 import time
+import uuid
 from typing import Optional
 
 from telegram import (
@@ -14,27 +24,66 @@ from telegram.ext import (
     ContextTypes, filters, PreCheckoutQueryHandler
 )
 
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.request import HTTPXRequest
+
 import redis.asyncio as redis
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
 log = logging.getLogger("anonchat")
 
 TOKEN = os.environ.get("TELEGRAM_TOKEN")
+BOT_API_URL = os.environ.get("BOT_API_URL", "https://api.telegram.org/bot")  # свой Bot API сервер / фейк
 REDIS_URL = os.environ.get("REDIS_URL")  # redis://default:<pass>@<host>:<port>/0
 
+# Режим получения апдейтов: polling (по умолчанию) или webhook
+BOT_MODE        = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_URL     = os.environ.get("WEBHOOK_URL", "")  # публичный https://<host>/<path>
+WEBHOOK_LISTEN  = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT    = int(os.environ.get("PORT", "8443"))
+WEBHOOK_PATH    = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET  = os.environ.get("WEBHOOK_SECRET", "")  # обязателен: A-Z a-z 0-9 _ -, до 256 символов
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "1"))
+
 DIAMOND_IMG_URL = os.environ.get("DIAMOND_IMG_URL", "")
 HALO_IMG_URL    = os.environ.get("HALO_IMG_URL", "")
+BANNER_IMG      = os.path.join(os.path.dirname(os.path.abspath(__file__)), "banner.jpg.png")
 
 # ===== Redis =====
 r: Optional[redis.Redis] = None
+USER_KEY    = "u:{uid}"   # HASH (listpack): анкета, пара, сроки VIP/премиума — поля F_*
+F_GENDER, F_AGE, F_PEER, F_VIP, F_PREMIUM = "g", "a", "peer", "vip", "prem"
+F_UP, F_DOWN, F_REPORTS = "r+", "r-", "rep"      # полученные оценки и жалобы
+F_REP_TIER = "rt"                                # ярус репутации, пересчитывается при оценке
+F_QUEUED = "qt"                                  # когда встал в очередь (мс) — для метрики ожидания
+F_SEEN = "seen"                                  # последняя активность (с), пишется пачками
+F_MIGRATED = "v"                                 # старые ключи перенесены (см. migrate_user)
+F_COUNTED = "pc"                                 # пара учтена в PAIRS_COUNT (см. CLEAR_PAIR_LUA)
+FEEDBACK_KEY = "fb:{uid}"  # LIST: последние FEEDBACK_RECENT оценок/жалоб на uid
+RATE_TOKEN_KEY = "rt:{uid}"  # HASH: токен кнопки оценки -> "выдан (мкс):собеседник", последние RATE_TOKENS_MAX
+FEEDBACK_RECENT = 50
+QUEUE_KEY   = "q:wait:{gender}:{age}:{want}:{rep}"  # ZSET-шард: uid -> время постановки (мс)
+QUEUE_WHERE = "q:where"   # HASH: uid -> ключ шарда, где он ждёт
+USERS_SET   = "users"  # множество уникальных пользователей
+# Старые раздельные ключи пользователя: читаются только при миграции в USER_KEY
 PROFILE_KEY = "profile:{uid}"
 PAIR_KEY    = "pair:{uid}"
-QUEUE_KEY   = "q:global"
 VIP_KEY     = "vip_until:{uid}"
 PREMIUM_KEY = "premium_until:{uid}"
+# Старые списки оценок/жалоб, ключ — тот, КТО оценивал (tools/backfill_feedback.py)
 RATES_KEY   = "rates:{uid}"
 REPORTS_KEY = "reports:{uid}"
-USERS_SET   = "users"  # множество уникальных пользователей
+PAYMENT_KEY  = "paid:{charge}"   # обработанные платежи (telegram_payment_charge_id)
+LEADER_KEY   = "leader:{job}"    # аренда фоновой задачи-синглтона
+WORKERS_KEY  = "workers"         # ZSET: id воркера -> последний heartbeat (мс)
+PAIR_CHANNEL = "pair:inval"  # pub/sub: "a,b" — пары этих uid изменились
+PAIRS_COUNT  = "stat:pairs"  # число активных пар, ведут скрипты пар
+MEDIA_KEY    = "media:file_id"  # HASH: источник картинки (URL/путь) -> file_id в Telegram
+ENT_CHANNEL  = "ent:inval"   # pub/sub: uid — у него изменились сроки VIP/премиума
+EVENTS_STREAM = "events"            # STREAM: события пар/очереди/оплат для аналитики
+FLOOD_KEY     = "flood:{bucket}"     # HASH: "{kind}:{uid}" -> апдейтов за окно (все воркеры)
+FLOOD_CHANNEL = "flood:mute"         # pub/sub: "kind:uid:until" — пользователь на паузе
+FLOOD_NOTICE  = "flood:notice:{uid}" # уведомление о паузе уже отправлено
 
 # ===== Payments (Telegram Stars) =====
 CURRENCY_XTR   = "XTR"
@@ -51,6 +100,14 @@ PREMIUM_PLANS = {
     "12m": {"months": 12, "amount": 1000, "title": "Премиум • 1 год",   "price_line": "1 год за 1000 ⭐ / 1999₽ / $19.99"},
 }
 
+# ===== Анкета: допустимые значения =====
+GENDERS    = ("M", "F")
+AGE_RANGES = ("12-20", "21-30", "31-40")
+WANT_ANY   = "any"
+# Ярусы репутации: 0 — низкая, 1 — обычная (и новички), 2 — высокая
+REP_TIERS   = ("0", "1", "2")
+REP_DEFAULT = "1"
+
 # ===== Reply-клавиатура (кнопка «квадратики») =====
 BTN_ANY = "🚀 Поиск любого собеседника"
 BTN_F   = "🙋‍♀️ Поиск Ж"
@@ -101,21 +158,115 @@ def profile_str(p: dict) -> str:
     a = p.get("age_range") or "—"
     return f"Пол: {g}\nВозраст: {a}"
 
-# ===== Users counter =====
-async def add_user(uid: int):
+# ===== Счётчики пользователей =====
+# Активность не пишется в Redis на каждый апдейт: uid копятся в памяти и раз в
+# COUNTERS_FLUSH_S уходят одним пайплайном — PFADD в поминутный HLL онлайна
+# (online:{minute}, живёт ONLINE_WINDOW_MIN минут) и в HLL «всего». Меню и
+# /stats читают значения, которые тот же цикл обновляет раз в COUNTERS_TTL_S,
+# — без обращений к Redis. Память постоянна: HLL — до 12 КБ на ключ.
+# Тем же пайплайном пишется время последней активности в u:{uid} (для уборки).
+# USERS_SET остаётся реестром для рассылок, в него пишутся только новые uid.
+ONLINE_KEY        = "online:{minute}"  # HLL: uid, активные в эту минуту
+USERS_HLL         = "users:hll"        # HLL: все uid (приближённо, ~0.8%)
+ONLINE_WINDOW_MIN = int(os.environ.get("ONLINE_WINDOW_MIN", "5"))
+COUNTERS_FLUSH_S  = float(os.environ.get("COUNTERS_FLUSH_S", "5"))
+COUNTERS_TTL_S    = float(os.environ.get("COUNTERS_TTL_S", "15"))
+# uid, уже записанные этим процессом в USERS_SET, — повторный SADD не нужен
+SEEN_USERS_MAX = 500_000
+_seen_users: set = set()
+_active_pending: set = set()   # активны с прошлого сброса
+_new_pending: set = set()      # ещё не записаны в USERS_SET
+counters = {"online": 0, "total": 0, "at": 0.0}
+
+def add_user(uid: int):
+    if len(_active_pending) < SEEN_USERS_MAX:  # Redis недоступен долго — не копим без конца
+        _active_pending.add(uid)
+    if uid not in _seen_users and len(_new_pending) < SEEN_USERS_MAX:
+        _new_pending.add(uid)
+
+# ===== Поток событий для аналитики =====
+# Создание и разрыв пар, постановка в очередь и оплаты пишутся компактными
+# записями в стрим EVENTS_STREAM (обрезается до ~EVENTS_MAXLEN). На горячем
+# пути событие только кладётся в буфер памяти — в Redis оно уходит тем же
+# пайплайном, что и активность. Поля: t — мс, e — тип, u — uid, дальше по
+# типу: pair (p, wu/wp — ждали в очереди, мс), queue, end (p, x — причина:
+# stop/next/idle/blocked), pay (x — план, a — сумма в звёздах).
+# Пишут их match_or_enqueue и batch_match_tick (pair, queue), clear_pair
+# (end) и _extend (pay — только реально применённый платёж).
+# Свёртка в поминутные агрегаты — tools/events_rollup.py, выгрузка в CSV —
+# tools/events_export.py.
+EVENTS_MAXLEN     = int(os.environ.get("EVENTS_MAXLEN", "1000000"))
+EVENTS_BUFFER_MAX = 100_000
+_events_pending: list = []
+
+def emit_event(kind: str, uid: int, **fields):
+    if len(_events_pending) >= EVENTS_BUFFER_MAX:  # Redis недоступен долго — теряем новые
+        events_dropped.inc();  return
+    _events_pending.append({"t": now_ms(), "e": kind, "u": uid, **fields})
+
+def online_keys(at_s: float) -> list:
+    minute = int(at_s // 60)
+    return [ONLINE_KEY.format(minute=m) for m in range(minute - ONLINE_WINDOW_MIN + 1, minute + 1)]
+
+async def flush_activity():
+    global _active_pending, _new_pending, _flood_pending, _events_pending
+    if not (_active_pending or _new_pending or _flood_pending or _events_pending):
+        return
+    active, new, flood, events = _active_pending, _new_pending, _flood_pending, _events_pending
+    _active_pending, _new_pending, _flood_pending, _events_pending = set(), set(), {}, []
+    now = int(time.time())
+    cur = online_keys(now)[-1]
+    pipe = r.pipeline(transaction=False)
+    for uid in active:
+        pipe.hset(user_k(uid), F_SEEN, now)
+    if active:
+        pipe.pfadd(cur, *active)
+        pipe.expire(cur, (ONLINE_WINDOW_MIN + 1) * 60)
+        pipe.pfadd(USERS_HLL, *active)
+    if new:
+        pipe.sadd(USERS_SET, *new)
+    for ev in events:
+        pipe.xadd(EVENTS_STREAM, ev, maxlen=EVENTS_MAXLEN, approximate=True)
+    flood_key = flood_report(pipe, flood, now)
     try:
-        await r.sadd(USERS_SET, uid)
+        res = await pipe.execute()
     except Exception as e:
-        log.warning(f"SADD users failed: {e}")
-
-async def users_count() -> int:
+        log.warning(f"counters flush failed: {e}")
+        _active_pending |= active;  _new_pending |= new
+        _events_pending = (events + _events_pending)[-EVENTS_BUFFER_MAX:]
+        return
+    if flood:
+        await flood_check(flood, res[-len(flood) - 1:-1], flood_key)
+    if len(_seen_users) + len(new) > SEEN_USERS_MAX:
+        _seen_users.clear()
+    _seen_users.update(new)
+
+async def refresh_counters():
+    pipe = r.pipeline(transaction=False)
+    pipe.pfcount(*online_keys(time.time()))
+    pipe.pfcount(USERS_HLL)
     try:
-        return await r.scard(USERS_SET)
-    except Exception:
-        return 0
+        online, total = await pipe.execute()
+    except Exception as e:
+        log.warning(f"counters refresh failed: {e}");  return
+    counters.update(online=online, total=total, at=time.monotonic())
+
+async def counters_loop():
+    while True:
+        await flush_activity()
+        if time.monotonic() - counters["at"] >= COUNTERS_TTL_S:
+            await refresh_counters()
+        await asyncio.sleep(COUNTERS_FLUSH_S)
 
-def menu_text_base(users_total: int, prefix: str = "") -> str:
-    top = f"Сейчас в чате {users_total} пользователей 👥"
+def online_count() -> int:
+    # Тот, кто смотрит на меню, сам онлайн — даже если его ещё не сбросили
+    return max(counters["online"], 1)
+
+def users_count() -> int:
+    return max(counters["total"], counters["online"], 1)
+
+def menu_text_base(online: int, prefix: str = "") -> str:
+    top = f"Сейчас в чате {online} пользователей 👥"
     body = (
         "/search — поиск собеседника\n"
         "/next — закончить текущий диалог и сразу же искать нового собеседника\n"
@@ -123,235 +274,1129 @@ def menu_text_base(users_total: int, prefix: str = "") -> str:
     )
     return (prefix + "\n" if prefix else "") + top + "\n\n" + body
 
-# ===== Helpers: VIP / PREMIUM =====
-def vip_k(uid: int) -> str: return VIP_KEY.format(uid=uid)
-def premium_k(uid: int) -> str: return PREMIUM_KEY.format(uid=uid)
-
-async def _get_until(key: str) -> int:
-    val = await r.get(key)
-    return int(val) if val else 0
+# ===== Хэш пользователя =====
+# Все скалярные поля пользователя — в одном маленьком хэше u:{uid}: Redis
+# хранит его как listpack, это в разы компактнее четырёх отдельных ключей.
+# Пользователи со старыми ключами переносятся лениво при первом чтении
+# (migrate_user) и пачками — tools/migrate_users.py. Перенесённым ставится
+# поле F_MIGRATED: по наличию хэша судить нельзя — flush_activity и очередь
+# пишут в него раньше, чем пользователь что-то прочитает.
+def user_k(uid: int) -> str: return USER_KEY.format(uid=uid)
+
+async def migrate_user(uid: int) -> dict:
+    # Переносит старые ключи в хэш, не затирая уже записанные поля, и ставит
+    # F_MIGRATED (в том числе новым пользователям — им переносить нечего).
+    # Возвращает итоговые поля {F_*: str}.
+    pipe = r.pipeline(transaction=False)
+    await migrate_script(args=[0, uid], client=pipe)  # только ставит в пайплайн
+    pipe.hgetall(user_k(uid))
+    return (await pipe.execute())[-1]
+
+# Перенос — скриптом: чтение старых ключей и запись в хэш атомарны, так что
+# параллельный перенос (бот + tools/migrate_users.py) не вернёт в хэш уже
+# устаревшее значение. Функция migrate(u, keep) подставляется и в скрипты,
+# которым нужны оба участника пары (разрыв). Перенесённых (F_MIGRATED) не
+# трогает — их старые ключи, если остались, только удаляются (keep — нет).
+MIGRATE_FN_LUA = """
+local function migrate(u, keep)
+  local ukey = '%(user)s' .. u
+  local old = {'%(profile)s' .. u, '%(pair)s' .. u, '%(vip)s' .. u, '%(premium)s' .. u}
+  if redis.call('HEXISTS', ukey, '%(migrated)s') == 1 then
+    if not keep then redis.call('DEL', unpack(old)) end
+    return 0
+  end
+  local vals = redis.call('MGET', unpack(old))
+  local moved = (vals[1] or vals[2] or vals[3] or vals[4]) and 1 or 0
+  local fields = {['%(peer)s'] = vals[2], ['%(vip_f)s'] = vals[3], ['%(prem_f)s'] = vals[4]}
+  if vals[1] then
+    local ok, p = pcall(cjson.decode, vals[1])
+    if ok and type(p) == 'table' then
+      fields['%(gender)s'], fields['%(age)s'] = p.gender, p.age_range
+    end
+  end
+  for f, v in pairs(fields) do
+    if type(v) == 'string' and v ~= '' then redis.call('HSETNX', ukey, f, v) end
+  end
+  if not keep then redis.call('DEL', unpack(old)) end
+  redis.call('HSET', ukey, '%(migrated)s', 1)
+  return moved
+end
+""" % {"user": USER_KEY.format(uid=""), "profile": PROFILE_KEY.format(uid=""), "pair": PAIR_KEY.format(uid=""),
+       "vip": VIP_KEY.format(uid=""), "premium": PREMIUM_KEY.format(uid=""), "migrated": F_MIGRATED,
+       "peer": F_PEER, "vip_f": F_VIP, "prem_f": F_PREMIUM, "gender": F_GENDER, "age": F_AGE}
+
+# ARGV[1] — 1: не удалять старые ключи; ARGV[2..] — uid. Ответ — сколько
+# пользователей действительно перенесено (у кого были старые ключи).
+MIGRATE_LUA = MIGRATE_FN_LUA + """
+local keep, moved = ARGV[1] == '1', 0
+for i = 2, #ARGV do moved = moved + migrate(ARGV[i], keep) end
+return moved
+"""
+migrate_script = None  # регистрируется в connect_redis
 
-async def get_vip_until(uid: int) -> int:
-    return await _get_until(vip_k(uid))
-
-async def get_premium_until(uid: int) -> int:
-    return await _get_until(premium_k(uid))
-
-async def is_vip(uid: int) -> bool:
-    return (await get_vip_until(uid)) > int(time.time())
-
-async def is_premium(uid: int) -> bool:
-    return (await get_premium_until(uid)) > int(time.time())
-
-async def has_gender_rights(uid: int) -> bool:
-    # Право искать по полу — у Премиума ИЛИ у VIP
-    return (await is_premium(uid)) or (await is_vip(uid))
+# ===== Helpers: VIP / PREMIUM =====
+# Права — это сроки (unix-время окончания), поэтому кэшировать их можно без
+# TTL: «активно ли сейчас» считается по часам, без обращения к Redis, и после
+# окончания срока ответ сам становится «нет». Меняет сроки только оплата —
+# скрипт продления публикует uid в ENT_CHANNEL, и все воркеры сбрасывают
+# запись. Пока подписка не работает, кэш не используется (как кэш пар).
+ENT_CACHE_MAX = 500_000
+_ent_cache: dict = {}  # uid -> (premium_until, vip_until)
+_ent_epoch = 0
+ent_cache_stats = {"hit": 0, "miss": 0}
+
+def is_active(until: int, now: Optional[int] = None) -> bool:
+    # Срок until — первая секунда, когда права уже нет
+    return until > (int(time.time()) if now is None else now)
+
+def invalidate_entitlements(*uids: int):
+    global _ent_epoch
+    _ent_epoch += 1
+    for uid in uids:
+        _ent_cache.pop(uid, None)
+
+def remember_entitlements(uid: int, premium_until: int, vip_until: int, epoch: int):
+    # epoch — значение _ent_epoch до чтения: если между ними был сброс, не кэшируем
+    if _inval_live and epoch == _ent_epoch:
+        if len(_ent_cache) >= ENT_CACHE_MAX:
+            _ent_cache.clear()
+        _ent_cache[uid] = (premium_until, vip_until)
+
+def cached_entitlements(uid: int) -> Optional[tuple]:
+    # (premium_until, vip_until) из кэша или None — тогда их читает load_user_state
+    if _inval_live and uid in _ent_cache:
+        ent_cache_stats["hit"] += 1
+        return _ent_cache[uid]
+    ent_cache_stats["miss"] += 1
+    return None
 
 def _add_months_or_days(base_ts: int, months: int = 0, days: int = 0) -> int:
     # months -> 30 дней условно
     return base_ts + int(days*24*3600 + months*30*24*3600)
 
-async def extend_vip(uid: int, months: int) -> int:
-    now_i = int(time.time())
-    base = max(now_i, await get_vip_until(uid))
-    new_until = _add_months_or_days(base, months=months)
-    await r.set(vip_k(uid), new_until)
-    return new_until
-
-async def extend_premium(uid: int, months: int = 0, days: int = 0) -> int:
-    now_i = int(time.time())
-    base = max(now_i, await get_premium_until(uid))
-    new_until = _add_months_or_days(base, months=months, days=days)
-    await r.set(premium_k(uid), new_until)
-    return new_until
+# Продление — одним скриптом: два воркера с платежами одного пользователя не
+# затрут продления друг друга. Повтор того же платежа (charge_id) не продлевает
+# второй раз. Ответ: [новый срок, 1 — применён / 0 — повтор].
+PAYMENT_TTL = 90 * 24 * 3600
+EXTEND_LUA = """
+local ukey, paid, chan, fld = KEYS[1], KEYS[2], KEYS[3], ARGV[1]
+local now, secs = tonumber(ARGV[2]), tonumber(ARGV[3])
+local cur = tonumber(redis.call('HGET', ukey, fld)) or 0
+if paid ~= '' and not redis.call('SET', paid, 1, 'NX', 'EX', ARGV[4]) then return {cur, 0} end
+local new_until = math.max(now, cur) + secs
+redis.call('HSET', ukey, fld, new_until)
+redis.call('PUBLISH', chan, ARGV[5])
+return {new_until, 1}
+"""
+extend_script = None  # регистрируется в connect_redis
+
+async def _extend(uid: int, field: str, secs: int, charge_id: str, event: Optional[dict] = None) -> int:
+    if not await r.hget(user_k(uid), F_MIGRATED):
+        await migrate_user(uid)  # иначе продление ляжет поверх старого срока
+    paid = PAYMENT_KEY.format(charge=charge_id) if charge_id else ""
+    new_until, applied = await extend_script(
+        keys=[user_k(uid), paid, ENT_CHANNEL], args=[field, int(time.time()), secs, PAYMENT_TTL, uid])
+    invalidate_entitlements(uid)  # своё сообщение из канала может прийти позже
+    if not applied:
+        log.info(f"payment {charge_id} for {uid} already applied")
+    elif event:  # повтор того же платежа в аналитику не попадает
+        emit_event("pay", uid, **event)
+    return int(new_until)
+
+async def extend_vip(uid: int, months: int, charge_id: str = "", event: Optional[dict] = None) -> int:
+    return await _extend(uid, F_VIP, _add_months_or_days(0, months=months), charge_id, event)
+
+async def extend_premium(uid: int, months: int = 0, days: int = 0, charge_id: str = "",
+                         event: Optional[dict] = None) -> int:
+    return await _extend(uid, F_PREMIUM, _add_months_or_days(0, months=months, days=days), charge_id, event)
 
 # ===== Profiles/Pairs/Queue =====
-async def get_profile(uid: int) -> dict:
-    raw = await r.get(PROFILE_KEY.format(uid=uid))
-    if not raw:
-        return {"gender": None, "age_range": None}
-    try:
-        return json.loads(raw)
-    except Exception:
-        return {"gender": None, "age_range": None}
-
-async def save_profile(uid: int, data: dict): await r.set(PROFILE_KEY.format(uid=uid), json.dumps(data))
-async def reset_profile(uid: int): await r.delete(PROFILE_KEY.format(uid=uid))
-
-async def get_peer(uid: int) -> Optional[int]:
-    val = await r.get(PAIR_KEY.format(uid=uid))
-    return int(val) if val else None
+def profile_from_fields(fields: dict) -> dict:
+    return {"gender": fields.get(F_GENDER), "age_range": fields.get(F_AGE)}
 
-async def set_pair(a: int, b: int):
-    pipe = r.pipeline()
-    pipe.set(PAIR_KEY.format(uid=a), b)
-    pipe.set(PAIR_KEY.format(uid=b), a)
+async def get_profile(uid: int) -> dict:
+    g, a, migrated = await r.hmget(user_k(uid), F_GENDER, F_AGE, F_MIGRATED)
+    if not migrated:
+        return profile_from_fields(await migrate_user(uid))
+    return {"gender": g, "age_range": a}
+
+async def save_profile(uid: int, data: dict):
+    fields = {F_GENDER: data.get("gender"), F_AGE: data.get("age_range")}
+    pipe = r.pipeline(transaction=False)
+    for f, v in fields.items():
+        if v: pipe.hset(user_k(uid), f, v)
+        else: pipe.hdel(user_k(uid), f)
     await pipe.execute()
+async def reset_profile(uid: int): await r.hdel(user_k(uid), F_GENDER, F_AGE)
+
+# ===== Кэш пар в памяти процесса =====
+# Релей читает pair: на каждое сообщение, поэтому пары (и их отсутствие)
+# кэшируются локально. Любая запись пары публикует в PAIR_CHANNEL, и все
+# воркеры сбрасывают эти uid. Пока подписка не работает, кэш не используется.
+PAIR_CACHE_MAX = 500_000
+_pair_cache: dict = {}
+_pair_epoch = 0           # растёт при каждой инвалидации — защита от гонки GET/сброс
+_inval_live = False  # подписка на PAIR_CHANNEL/ENT_CHANNEL активна
+pair_cache_stats = {"hit": 0, "miss": 0, "inval": 0}
+
+def invalidate_pairs(*uids: int):
+    global _pair_epoch
+    _pair_epoch += 1
+    pair_cache_stats["inval"] += 1
+    for uid in uids:
+        _pair_cache.pop(uid, None)
+
+def pair_cache_hit_rate() -> float:
+    total = pair_cache_stats["hit"] + pair_cache_stats["miss"]
+    return pair_cache_stats["hit"] / total if total else 0.0
+
+async def invalidation_listener():
+    # Один подписчик на все каналы: пары, права (VIP/премиум) и паузы флудящих
+    global _inval_live
+    while True:
+        pubsub = r.pubsub()
+        try:
+            await pubsub.subscribe(PAIR_CHANNEL, ENT_CHANNEL, FLOOD_CHANNEL)
+            _inval_live = True
+            async for msg in pubsub.listen():
+                if msg.get("type") != "message":
+                    continue
+                if msg["channel"] == FLOOD_CHANNEL:
+                    apply_mute(msg["data"]);  continue
+                uids = [int(x) for x in msg["data"].split(",") if x]
+                if msg["channel"] == ENT_CHANNEL:
+                    invalidate_entitlements(*uids)
+                else:
+                    invalidate_pairs(*uids)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning(f"invalidation listener: {e}")
+        finally:
+            # Сообщения могли потеряться — кэшам больше верить нельзя
+            _inval_live = False
+            _pair_cache.clear()
+            _ent_cache.clear()
+            try:
+                await pubsub.close()
+            except Exception:
+                pass
+        await asyncio.sleep(1)
+
+_MISS = object()
+
+def cached_peer(uid: int):
+    # Собеседник из кэша или _MISS
+    if _inval_live and uid in _pair_cache:
+        pair_cache_stats["hit"] += 1
+        return _pair_cache[uid]
+    pair_cache_stats["miss"] += 1
+    return _MISS
+
+def remember_peer(uid: int, val: Optional[str], epoch: int) -> Optional[int]:
+    # epoch — значение _pair_epoch до GET: если между ними был сброс, не кэшируем
+    peer = int(val) if val else None
+    if _inval_live and epoch == _pair_epoch:
+        if len(_pair_cache) >= PAIR_CACHE_MAX:
+            _pair_cache.clear()
+        _pair_cache[uid] = peer
+    return peer
 
-async def clear_pair(uid: int):
-    peer = await get_peer(uid)
-    pipe = r.pipeline()
-    pipe.delete(PAIR_KEY.format(uid=uid))
+async def get_peer(uid: int) -> Optional[int]:
+    peer = cached_peer(uid)
+    if peer is not _MISS:
+        return peer
+    epoch = _pair_epoch
+    val, migrated = await r.hmget(user_k(uid), F_PEER, F_MIGRATED)
+    if not migrated:
+        val = (await migrate_user(uid)).get(F_PEER)
+    return remember_peer(uid, val, epoch)
+
+# Разрыв пары атомарно: собеседник берётся из Redis, а не из кэша.
+# С idle_before (ARGV[5]) пара рвётся, только если me не был активен с тех пор.
+# Оба участника сначала переносятся со старых ключей: иначе пара, начатая до
+# перехода на хэш, осталась бы в pair:{uid} и ожила бы при следующем чтении.
+# Счётчик пар уменьшается, только если пару записал скрипт матчинга (поле
+# F_COUNTED, ARGV[4]): пары, начатые до появления счётчика, в нём не учтены.
+CLEAR_PAIR_LUA = MIGRATE_FN_LUA + """
+local pfx, fld, me, counted = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+migrate(me)
+if ARGV[6] and (tonumber(redis.call('HGET', pfx .. me, ARGV[5])) or 0) >= tonumber(ARGV[6]) then
+  return 0
+end
+local peer = redis.call('HGET', pfx .. me, fld)
+local was_counted = redis.call('HDEL', pfx .. me, fld, counted) == 2
+if peer then migrate(peer) end
+if peer and redis.call('HGET', pfx .. peer, fld) == me then
+  redis.call('HDEL', pfx .. peer, fld, counted)
+  if was_counted then redis.call('DECR', KEYS[2]) end
+end
+redis.call('PUBLISH', KEYS[1], me .. ',' .. (peer or ''))
+return tonumber(peer) or 0
+"""
+clear_pair_script = None  # регистрируется в post_init
+
+async def clear_pair(uid: int, idle_before: Optional[int] = None, reason: str = "stop") -> Optional[int]:
+    args = [user_k(""), F_PEER, uid, F_COUNTED] + ([F_SEEN, idle_before] if idle_before else [])
+    peer = int(await clear_pair_script(keys=[PAIR_CHANNEL, PAIRS_COUNT], args=args))
+    invalidate_pairs(uid, peer)
     if peer:
-        pipe.delete(PAIR_KEY.format(uid=peer))
-    await pipe.execute()
+        emit_event("end", uid, p=peer, x=reason)
+    return peer or None
+
+# ===== Состояние пользователя на время апдейта =====
+# Всё, что хендлерам нужно о пользователе (анкета, пара, премиум, VIP), читается
+# одним пайплайном при первом обращении и живёт до конца обработки апдейта
+# (хранится на CallbackContext). Пара берётся из кэша пар, если он тёплый.
+class UserState:
+    __slots__ = ("uid", "profile", "peer", "premium_until", "vip_until", "rep_tier")
+
+    def __init__(self, uid: int, profile: dict, peer: Optional[int],
+                 premium_until: int, vip_until: int, rep_tier: str = REP_DEFAULT):
+        self.uid, self.profile, self.peer = uid, profile, peer
+        self.premium_until, self.vip_until = premium_until, vip_until
+        self.rep_tier = rep_tier
+
+    @property
+    def is_premium(self) -> bool: return is_active(self.premium_until)
+    @property
+    def is_vip(self) -> bool: return is_active(self.vip_until)
+    @property
+    def has_gender_rights(self) -> bool: return self.is_premium or self.is_vip
+
+async def load_user_state(context: ContextTypes.DEFAULT_TYPE, uid: int) -> UserState:
+    states = context.__dict__.setdefault("user_states", {})
+    st = states.get(uid)
+    if st is not None:
+        return st
+    peer = cached_peer(uid)
+    ent = cached_entitlements(uid)
+    epoch, ent_epoch = _pair_epoch, _ent_epoch
+    # Сроки из кэша — тогда их поля не читаем
+    names = (F_GENDER, F_AGE, F_PEER, F_REP_TIER, F_MIGRATED) + (() if ent else (F_PREMIUM, F_VIP))
+    fields = dict(zip(names, await r.hmget(user_k(uid), *names)))
+    if not fields[F_MIGRATED]:  # новый пользователь или ещё на старых ключах
+        fields = await migrate_user(uid)
+    if peer is _MISS:
+        peer = remember_peer(uid, fields.get(F_PEER), epoch)
+    if ent:
+        prem, vip = ent
+    else:
+        prem, vip = int(fields.get(F_PREMIUM) or 0), int(fields.get(F_VIP) or 0)
+        remember_entitlements(uid, prem, vip, ent_epoch)
+    st = states[uid] = UserState(uid, profile_from_fields(fields), peer,
+                                 prem, vip, fields.get(F_REP_TIER) or REP_DEFAULT)
+    return st
+
+def peek_user_state(context: ContextTypes.DEFAULT_TYPE, uid: int) -> Optional[UserState]:
+    return context.__dict__.get("user_states", {}).get(uid)
+
+# Очередь разбита на шарды по (пол, возраст, кого ищет, ярус репутации) —
+# ZSET с временем постановки в score. Поиск берёт голову нужных шардов, а не
+# сканирует всё; шардов константное число, так что и поиск «любого» остаётся
+# O(1) по шардам. Прем/вип встают в очередь с форой PRIORITY_BONUS_MS.
+PRIORITY_BONUS_MS = 10 * 60 * 1000
+
+# Режим матчинга (MATCH_MODE): "fifo" — самый давний подходящий по полу/возрасту,
+# "reputation" — только соседние ярусы репутации (ближе — лучше); остальные
+# подойдут, лишь когда прождут дольше MATCH_MAX_WAIT_MS. Просроченных забирают
+# первыми в любом режиме — так ожидание ограничено сверху. Просрочка считается
+# по настоящему времени постановки (F_QUEUED), а не по score: у прем/вип он
+# сдвинут на PRIORITY_BONUS_MS, и они были бы «просрочены» сразу. Кандидаты —
+# записи шарда со score <= deadline, их смотрится не больше OVERDUE_SCAN
+# (впереди просроченных могут стоять только недавние прем/вип).
+MATCH_MODE        = os.environ.get("MATCH_MODE", "fifo")
+MATCH_MAX_WAIT_MS = int(os.environ.get("MATCH_MAX_WAIT_MS", "15000"))
+OVERDUE_SCAN      = 20
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+def queue_score(priority: bool = False, at_ms: Optional[int] = None) -> int:
+    ts = now_ms() if at_ms is None else at_ms
+    return ts - PRIORITY_BONUS_MS if priority else ts
+
+def queue_k(gender: str, age: str, want: str = WANT_ANY, rep: str = REP_DEFAULT) -> str:
+    return QUEUE_KEY.format(gender=gender, age=age, want=want, rep=rep)
+
+def _by_distance(values: tuple, own: str) -> list:
+    # Своё значение первым, дальше соседние по удалённости
+    i = values.index(own)
+    return sorted(values, key=lambda v: (abs(values.index(v) - i), values.index(v)))
+
+def age_fallback(age: str) -> list:
+    return _by_distance(AGE_RANGES, age)
+
+def _compatible_shards(p: dict, want: str, age: str, reps) -> list:
+    # Подходят те, чей пол нам нужен и кто ищет «любого» или именно наш пол
+    genders = GENDERS if want == WANT_ANY else (want,)
+    return [queue_k(g, age, w, rt) for g in genders for w in (WANT_ANY, p["gender"]) for rt in reps]
+
+# Матчер возвращает (ярусы шардов по убыванию предпочтения, шарды «только
+# для просроченных»).
+REP_MAX_DISTANCE = 1
+
+def candidate_tiers_fifo(p: dict, want: str, rep: str) -> tuple:
+    # Ярус — один возраст; репутация не важна
+    return [_compatible_shards(p, want, age, REP_TIERS) for age in age_fallback(p["age_range"])], []
+
+def candidate_tiers_reputation(p: dict, want: str, rep: str) -> tuple:
+    # Ярус — (возраст, репутация): сначала свой возраст и свой ярус репутации
+    i = REP_TIERS.index(rep)
+    near = [rt for rt in _by_distance(REP_TIERS, rep) if abs(REP_TIERS.index(rt) - i) <= REP_MAX_DISTANCE]
+    far = [rt for rt in REP_TIERS if rt not in near]
+    tiers = [_compatible_shards(p, want, age, (rt,)) for age in age_fallback(p["age_range"]) for rt in near]
+    overdue_only = [k for age in AGE_RANGES for k in _compatible_shards(p, want, age, far)]
+    return tiers, overdue_only
+
+MATCHERS = {
+    "fifo": candidate_tiers_fifo,
+    "reputation": candidate_tiers_reputation,
+}
 
-async def push_queue(uid: int):
-    members = await r.lrange(QUEUE_KEY, 0, -1)
-    if str(uid) not in members:
-        await r.rpush(QUEUE_KEY, uid)
-async def pop_queue() -> Optional[int]:
-    val = await r.lpop(QUEUE_KEY)
-    return int(val) if val else None
-async def remove_from_queue(uid: int): await r.lrem(QUEUE_KEY, 0, uid)
+def candidate_tiers(p: dict, want: str = WANT_ANY, rep: str = REP_DEFAULT) -> tuple:
+    return MATCHERS.get(MATCH_MODE, candidate_tiers_fifo)(p, want, rep)
+
+async def remove_from_queue(uid: int): await dequeue_script(keys=[QUEUE_WHERE], args=[uid])
+
+# ===== Исходящие: планировщик отправки =====
+# Все массовые отправки идут через один планировщик: глобальный token bucket
+# (лимит Bot API на бота) + bucket на каждый чат. Токен чата резервируется
+# при постановке, поэтому сообщения в один чат уходят в порядке вызова.
+# Из готовых к отправке первыми уходят более приоритетные (релей впереди
+# оценок). RetryAfter по одному чату (Telegram не говорит, чей это лимит)
+# ставит на паузу только этот чат — сообщение повторяется после паузы, а
+# остальные чаты идут дальше. Если за RETRY_GLOBAL_WINDOW_S RetryAfter пришёл
+# от RETRY_GLOBAL_CHATS разных чатов — это лимит бота, на паузу встаёт вся
+# отправка.
+# Лимит на бота общий для всех воркеров и идущей рассылки (tools/broadcast):
+# каждый берёт TG_GLOBAL_RATE / число живых отправителей (см. send_rate_share).
+# Доля простаивающего при этом не достаётся другим — зато на отправку нет
+# лишнего запроса в Redis.
+TG_GLOBAL_RATE  = float(os.environ.get("TG_GLOBAL_RATE", "30"))   # сообщений/с на бота
+TG_CHAT_RATE    = float(os.environ.get("TG_CHAT_RATE", "1"))      # сообщений/с в один чат
+TG_CHAT_BURST   = float(os.environ.get("TG_CHAT_BURST", "3"))
+SEND_CONCURRENCY = int(os.environ.get("SEND_CONCURRENCY", "64"))
+SEND_MAX_RETRIES = 3
+RETRY_GLOBAL_CHATS    = 3
+RETRY_GLOBAL_WINDOW_S = 1.0
+
+PRIO_INTERACTIVE = 0  # релей, «собеседник найден», конец диалога
+PRIO_NORMAL      = 1
+PRIO_BULK        = 2  # предложения оценить, рассылки
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.ts = burst, time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+
+    def set_rate(self, rate: float, burst: float):
+        self._refill()  # накопленное до смены — по старой скорости
+        self.rate, self.burst = rate, burst
+        self.tokens = min(self.tokens, burst)
+
+    def hold(self, secs: float):
+        # Ближайший токен — не раньше чем через secs
+        self._refill()
+        self.tokens = min(self.tokens, -secs * self.rate)
+
+    def reserve(self) -> float:
+        # Забирает токен (можно «в долг») и возвращает, сколько ждать до него
+        self._refill()
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def idle(self) -> bool:
+        return self.tokens + (time.monotonic() - self.ts) * self.rate >= self.burst
+
+class SendScheduler:
+    CHAT_BUCKETS_MAX = 50_000
+
+    def __init__(self, global_rate: float = TG_GLOBAL_RATE, chat_rate: float = TG_CHAT_RATE,
+                 chat_burst: float = TG_CHAT_BURST, concurrency: int = SEND_CONCURRENCY):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate, self._chat_burst = chat_rate, chat_burst
+        self._chats: dict = {}
+        self._heap: list = []
+        self._seq = itertools.count()
+        self._wake = asyncio.Event()
+        self._sem = asyncio.Semaphore(concurrency)
+        self._paused_until = 0.0
+        self._retries: collections.deque = collections.deque()  # (время, чат) последних RetryAfter
+        self.stats = {"sent": 0, "failed": 0, "retry_after": 0, "global_pauses": 0, "wait_sum": 0.0, "wait_max": 0.0}
+
+    def set_global_rate(self, rate: float):
+        self._global.set_rate(rate, rate)
+
+    def queue_depth(self) -> int:
+        return len(self._heap)
+
+    def avg_wait(self) -> float:
+        done = self.stats["sent"] + self.stats["failed"]
+        return self.stats["wait_sum"] / done if done else 0.0
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        b = self._chats.get(chat_id)
+        if b is None:
+            if len(self._chats) >= self.CHAT_BUCKETS_MAX:
+                self._chats = {k: v for k, v in self._chats.items() if not v.idle()}
+            b = self._chats[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        return b
+
+    async def send(self, chat_id: int, factory, priority: int = PRIO_NORMAL):
+        # factory — функция без аргументов, возвращающая корутину вызова Bot API
+        delay = self._chat_bucket(chat_id).reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        fut = asyncio.get_running_loop().create_future()
+        self._push((priority, next(self._seq), time.monotonic(), chat_id, factory, fut, 0))
+        return await fut
+
+    def _push(self, item):
+        if not item[5].done():  # отправитель мог уже отменить ожидание
+            heapq.heappush(self._heap, item)
+            self._wake.set()
+
+    def _on_retry_after(self, chat_id: int, secs: float):
+        # Пауза чату; если 429 сразу от нескольких чатов — пауза всей отправке
+        now = time.monotonic()
+        self._chat_bucket(chat_id).hold(secs)
+        self._retries.append((now, chat_id))
+        while self._retries and self._retries[0][0] < now - RETRY_GLOBAL_WINDOW_S:
+            self._retries.popleft()
+        if len({c for _, c in self._retries}) >= RETRY_GLOBAL_CHATS:
+            self.stats["global_pauses"] += 1
+            self._paused_until = max(self._paused_until, now + secs)
+            self._retries.clear()
+
+    async def run(self):
+        while True:
+            if not self._heap:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause);  continue
+            delay = self._global.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self._sem.acquire()
+            if not self._heap:  # пока ждали, всё разобрали
+                self._sem.release();  continue
+            asyncio.create_task(self._execute(heapq.heappop(self._heap)))
+
+    async def _execute(self, item):
+        priority, seq, enq_ts, chat_id, factory, fut, attempt = item
+        # Отправитель может отменить ожидание в любой момент (разрыв пары,
+        # потеря лидерства) — тогда результат никому не нужен
+        try:
+            if fut.done():
+                return
+            try:
+                res = await factory()
+            except RetryAfter as e:
+                self.stats["retry_after"] += 1
+                self._on_retry_after(chat_id, e.retry_after)
+                log.warning(f"send scheduler: RetryAfter {e.retry_after}s for {chat_id}, queue={len(self._heap)}")
+                if attempt + 1 < SEND_MAX_RETRIES:
+                    asyncio.get_running_loop().call_later(
+                        e.retry_after, self._push, (priority, seq, enq_ts, chat_id, factory, fut, attempt + 1))
+                    return
+                self._done(enq_ts, "failed")
+                if not fut.done(): fut.set_exception(e)
+            except Exception as e:
+                self._done(enq_ts, "failed")
+                if not fut.done(): fut.set_exception(e)
+            else:
+                self._done(enq_ts, "sent")
+                if not fut.done(): fut.set_result(res)
+        finally:
+            self._sem.release()
+
+    def _done(self, enq_ts: float, outcome: str):
+        wait = time.monotonic() - enq_ts
+        self.stats[outcome] += 1
+        self.stats["wait_sum"] += wait
+        self.stats["wait_max"] = max(self.stats["wait_max"], wait)
+
+outbox: Optional[SendScheduler] = None  # создаётся в post_init
+
+async def fan_out(sends: dict, what: str):
+    # Независимые отправки разным получателям — параллельно; ошибка одного
+    # (заблокировал бота и т.п.) не ломает остальных. sends: {chat_id: корутина}
+    results = await asyncio.gather(*sends.values(), return_exceptions=True)
+    for chat_id, res in zip(sends, results):
+        if isinstance(res, Exception):
+            log.error(f"{what} → {chat_id} failed: {res}")
+
+async def scheduled(chat_id: int, factory, priority: int = PRIO_NORMAL):
+    if outbox is None:
+        return await factory()
+    return await outbox.send(chat_id, factory, priority)
+
+async def send_text(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str,
+                    priority: int = PRIO_NORMAL, **kwargs):
+    return await scheduled(chat_id, lambda: context.bot.send_message(chat_id, text, **kwargs), priority)
 
 # ===== START / анкета =====
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    await add_user(uid)
-    p = await get_profile(uid)
+    add_user(uid)
+    p = (await load_user_state(context, uid)).profile
     if not p["gender"]:
         await update.message.reply_text("Привет! Выбери свой пол:", reply_markup=gender_kb());  return
     if not p["age_range"]:
         await update.message.reply_text("Укажи возраст:", reply_markup=age_kb());  return
 
-    total = await users_count()
     await update.message.reply_text("Профиль уже заполнен ✅\n" + profile_str(p))
-    await update.message.reply_text(menu_text_base(total, "Отлично!"), reply_markup=reply_menu_kb())
+    await update.message.reply_text(menu_text_base(online_count(), "Отлично!"), reply_markup=reply_menu_kb())
 
 # callbacks анкеты
 async def on_gender(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query;  await q.answer()
     uid = q.from_user.id;  _, gender = q.data.split(":", 1)
-    p = await get_profile(uid);  p["gender"] = gender;  await save_profile(uid, p)
+    p = (await load_user_state(context, uid)).profile;  p["gender"] = gender;  await save_profile(uid, p)
     await q.edit_message_text("Пол сохранён ✅\nТеперь выбери возраст:", reply_markup=age_kb())
 
 async def on_age(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query;  await q.answer()
     uid = q.from_user.id;  _, age_range = q.data.split(":", 1)
-    p = await get_profile(uid);  p["age_range"] = age_range;  await save_profile(uid, p)
-    total = await users_count()
+    p = (await load_user_state(context, uid)).profile;  p["age_range"] = age_range;  await save_profile(uid, p)
     await q.edit_message_text("Возраст сохранён ✅\n\nТвой профиль:\n" + profile_str(p))
-    await q.message.reply_text(menu_text_base(total, "Отлично!"), reply_markup=reply_menu_kb())
+    await q.message.reply_text(menu_text_base(online_count(), "Отлично!"), reply_markup=reply_menu_kb())
+
+# ===== Дневной лимит чатов =====
+# Бесплатным — не больше FREE_CHATS_PER_DAY собеседников в сутки (премиум и
+# VIP без лимита, это видно из UserState — лишнего запроса нет). Проверка и
+# счёт — внутри скрипта матчинга: чат засчитывается обоим, когда пара
+# создана. Счётчики компактные: за день — HASH на каждые QUOTA_SHARD uid
+# (поле — uid % QUOTA_SHARD, хэш остаётся listpack), ключи дня живут
+# QUOTA_TTL_S и исчезают сами — память зависит только от активных за сутки.
+FREE_CHATS_PER_DAY = int(os.environ.get("FREE_CHATS_PER_DAY", "50"))   # 0 — без лимита
+QUOTA_KEY          = "quota:{day}:{shard}"
+QUOTA_SHARD        = 100
+QUOTA_TTL_S        = 2 * 86400
+QUOTA_TZ_OFFSET_S  = int(os.environ.get("QUOTA_TZ_OFFSET_S", str(3 * 3600)))  # сутки по Москве
+
+def quota_prefix(at_s: Optional[float] = None) -> str:
+    day = int(((time.time() if at_s is None else at_s) + QUOTA_TZ_OFFSET_S) // 86400)
+    return QUOTA_KEY.format(day=day, shard="")
+
+def quota_text() -> str:
+    return (f"На сегодня лимит бесплатных чатов исчерпан ({FREE_CHATS_PER_DAY} собеседников в сутки) 😔\n\n"
+            "Новые собеседники — завтра, а с премиумом — без ограничений: /pay")
 
 # ===== Matching =====
-async def try_match(uid: int) -> Optional[int]:
-    while True:
-        other = await pop_queue()
-        if other is None: return None
-        if other == uid:
-            await push_queue(other)
-            return None
-        if await get_peer(other):  # уже занят
+# Весь матчинг — одним Lua-скриптом: найти свободного собеседника, убрать его
+# из очереди и записать пару в хэши обоих, либо встать в очередь самому.
+# Скрипт выполняется атомарно, поэтому параллельные /search не могут забрать
+# одного и того же собеседника или оставить пару в очереди.
+# ARGV[1..8] — me, префикс хэша, поле пары, score, свой шард, deadline,
+# поле времени постановки, now. ARGV[9..12] — дневной лимит чатов (см.
+# выше): префикс ключа дня, лимит (0 — без лимита), TTL ключа, QUOTA_SHARD.
+# ARGV[13] — OVERDUE_SCAN, ARGV[14] — поле F_COUNTED. ARGV[15..] — шарды-кандидаты по ярусам, ярусы
+# разделены "|"; после "#" — шарды, из которых берём только просроченных.
+# Если кто-то ждёт с момента <= deadline (ARGV[6]), первым берём самого
+# давнего из них.
+# Ответ: {id собеседника, сколько он ждал в мс}; id 0 — встали в очередь,
+# -1 — уже в диалоге, -2 — лимит чатов на сегодня исчерпан.
+DEQUEUE_LUA = """
+local prev = redis.call('HGET', KEYS[1], ARGV[1])
+if prev then
+  redis.call('ZREM', prev, ARGV[1])
+  redis.call('HDEL', KEYS[1], ARGV[1])
+end
+"""
+MATCH_LUA = """
+local where, chan, npairs = KEYS[1], KEYS[2], KEYS[3]
+local me, pfx, fld, score, mine = ARGV[1], ARGV[2], ARGV[3], ARGV[4], ARGV[5]
+local deadline, qt, now = tonumber(ARGV[6]), ARGV[7], tonumber(ARGV[8])
+local quota, limit, quota_ttl, qshard = ARGV[9], tonumber(ARGV[10]), ARGV[11], tonumber(ARGV[12])
+local scan, counted = tonumber(ARGV[13]), ARGV[14]
+if redis.call('HEXISTS', pfx .. me, fld) == 1 then return {-1, 0} end
+
+-- счётчик чатов за день: HASH на каждые qshard uid, поле — uid % qshard
+local function quota_k(u)
+  return quota .. math.floor(tonumber(u) / qshard), tonumber(u) % qshard
+end
+if limit > 0 then
+  local k, f = quota_k(me)
+  if (tonumber(redis.call('HGET', k, f)) or 0) >= limit then return {-2, 0} end
+end
+local prev = redis.call('HGET', where, me)
+if prev then redis.call('ZREM', prev, me) end
+
+-- забрать из очереди; nil, если он уже в паре (тогда просто выкинут)
+local function take(u, k)
+  redis.call('ZREM', k, u)
+  redis.call('HDEL', where, u)
+  if redis.call('HEXISTS', pfx .. u, fld) == 0 then return u end
+end
+
+-- самый давний свободный из голов шардов (по score, с форой прем/вип)
+local function pick(shards)
+  while true do
+    local best, best_k, best_s
+    for _, k in ipairs(shards) do
+      local head = redis.call('ZRANGE', k, 0, 0, 'WITHSCORES')
+      local s = #head > 0 and tonumber(head[2])
+      if s and (best_s == nil or s < best_s) then
+        best, best_k, best_s = head[1], k, s
+      end
+    end
+    if not best then return nil end
+    if take(best, best_k) then return best end
+  end
+end
+
+-- самый давний из ждущих с qt <= deadline; время постановки >= score, поэтому
+-- в шарде дальше score > лучшего найденного времени смотреть незачем
+local function pick_overdue(shards)
+  while true do
+    local best, best_k, best_t
+    for _, k in ipairs(shards) do
+      local c = redis.call('ZRANGEBYSCORE', k, '-inf', ARGV[6], 'WITHSCORES', 'LIMIT', 0, scan)
+      for i = 1, #c, 2 do
+        local s = tonumber(c[i + 1])
+        if best_t and s >= best_t then break end
+        local t = tonumber(redis.call('HGET', pfx .. c[i], qt)) or s
+        if t <= deadline and (best_t == nil or t < best_t) then
+          best, best_k, best_t = c[i], k, t
+        end
+      end
+    end
+    if not best then return nil end
+    if take(best, best_k) then return best end
+  end
+end
+
+local function pair(other)
+  local since = tonumber(redis.call('HGET', pfx .. other, qt)) or now
+  redis.call('HDEL', where, me)
+  redis.call('HDEL', pfx .. me, qt)
+  redis.call('HDEL', pfx .. other, qt)
+  redis.call('HSET', pfx .. me, fld, other, counted, 1)
+  redis.call('HSET', pfx .. other, fld, me, counted, 1)
+  for _, u in ipairs({me, other}) do
+    local k, f = quota_k(u)
+    redis.call('HINCRBY', k, f, 1)
+    redis.call('EXPIRE', k, quota_ttl)
+  end
+  redis.call('INCR', npairs)
+  redis.call('PUBLISH', chan, me .. ',' .. other)
+  return {tonumber(other), math.max(now - since, 0)}
+end
+
+local all, tiers, tier, overdue_only = {}, {}, {}, false
+for i = 15, #ARGV do
+  if ARGV[i] == '#' then
+    overdue_only = true
+  elseif ARGV[i] == '|' then
+    table.insert(tiers, tier);  tier = {}
+  else
+    if not overdue_only then table.insert(tier, ARGV[i]) end
+    table.insert(all, ARGV[i])
+  end
+end
+table.insert(tiers, tier)
+
+local other = pick_overdue(all)
+if other then return pair(other) end
+for _, t in ipairs(tiers) do
+  other = pick(t)
+  if other then return pair(other) end
+end
+redis.call('ZADD', mine, score, me)
+redis.call('HSET', where, me, mine)
+redis.call('HSET', pfx .. me, qt, ARGV[8])
+return {0, 0}
+"""
+match_script = None    # регистрируются в post_init
+dequeue_script = None
+
+async def match_or_enqueue(uid: int, p: dict, want: str = WANT_ANY, priority: bool = False,
+                           rep: str = REP_DEFAULT, at_ms: Optional[int] = None, quota: int = 0) -> int:
+    # at_ms — «текущее» время в мс; задаётся только симулятором.
+    # quota — сколько чатов в день разрешено (0 — без лимита)
+    ts = now_ms() if at_ms is None else at_ms
+    # В пакетном режиме поиск только ставит в очередь — пары собирает тик
+    tiers, overdue_only = ([], []) if MATCH_SCHEDULER == "batch" else candidate_tiers(p, want, rep)
+    shards = []
+    for tier in tiers:
+        shards += tier + ["|"]
+    res, waited = await match_script(
+        keys=[QUEUE_WHERE, PAIR_CHANNEL, PAIRS_COUNT],
+        args=[uid, user_k(""), F_PEER, queue_score(priority, ts),
+              queue_k(p["gender"], p["age_range"], want, rep), ts - MATCH_MAX_WAIT_MS, F_QUEUED, ts,
+              quota_prefix(ts / 1000), quota, QUOTA_TTL_S, QUOTA_SHARD, OVERDUE_SCAN, F_COUNTED,
+              *shards[:-1], "#", *overdue_only],
+    )
+    if res > 0:
+        invalidate_pairs(uid, res)
+        # Ждал собеседник; нашедший сразу ждал 0
+        match_wait.observe(waited / 1000)
+        match_wait.observe(0.0)
+        emit_event("pair", uid, p=res, wu=0, wp=waited)
+    elif res == 0:
+        emit_event("queue", uid)
+    return res
+
+# ===== Пакетный матчинг =====
+# MATCH_SCHEDULER=batch: раз в MATCH_TICK_MS одна фоновая задача читает все
+# шарды одним пайплайном, подбирает пары в памяти (старшие по score — первыми,
+# с теми же правилами пола/возраста/репутации, что и скрипт), записывает их
+# одним скриптом и рассылает уведомления параллельно. Скрипт записи заново
+# проверяет, что оба ещё в очереди и свободны, — поиск/стоп между чтением и
+# записью пару просто отменяют.
+MATCH_SCHEDULER    = os.environ.get("MATCH_SCHEDULER", "request")  # request | batch
+MATCH_TICK_MS      = int(os.environ.get("MATCH_TICK_MS", "500"))
+BATCH_MAX_PER_SHARD = 5000
+
+COMMIT_PAIRS_LUA = """
+local where, chan, npairs = KEYS[1], KEYS[2], KEYS[3]
+local pfx, fld, qt, now = ARGV[1], ARGV[2], ARGV[3], tonumber(ARGV[4])
+local quota, quota_ttl, qshard, counted = ARGV[5], ARGV[6], tonumber(ARGV[7]), ARGV[8]
+local done = {}
+for i = 9, #ARGV, 2 do
+  local a, b = ARGV[i], ARGV[i + 1]
+  local sa, sb = redis.call('HGET', where, a), redis.call('HGET', where, b)
+  if sa and sb and redis.call('HEXISTS', pfx .. a, fld) == 0 and redis.call('HEXISTS', pfx .. b, fld) == 0 then
+    redis.call('ZREM', sa, a)
+    redis.call('ZREM', sb, b)
+    redis.call('HDEL', where, a, b)
+    local qa = tonumber(redis.call('HGET', pfx .. a, qt)) or now
+    local qb = tonumber(redis.call('HGET', pfx .. b, qt)) or now
+    redis.call('HDEL', pfx .. a, qt)
+    redis.call('HDEL', pfx .. b, qt)
+    redis.call('HSET', pfx .. a, fld, b, counted, 1)
+    redis.call('HSET', pfx .. b, fld, a, counted, 1)
+    for _, u in ipairs({a, b}) do  -- дневной счётчик чатов, как в MATCH_LUA
+      local k = quota .. math.floor(tonumber(u) / qshard)
+      redis.call('HINCRBY', k, tonumber(u) % qshard, 1)
+      redis.call('EXPIRE', k, quota_ttl)
+    end
+    redis.call('INCR', npairs)
+    redis.call('PUBLISH', chan, a .. ',' .. b)
+    for _, x in ipairs({a, b, math.max(now - qa, 0), math.max(now - qb, 0)}) do table.insert(done, x) end
+  end
+end
+return done
+"""
+commit_pairs_script = None  # регистрируется в post_init
+
+def all_shards() -> list:
+    return [queue_k(g, age, w, rt) for g in GENDERS for age in AGE_RANGES
+            for w in (WANT_ANY,) + GENDERS for rt in REP_TIERS]
+
+def plan_pairs(waiting: dict, at_ms: int, since: Optional[dict] = None) -> list:
+    # waiting: {шард: [(uid, score), ...] по возрастанию score} -> [(a, b), ...]
+    # since: {uid: время постановки, мс} — для тех, кто может быть просрочен
+    # (score <= deadline); без записи время постановки считается равным score
+    since = since or {}
+    heads = {k: 0 for k in waiting}
+    taken = set()
+    deadline = at_ms - MATCH_MAX_WAIT_MS
+
+    def skip_taken(k):
+        # Разобранных с головы шарда снимаем насовсем
+        entries, i = waiting[k], heads[k]
+        while i < len(entries) and entries[i][0] in taken:
+            i += 1
+        heads[k] = i
+        return entries, i
+
+    def oldest(shards, me):
+        # Самый давний свободный (кроме me) из голов шардов, по score
+        best = None
+        for k in shards:
+            if not waiting.get(k):
+                continue
+            entries, i = skip_taken(k)
+            while i < len(entries) and (entries[i][0] == me or entries[i][0] in taken):
+                i += 1
+            if i < len(entries) and (best is None or entries[i][1] < best[1]):
+                best = entries[i]
+        return best and best[0]
+
+    def oldest_overdue(shards, me):
+        # Самый давний из ждущих с настоящего времени <= deadline (как в MATCH_LUA)
+        best, best_t = None, None
+        for k in shards:
+            if not waiting.get(k):
+                continue
+            entries, i = skip_taken(k)
+            for uid, sc in entries[i:i + OVERDUE_SCAN]:
+                if sc > deadline or (best_t is not None and sc >= best_t):
+                    break
+                t = since.get(uid, sc)
+                if uid != me and uid not in taken and t <= deadline and (best_t is None or t < best_t):
+                    best, best_t = uid, t
+        return best
+
+    pairs = []
+    order = sorted(((sc, uid, k) for k, entries in waiting.items() for uid, sc in entries))
+    for _, uid, k in order:
+        if uid in taken:
             continue
-        return other
-
-async def try_match_priority(uid: int) -> Optional[int]:
-    # Для прем/вип — приоритетный просмотр очереди
-    members = await r.lrange(QUEUE_KEY, 0, -1)
-    for raw in members:
-        other = int(raw)
-        if other == uid: continue
-        if await get_peer(other): continue
-        await r.lrem(QUEUE_KEY, 1, other)
-        return other
-    return None
+        _, _, g, age, want, rep = k.split(":")
+        tiers, overdue_only = candidate_tiers({"gender": g, "age_range": age}, want, rep)
+        found = oldest_overdue([s for t in tiers for s in t] + overdue_only, uid)
+        for t in tiers:
+            if found:
+                break
+            found = oldest(t, uid)
+        if found:
+            taken.update((uid, found))
+            pairs.append((uid, found))
+    return pairs
+
+async def batch_match_tick(at_ms: Optional[int] = None) -> list:
+    shards = all_shards()
+    pipe = r.pipeline(transaction=False)
+    for k in shards:
+        pipe.zrange(k, 0, BATCH_MAX_PER_SHARD - 1, withscores=True)
+    waiting = {k: [(int(u), sc) for u, sc in entries] for k, entries in zip(shards, await pipe.execute()) if entries}
+    ts = now_ms() if at_ms is None else at_ms
+    # Настоящее время постановки — только тем, кто по score может быть просрочен
+    maybe_overdue = [u for entries in waiting.values() for u, sc in entries if sc <= ts - MATCH_MAX_WAIT_MS]
+    pipe = r.pipeline(transaction=False)
+    for u in maybe_overdue:
+        pipe.hget(user_k(u), F_QUEUED)
+    since = {u: int(t) for u, t in zip(maybe_overdue, await pipe.execute()) if t}
+    pairs = plan_pairs(waiting, ts, since)
+    if not pairs:
+        return []
+    done = await commit_pairs_script(
+        keys=[QUEUE_WHERE, PAIR_CHANNEL, PAIRS_COUNT],
+        args=[user_k(""), F_PEER, F_QUEUED, ts, quota_prefix(ts / 1000), QUOTA_TTL_S, QUOTA_SHARD, F_COUNTED,
+              *(x for pr in pairs for x in pr)],
+    )
+    # done: a, b, ждал a (мс), ждал b, ...
+    done = [int(x) for x in done]
+    for i in range(0, len(done), 4):
+        invalidate_pairs(done[i], done[i + 1])
+        match_wait.observe(done[i + 2] / 1000)
+        match_wait.observe(done[i + 3] / 1000)
+        emit_event("pair", done[i], p=done[i + 1], wu=done[i + 2], wp=done[i + 3])
+    return [(done[i], done[i + 1]) for i in range(0, len(done), 4)]
+
+async def batch_matcher(app: Application):
+    context = app.context_types.context(app)
+    while True:
+        await asyncio.sleep(MATCH_TICK_MS / 1000)
+        try:
+            pairs = await batch_match_tick()
+        except Exception as e:
+            log.warning(f"batch match tick failed: {e}");  continue
+        if pairs:
+            await asyncio.gather(*(announce_pair(context, a, b) for a, b in pairs))
 
 async def announce_pair(context: ContextTypes.DEFAULT_TYPE, a: int, b: int):
     text = "Собеседник найден! Можете общаться анонимно. ✍️\n\n/next — искать нового собеседника\n/stop — закончить диалог"
-    await context.bot.send_message(a, text, reply_markup=hide_reply_kb())
-    await context.bot.send_message(b, text, reply_markup=hide_reply_kb())
-
-async def do_search(chat_id: int, uid: int, context: ContextTypes.DEFAULT_TYPE):
-    p = await get_profile(uid)
+    await fan_out({
+        a: send_text(context, a, text, PRIO_INTERACTIVE, reply_markup=hide_reply_kb()),
+        b: send_text(context, b, text, PRIO_INTERACTIVE, reply_markup=hide_reply_kb()),
+    }, "announce pair")
+
+async def do_search(chat_id: int, uid: int, context: ContextTypes.DEFAULT_TYPE, want: str = WANT_ANY):
+    st = await load_user_state(context, uid)
+    p = st.profile
     if not (p.get("gender") and p.get("age_range")):
-        await context.bot.send_message(chat_id, "Сначала заполни профиль: /start");  return
-    if await get_peer(uid):
-        await context.bot.send_message(chat_id, "Ты уже в диалоге.\n/next — новый собеседник\n/stop — закончить диалог");  return
+        await send_text(context, chat_id, "Сначала заполни профиль: /start");  return
 
-    peer = None
-    if await has_gender_rights(uid):
-        peer = await try_match_priority(uid)
-    if not peer:
-        peer = await try_match(uid)
+    if st.peer:
+        await send_text(context, chat_id, "Ты уже в диалоге.\n/next — новый собеседник\n/stop — закончить диалог");  return
 
+    peer = await match_or_enqueue(uid, p, want, priority=st.has_gender_rights, rep=st.rep_tier,
+                                  quota=0 if st.has_gender_rights else FREE_CHATS_PER_DAY)
+    if peer == -2:
+        await send_text(context, chat_id, quota_text(), reply_markup=reply_menu_kb());  return
+    if peer < 0:
+        await send_text(context, chat_id, "Ты уже в диалоге.\n/next — новый собеседник\n/stop — закончить диалог");  return
     if peer:
-        await set_pair(uid, peer);  await announce_pair(context, uid, peer)
+        await announce_pair(context, uid, peer)
     else:
-        await push_queue(uid)
-        await context.bot.send_message(chat_id, "Ищу собеседника… ⏳\n/stop — отменить поиск", reply_markup=hide_reply_kb())
+        await send_text(context, chat_id, "Ищу собеседника… ⏳\n/stop — отменить поиск", reply_markup=hide_reply_kb())
 
 async def cmd_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await add_user(update.effective_user.id)
+    add_user(update.effective_user.id)
     await do_search(update.effective_chat.id, update.effective_user.id, context)
 
 # ===== Оценка и жалобы =====
-RATE_MENU = InlineKeyboardMarkup([
-    [InlineKeyboardButton("👍🏻", callback_data="rate:+"), InlineKeyboardButton("👎🏻", callback_data="rate:-")],
-    [InlineKeyboardButton("⚠️Пожаловаться", callback_data="report:open")],
-])
-REPORT_MENU = InlineKeyboardMarkup([
-    [InlineKeyboardButton("📰 Реклама", callback_data="report:Реклама")],
-    [InlineKeyboardButton("💰 Продажа", callback_data="report:Продажа")],
-    [InlineKeyboardButton("⛔ Разжигание розни", callback_data="report:Разжигание розни")],
-    [InlineKeyboardButton("🔞 Детская порнография", callback_data="report:Детская порнография")],
-    [InlineKeyboardButton("🪙 Попрошайничество", callback_data="report:Попрошайничество")],
-    [InlineKeyboardButton("😡 Оскорбление", callback_data="report:Оскорбление")],
-    [InlineKeyboardButton("👊 Насилие", callback_data="report:Насилие")],
-    [InlineKeyboardButton("📣 Пропаганда суицида", callback_data="report:Пропаганда суицида")],
-    [InlineKeyboardButton("❌ Пошлый собеседник", callback_data="report:Пошлый собеседник")],
-    [InlineKeyboardButton("← Назад", callback_data="report:back")],
-])
-
-async def send_rate_prompt(context: ContextTypes.DEFAULT_TYPE, uid: int):
+# Каждое приглашение оценить привязано к своему диалогу: в callback_data —
+# случайный токен, а собеседник лежит в хэше rt:{uid} под этим токеном.
+# Поэтому старая кнопка оценивает того, с кем был тот диалог, а не последнего,
+# и подделать собеседника через callback_data нельзя. Токен одноразовый; в
+# хэше живут только RATE_TOKENS_MAX последних, кнопки старше — недоступны.
+RATE_TOKEN_TTL_S = 7 * 86400
+RATE_TOKENS_MAX  = 5
+REPORT_REASONS = (
+    ("📰", "Реклама"), ("💰", "Продажа"), ("⛔", "Разжигание розни"), ("🔞", "Детская порнография"),
+    ("🪙", "Попрошайничество"), ("😡", "Оскорбление"), ("👊", "Насилие"), ("📣", "Пропаганда суицида"),
+    ("❌", "Пошлый собеседник"),
+)
+# callback_data: "rate:+:{token}", "report:{причина|open|back}:{token}" (до 64 байт)
+RATE_DATA = re.compile(r"^(rate:[+-]|report:[^:]+):([0-9a-f]{12})$")
+
+def rate_tokens_k(uid: int) -> str: return RATE_TOKEN_KEY.format(uid=uid)
+
+def rate_menu(token: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("👍🏻", callback_data=f"rate:+:{token}"),
+         InlineKeyboardButton("👎🏻", callback_data=f"rate:-:{token}")],
+        [InlineKeyboardButton("⚠️Пожаловаться", callback_data=f"report:open:{token}")],
+    ])
+
+def report_menu(token: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton(f"{icon} {reason}", callback_data=f"report:{reason}:{token}")]
+         for icon, reason in REPORT_REASONS]
+        + [[InlineKeyboardButton("← Назад", callback_data=f"report:back:{token}")]])
+
+# Выдать токен и оставить в хэше только ARGV[3] последних (по времени выдачи)
+RATE_TOKEN_LUA = """
+local k, token, peer, keep = KEYS[1], ARGV[1], ARGV[2], tonumber(ARGV[3])
+local t = redis.call('TIME')
+redis.call('HSET', k, token, t[1] .. string.format('%06d', t[2]) .. ':' .. peer)
+local all, issued = redis.call('HGETALL', k), {}
+for i = 1, #all, 2 do
+  table.insert(issued, {tonumber(string.match(all[i + 1], '^(%d+):')) or 0, all[i]})
+end
+table.sort(issued, function(x, y) return x[1] < y[1] end)
+for i = 1, #issued - keep do redis.call('HDEL', k, issued[i][2]) end
+redis.call('EXPIRE', k, ARGV[4])
+"""
+rate_token_script = None  # регистрируется в connect_redis
+
+async def issue_rate_token(uid: int, peer: int) -> str:
+    token = uuid.uuid4().hex[:12]
+    await rate_token_script(keys=[rate_tokens_k(uid)], args=[token, peer, RATE_TOKENS_MAX, RATE_TOKEN_TTL_S])
+    return token
+
+async def take_rate_token(uid: int, token: str) -> Optional[int]:
+    # Одноразово: HGET и HDEL в одной транзакции — двойное нажатие засчитается один раз
+    pipe = r.pipeline(transaction=True)
+    pipe.hget(rate_tokens_k(uid), token)
+    pipe.hdel(rate_tokens_k(uid), token)
+    val, _ = await pipe.execute()
+    if not val:
+        return None
+    issued_us, peer = val.split(":")
+    if int(issued_us) < (time.time() - RATE_TOKEN_TTL_S) * 1e6:
+        return None
+    return int(peer)
+
+async def send_rate_prompt(context: ContextTypes.DEFAULT_TYPE, uid: int, peer: int):
     txt = "Если хотите, оставьте мнение о вашем собеседнике. Это поможет находить вам подходящих собеседников"
-    await context.bot.send_message(uid, txt, reply_markup=RATE_MENU)
+    token = await issue_rate_token(uid, peer)
+    await send_text(context, uid, txt, PRIO_BULK, reply_markup=rate_menu(token))
+
+# Оценки хранятся у того, КОГО оценили: счётчики в его хэше (O(1) для /stats
+# и матчинга) + короткое окно последних событий для модерации.
+def feedback_k(uid: int) -> str: return FEEDBACK_KEY.format(uid=uid)
+
+# Ярус репутации пересчитывается тем же скриптом, что пишет оценку, —
+# поэтому при поиске он уже готов и читается вместе с остальным состоянием.
+# Оценка: (👍+1)/(👍+👎+2) минус штраф за жалобы; высокий ярус — только при
+# REP_MIN_VOTES голосах, чтобы пара случайных 👍 не поднимала новичка.
+REP_LOW, REP_HIGH, REP_MIN_VOTES, REP_REPORT_PENALTY = 0.35, 0.7, 5, 0.1
+
+def rep_tier(up: int, down: int, reports: int) -> str:
+    score = (up + 1) / (up + down + 2) - REP_REPORT_PENALTY * reports
+    if score < REP_LOW:
+        return "0"
+    if score > REP_HIGH and up + down >= REP_MIN_VOTES:
+        return "2"
+    return REP_DEFAULT
+
+FEEDBACK_LUA = """
+local ukey, fb, counter, rec, recent = KEYS[1], KEYS[2], ARGV[1], ARGV[2], tonumber(ARGV[3])
+local low, high, min_votes, penalty = tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6]), tonumber(ARGV[7])
+local f_up, f_down, f_reports, f_tier = ARGV[8], ARGV[9], ARGV[10], ARGV[11]
+redis.call('HINCRBY', ukey, counter, 1)
+redis.call('LPUSH', fb, rec)
+redis.call('LTRIM', fb, 0, recent - 1)
+local c = redis.call('HMGET', ukey, f_up, f_down, f_reports)
+local up, down, reps = tonumber(c[1]) or 0, tonumber(c[2]) or 0, tonumber(c[3]) or 0
+local score = (up + 1) / (up + down + 2) - penalty * reps
+local tier = '1'
+if score < low then tier = '0' elseif score > high and up + down >= min_votes then tier = '2' end
+redis.call('HSET', ukey, f_tier, tier)
+return tier
+"""
+feedback_script = None  # регистрируется в post_init
+
+async def record_feedback(peer: int, counter: str, rec: dict) -> str:
+    return await feedback_script(
+        keys=[user_k(peer), feedback_k(peer)],
+        args=[counter, json.dumps(rec, separators=(",", ":")), FEEDBACK_RECENT,
+              REP_LOW, REP_HIGH, REP_MIN_VOTES, REP_REPORT_PENALTY,
+              F_UP, F_DOWN, F_REPORTS, F_REP_TIER],
+    )
+
+async def get_feedback_counts(uid: int) -> tuple:
+    up, down, reports = await r.hmget(user_k(uid), F_UP, F_DOWN, F_REPORTS)
+    return int(up or 0), int(down or 0), int(reports or 0)
 
 async def on_rate_or_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query;  await q.answer()
     uid = q.from_user.id
-    data = q.data
-    peer = await get_peer(uid)
-    peer_id = peer if peer else 0
+    m = RATE_DATA.match(q.data)
+    if not m:  # кнопки без токена — из старых сообщений
+        await q.edit_message_text("Оценка для этого диалога уже недоступна.");  return
+    data, token = m.groups()
 
     if data == "report:open":
-        await q.edit_message_reply_markup(REPORT_MENU);  return
+        await q.edit_message_reply_markup(report_menu(token));  return
     if data == "report:back":
-        await q.edit_message_reply_markup(RATE_MENU);  return
+        await q.edit_message_reply_markup(rate_menu(token));  return
+
+    # Собеседник — тот, с кем был диалог этой кнопки; повторное нажатие не засчитывается
+    peer = await take_rate_token(uid, token)
+    if not peer:
+        await q.edit_message_text("Оценка для этого диалога уже недоступна.");  return
 
     if data.startswith("rate:"):
         val = 1 if data.endswith("+") else -1
-        rec = {"peer": peer_id, "v": val, "ts": int(time.time())}
-        await r.rpush(RATES_KEY.format(uid=uid), json.dumps(rec))
+        await record_feedback(peer, F_UP if val > 0 else F_DOWN, {"from": uid, "v": val, "ts": int(time.time())})
         await q.edit_message_text("Спасибо! Оценка сохранена ✅");  return
 
-    if data.startswith("report:"):
-        reason = data.split(":",1)[1]
-        rec = {"peer": peer_id, "reason": reason, "ts": int(time.time())}
-        await r.rpush(REPORTS_KEY.format(uid=uid), json.dumps(rec))
-        await q.edit_message_text("Спасибо! Жалоба отправлена ⚠️");  return
+    reason = data.split(":", 1)[1]
+    await record_feedback(peer, F_REPORTS, {"from": uid, "reason": reason, "ts": int(time.time())})
+    await q.edit_message_text("Спасибо! Жалоба отправлена ⚠️")
 
 # ===== STOP / NEXT =====
-async def cmd_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def send_dialog_end(context: ContextTypes.DEFAULT_TYPE, chat_id: int, peer: int):
+    # Текст конца диалога и оценку не склеить в одно сообщение: первому нужна
+    # reply-клавиатура меню, второй — инлайн-кнопки, а reply_markup один.
+    # Внутри чата — по порядку, между двумя участниками — параллельно.
+    await send_text(context, chat_id, end_dialog_text(), PRIO_INTERACTIVE, reply_markup=reply_menu_kb())
+    await send_rate_prompt(context, chat_id, peer)
+
+async def cmd_stop(update: Update, context: ContextTypes.DEFAULT_TYPE, reason: str = "stop"):
     uid = update.effective_user.id
-    peer = await get_peer(uid)
     await remove_from_queue(uid)
+    peer = await clear_pair(uid, reason=reason)
+    st = peek_user_state(context, uid)
+    if st:  # /next дальше ищет в том же апдейте
+        st.peer = None
 
     if peer:
-        await clear_pair(uid)
-        try:
-            await context.bot.send_message(peer, end_dialog_text(), reply_markup=reply_menu_kb())
-            await send_rate_prompt(context, peer)
-        except Exception as e:
-            log.error(f"notify peer fail: {e}")
-
-        await update.message.reply_text(end_dialog_text(), reply_markup=reply_menu_kb())
-        await send_rate_prompt(context, uid)
+        await fan_out({
+            peer: send_dialog_end(context, peer, uid),
+            update.effective_chat.id: send_dialog_end(context, update.effective_chat.id, peer),
+        }, "dialog end")
     else:
-        await update.message.reply_text("Поиск остановлен.", reply_markup=reply_menu_kb())
+        await send_text(context, update.effective_chat.id, "Поиск остановлен.", reply_markup=reply_menu_kb())
 
 async def cmd_next(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await cmd_stop(update, context)
+    await cmd_stop(update, context, reason="next")
     await cmd_search(update, context)
 
 # ===== Релей сообщений =====
@@ -359,11 +1404,253 @@ async def relay(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
     if not msg: return
     uid = update.effective_user.id
-    await add_user(uid)
+    add_user(uid)
     peer = await get_peer(uid)
     if not peer: return
-    try: await msg.copy(chat_id=peer)
-    except Exception as e: log.error(f"relay error: {e}")
+    try:
+        await relay_enqueue(uid, peer, msg)
+    except Exception as e:  # Redis недоступен — хотя бы одна попытка напрямую
+        log.error(f"relay enqueue failed: {e}")
+        try: await scheduled(peer, lambda: msg.copy(chat_id=peer), PRIO_INTERACTIVE)
+        except Exception as e: log.error(f"relay error: {e}")
+
+# Хендлер только дописывает сообщение в стрим relay:{n} (n — по получателю),
+# доставляют фоновые задачи. Каждую партицию разбирает один воркер — тот, кто
+# держит аренду relay:{n}. У каждого получателя своя задача доставки: его
+# сообщения идут строго по порядку, а медленный или повторяемый чат не
+# задерживает остальных — разборщик читает стрим дальше, не дожидаясь
+# доставки (в работе не больше RELAY_INFLIGHT_MAX записей на партицию).
+# Сеть/429 — повтор с растущей паузой; Forbidden (получатель заблокировал
+# бота) — пара разрывается, отправитель получает конец диалога. Задача чата
+# удаляет каждую запись из стрима сразу после её доставки, так что после
+# падения воркера новый дошлёт недоставленное, а повторится не больше одного
+# сообщения на чат.
+RELAY_STREAM      = "relay:{part}"
+RELAY_PARTITIONS  = int(os.environ.get("RELAY_PARTITIONS", "16"))
+RELAY_BATCH       = 200
+RELAY_MAX_RETRIES = int(os.environ.get("RELAY_MAX_RETRIES", "5"))
+RELAY_BACKOFF_S   = 0.5
+RELAY_MAXLEN      = 100_000  # на партицию: если доставка стоит, старое вытесняется
+RELAY_INFLIGHT_MAX = 5000
+
+def relay_k(part: int) -> str:
+    return RELAY_STREAM.format(part=part)
+
+async def relay_enqueue(uid: int, peer: int, msg):
+    await r.xadd(relay_k(peer % RELAY_PARTITIONS), {"from": uid, "to": peer, "chat": msg.chat_id, "mid": msg.message_id},
+                 maxlen=RELAY_MAXLEN, approximate=True)
+
+async def relay_backlog() -> int:
+    pipe = r.pipeline(transaction=False)
+    for part in range(RELAY_PARTITIONS):
+        pipe.xlen(relay_k(part))
+    return sum(await pipe.execute())
+
+async def on_peer_blocked(context: ContextTypes.DEFAULT_TYPE, sender: int, peer: int):
+    # Разрываем со стороны заблокировавшего: скрипт снимет пару у sender,
+    # только если она всё ещё с peer
+    if await clear_pair(peer, reason="blocked") == sender:
+        log.info(f"relay: {peer} blocked the bot, pair with {sender} closed")
+        await send_dialog_end(context, sender, peer)
+
+async def deliver_relayed(context: ContextTypes.DEFAULT_TYPE, entries: list):
+    # entries — записи стрима для одного получателя, по порядку
+    for _, f in entries:
+        sender, peer, chat, mid = int(f["from"]), int(f["to"]), int(f["chat"]), int(f["mid"])
+        if await get_peer(sender) != peer:  # диалог уже закончился — в новый не пускаем
+            relay_outcomes.inc("stale");  continue
+        for attempt in range(RELAY_MAX_RETRIES + 1):
+            try:
+                await scheduled(peer, lambda: context.bot.copy_message(peer, chat, mid), PRIO_INTERACTIVE)
+                relay_outcomes.inc("sent");  break
+            except Forbidden:
+                relay_outcomes.inc("blocked")
+                await on_peer_blocked(context, sender, peer);  break
+            except BadRequest as e:  # сообщение удалено и т.п. — повтор не поможет
+                relay_outcomes.inc("dropped")
+                log.warning(f"relay {sender}->{peer} dropped: {e}");  break
+            except Exception as e:
+                if attempt == RELAY_MAX_RETRIES:
+                    relay_outcomes.inc("dropped")
+                    log.error(f"relay {sender}->{peer} failed after {attempt} retries: {e}");  break
+                relay_outcomes.inc("retried")
+                await asyncio.sleep(min(RELAY_BACKOFF_S * 2 ** attempt, 30))
+
+async def relay_drainer(app: Application, part: int):
+    context = app.context_types.context(app)
+    key, last = relay_k(part), "0"
+    chats: dict = {}  # получатель -> deque записей; пока ключ есть, его задача жива
+    tasks: set = set()
+    inflight, room = 0, asyncio.Event()
+
+    async def deliver_chat(to: str):
+        # По одной записи: доставленная сразу удаляется из стрима, так что после
+        # ошибки или потери лидерства повторится только та, что была в полёте
+        nonlocal inflight
+        queue = chats[to]
+        try:
+            while queue:
+                try:
+                    await deliver_relayed(context, [queue[0]])
+                except Exception as e:  # Redis недоступен и т.п. — повторим эту запись
+                    log.warning(f"relay drainer {part}: delivery to {to}: {e}")
+                    await asyncio.sleep(1);  continue
+                eid, _ = queue.popleft()
+                inflight -= 1;  room.set()
+                try:
+                    await r.xdel(key, eid)
+                except Exception as e:
+                    log.warning(f"relay drainer {part}: xdel failed: {e}")
+        finally:
+            chats.pop(to, None)
+
+    try:
+        while True:
+            if inflight >= RELAY_INFLIGHT_MAX:
+                room.clear()
+                await room.wait();  continue
+            try:
+                res = await r.xread({key: last}, count=RELAY_BATCH, block=1000)
+            except Exception as e:
+                log.warning(f"relay drainer {part}: {e}")
+                await asyncio.sleep(1);  continue
+            if not res:
+                continue
+            entries = res[0][1]
+            for eid, f in entries:
+                queue = chats.get(f["to"])
+                if queue is None:
+                    queue = chats[f["to"]] = collections.deque()
+                    task = asyncio.create_task(deliver_chat(f["to"]))
+                    tasks.add(task);  task.add_done_callback(tasks.discard)
+                queue.append((eid, f))
+            inflight += len(entries)
+            last = entries[-1][0]
+    finally:
+        # Недоставленное осталось в стриме — следующий лидер прочтёт с начала
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+# ===== Уборка брошенных поисков и диалогов =====
+# Кто встал в очередь и ушёл или пропал посреди диалога, иначе висел бы там
+# вечно: матчинг тратил бы на него выборки, а живых сводил бы с мёртвыми.
+# Лидер обходит u:* SCAN-ом пачками (один пайплайн на пачку, пауза между
+# пачками) и убирает из очереди прождавших дольше QUEUE_MAX_WAIT_S, а пары,
+# где кто-то неактивен дольше PAIR_IDLE_S, разрывает и сообщает второму.
+# У кого ещё нет отметки активности (старые пары), часы запускаются с обхода.
+REAPER_EVERY_S   = int(os.environ.get("REAPER_EVERY_S", "300"))
+QUEUE_MAX_WAIT_S = int(os.environ.get("QUEUE_MAX_WAIT_S", "1800"))
+PAIR_IDLE_S      = int(os.environ.get("PAIR_IDLE_S", "3600"))
+REAPER_BATCH     = 500
+REAPER_PAUSE_S   = 0.05
+
+async def reap_batch(context: ContextTypes.DEFAULT_TYPE, keys: list, now: int) -> tuple:
+    uids = [int(k.split(":", 1)[1]) for k in keys]
+    pipe = r.pipeline(transaction=False)
+    for uid in uids:
+        pipe.hmget(user_k(uid), F_PEER, F_SEEN, F_QUEUED)
+        pipe.hexists(QUEUE_WHERE, uid)
+    res = await pipe.execute()
+
+    expired, idle, unseen = [], [], []
+    for uid, (peer, seen, qt), queued in zip(uids, res[::2], res[1::2]):
+        if queued and qt and now - int(qt) // 1000 > QUEUE_MAX_WAIT_S:
+            expired.append(uid)
+        if peer and not seen:
+            unseen.append(uid)
+        elif peer and now - int(seen) > PAIR_IDLE_S:
+            idle.append(uid)
+    if unseen:
+        pipe = r.pipeline(transaction=False)
+        for uid in unseen:
+            pipe.hsetnx(user_k(uid), F_SEEN, now)
+        await pipe.execute()
+
+    sends = {}
+    for uid in expired:
+        await remove_from_queue(uid)
+        sends[uid] = send_text(context, uid, f"Никого не нашли за {QUEUE_MAX_WAIT_S // 60} мин — поиск остановлен.\n"
+                               "/search — искать снова", PRIO_BULK, reply_markup=reply_menu_kb())
+    closed = 0
+    for uid in idle:
+        peer = await clear_pair(uid, idle_before=now - PAIR_IDLE_S, reason="idle")
+        if peer:
+            closed += 1
+            sends[peer] = send_text(context, peer, "Собеседник давно не отвечает — диалог завершён.\n"
+                                    "/search — найти нового собеседника", PRIO_BULK, reply_markup=reply_menu_kb())
+    if sends:
+        await fan_out(sends, "reaper notice")
+    return len(expired), closed
+
+async def reaper(app: Application):
+    context = app.context_types.context(app)
+    while True:
+        t0, expired, closed, cursor = time.monotonic(), 0, 0, 0
+        while True:
+            try:
+                cursor, keys = await r.scan(cursor, match=user_k("") + "*", count=REAPER_BATCH)
+                if keys:
+                    e, c = await reap_batch(context, keys, int(time.time()))
+                    expired += e;  closed += c
+            except Exception as e:
+                log.warning(f"reaper: {e}")
+            if cursor == 0:
+                break
+            await asyncio.sleep(REAPER_PAUSE_S)
+        reaped.inc("queue", by=expired)
+        reaped.inc("pair", by=closed)
+        log.info(f"reaper: pass {time.monotonic() - t0:.1f}s, expired searches={expired}, idle pairs closed={closed}")
+        await asyncio.sleep(REAPER_EVERY_S)
+
+# ===== Картинки: file_id вместо URL =====
+# Каждая картинка загружается в Telegram один раз (URL или файл из репозитория),
+# полученный file_id хранится в Redis и в памяти и дальше шлётся вместо
+# источника — Telegram не скачивает URL заново. Ключ — сам источник, так что
+# смена URL в env приводит к новой загрузке. Если Telegram перестал принимать
+# file_id, картинка загружается заново.
+MEDIA_ASSETS = {
+    "diamond": DIAMOND_IMG_URL or (BANNER_IMG if os.path.exists(BANNER_IMG) else ""),
+    "halo": HALO_IMG_URL,
+}
+_media_ids: dict = {}  # источник -> file_id
+_media_locks: dict = {}
+
+def has_asset(name: str) -> bool:
+    return bool(MEDIA_ASSETS.get(name))
+
+async def _upload_asset(bot, chat_id: int, source: str, **kwargs):
+    if source.startswith(("http://", "https://")):
+        msg = await bot.send_photo(chat_id, source, **kwargs)
+    else:
+        with open(source, "rb") as f:
+            msg = await bot.send_photo(chat_id, f, **kwargs)
+    _media_ids[source] = msg.photo[-1].file_id
+    try:
+        await r.hset(MEDIA_KEY, source, _media_ids[source])
+    except Exception as e:
+        log.warning(f"media: failed to store file_id: {e}")
+    return msg
+
+async def send_asset(bot, chat_id: int, name: str, **kwargs):
+    source = MEDIA_ASSETS[name]
+    file_id = _media_ids.get(source)
+    if file_id is None:
+        lock = _media_locks.setdefault(source, asyncio.Lock())
+        async with lock:  # первую загрузку делает один, остальные ждут её file_id
+            file_id = _media_ids.get(source) or await r.hget(MEDIA_KEY, source)
+            if file_id is None:
+                return await _upload_asset(bot, chat_id, source, **kwargs)
+            _media_ids[source] = file_id
+    try:
+        return await bot.send_photo(chat_id, file_id, **kwargs)
+    except BadRequest as e:
+        if "file" not in str(e).lower():
+            raise
+        log.warning(f"media: file_id for {name} rejected ({e}), re-uploading")
+        if _media_ids.get(source) == file_id:
+            _media_ids.pop(source, None)
+        return await _upload_asset(bot, chat_id, source, **kwargs)
 
 # ===== VIP / PREMIUM UI и оплата =====
 def vip_menu_inline() -> InlineKeyboardMarkup:
@@ -387,7 +1674,7 @@ def fmt_until(ts: int) -> str:
     return d.strftime("%d.%m.%Y")
 
 async def send_vip_page(chat_id: int, uid: int, context: ContextTypes.DEFAULT_TYPE):
-    until = await get_vip_until(uid)
+    until = (await load_user_state(context, uid)).vip_until
     active = until > int(time.time())
     left = max(0, until - int(time.time()))
     days = left // 86400; hours = (left % 86400) // 3600
@@ -403,8 +1690,8 @@ async def send_vip_page(chat_id: int, uid: int, context: ContextTypes.DEFAULT_TY
         f"Стоимость VIP-статуса на 12 месяцев — {VIP_PLANS['12m']['amount']} Telegram Stars / 6999₽ / $69\n"
         "Переходите к оплате по кнопке ниже:"
     )
-    if DIAMOND_IMG_URL:
-        await context.bot.send_photo(chat_id, DIAMOND_IMG_URL, caption=caption, reply_markup=vip_menu_inline())
+    if has_asset("diamond"):
+        await send_asset(context.bot, chat_id, "diamond", caption=caption, reply_markup=vip_menu_inline())
     else:
         await context.bot.send_message(chat_id, caption, reply_markup=vip_menu_inline())
 
@@ -458,7 +1745,7 @@ def premium_text_no(active: bool) -> str:
 
 async def cmd_pay(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    prem_until = await get_premium_until(uid)
+    prem_until = (await load_user_state(context, uid)).premium_until
     active = prem_until > int(time.time())
     if not active:
         text = premium_text_no(False)
@@ -495,30 +1782,32 @@ async def precheckout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def successful_payment_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     sp = update.message.successful_payment
     payload = sp.invoice_payload if sp else ""
+    charge_id = sp.telegram_payment_charge_id if sp else ""
     uid = update.effective_user.id
 
     if payload.startswith("vip_"):
         plan_key = payload.split("_",1)[1]
         months = VIP_PLANS.get(plan_key, VIP_PLANS["12m"])["months"]
-        await extend_vip(uid, months)
-        text = f"Спасибо за приобретение VIP-статуса! Активен до {fmt_until(await get_vip_until(uid))}."
+        until = await extend_vip(uid, months, charge_id, event={"x": f"vip:{plan_key}", "a": sp.total_amount})
+        text = f"Спасибо за приобретение VIP-статуса! Активен до {fmt_until(until)}."
     elif payload.startswith("premium_"):
         plan_key = payload.split("_",1)[1]
         plan = PREMIUM_PLANS.get(plan_key, PREMIUM_PLANS["1m"])
         months = plan.get("months", 0)
         days = plan.get("days", 0)
-        await extend_premium(uid, months=months, days=days)
-        text = f"Спасибо! Премиум активен до {fmt_until(await get_premium_until(uid))}. Теперь доступен поиск по полу."
+        until = await extend_premium(uid, months=months, days=days, charge_id=charge_id,
+                                     event={"x": f"premium:{plan_key}", "a": sp.total_amount})
+        text = f"Спасибо! Премиум активен до {fmt_until(until)}. Теперь доступен поиск по полу."
     else:
         text = "Оплата получена."
 
-    if HALO_IMG_URL: await update.message.reply_photo(HALO_IMG_URL, caption=text, reply_markup=reply_menu_kb())
+    if has_asset("halo"): await send_asset(context.bot, update.effective_chat.id, "halo", caption=text, reply_markup=reply_menu_kb())
     else: await update.message.reply_text(text, reply_markup=reply_menu_kb())
 
 # ===== /link — отправить ссылку на себя собеседнику =====
 async def cmd_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    peer = await get_peer(uid)
+    peer = (await load_user_state(context, uid)).peer
     if not peer:
         await update.message.reply_text("Вы не в диалоге. Сначала начните чат: /search")
         return
@@ -530,7 +1819,7 @@ async def cmd_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Собеседнику — кликабельное слово «Ссылка»
     peer_text = f"👋 Собеседник отправил свой профиль: [Ссылка]({url})"
-    await context.bot.send_message(peer, peer_text, parse_mode="Markdown")
+    await send_text(context, peer, peer_text, PRIO_INTERACTIVE, parse_mode="Markdown")
     # Отправителю — подтверждение
     await update.message.reply_text("Ссылка на ваш аккаунт отправлена собеседнику.")
 
@@ -551,10 +1840,10 @@ async def on_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    rates = await r.llen(RATES_KEY.format(uid=uid))
-    reports = await r.llen(REPORTS_KEY.format(uid=uid))
-    total = await users_count()
-    await update.message.reply_text(f"📊 Статистика: ваши оценки — {rates}, жалобы — {reports}.\n👥 Всего пользователей: {total}")
+    up, down, reports = await get_feedback_counts(uid)
+    await update.message.reply_text(
+        f"📊 Статистика: ваши оценки — 👍 {up} / 👎 {down}, жалобы — {reports}.\n"
+        f"🟢 Сейчас онлайн: {online_count()}\n👥 Всего пользователей: ~{users_count()}")
 
 async def cmd_myid(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(f"🆔 ID вашего аккаунта: <code>{update.effective_user.id}</code>", parse_mode="HTML")
@@ -580,32 +1869,347 @@ async def cmd_paysupport(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ===== Reply-кнопки обработчики (нужны ДО main) =====
 async def show_premium_gate(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
     text = "Поиск по полу доступен только Премиум/💎VIP пользователям.\n\nОформить — /pay\nПодробности VIP — /vip"
-    if DIAMOND_IMG_URL: await context.bot.send_photo(chat_id, DIAMOND_IMG_URL, caption=text)
+    if has_asset("diamond"): await send_asset(context.bot, chat_id, "diamond", caption=text)
     else: await context.bot.send_message(chat_id, text)
 
 async def on_btn_any(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await do_search(update.effective_chat.id, update.effective_user.id, context)
 
 async def on_btn_f(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await has_gender_rights(update.effective_user.id):
+    if not (await load_user_state(context, update.effective_user.id)).has_gender_rights:
         await show_premium_gate(update.effective_chat.id, context);  return
-    await do_search(update.effective_chat.id, update.effective_user.id, context)
+    await do_search(update.effective_chat.id, update.effective_user.id, context, want="F")
 
 async def on_btn_m(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await has_gender_rights(update.effective_user.id):
+    if not (await load_user_state(context, update.effective_user.id)).has_gender_rights:
         await show_premium_gate(update.effective_chat.id, context);  return
-    await do_search(update.effective_chat.id, update.effective_user.id, context)
+    await do_search(update.effective_chat.id, update.effective_user.id, context, want="M")
+
+# ===== Redis: подключение и скрипты =====
+async def connect_redis(url: str, client: Optional[redis.Redis] = None):
+    # client — уже созданный клиент (бенчмарк подставляет in-process Redis)
+    global r, match_script, dequeue_script, clear_pair_script, feedback_script, migrate_script
+    global commit_pairs_script, extend_script, leader_script, rate_token_script
+    r = client or await redis.from_url(url, decode_responses=True)
+    instrument_redis(r)
+    await r.ping()
+    match_script = r.register_script(MATCH_LUA)
+    dequeue_script = r.register_script(DEQUEUE_LUA)
+    clear_pair_script = r.register_script(CLEAR_PAIR_LUA)
+    feedback_script = r.register_script(FEEDBACK_LUA)
+    commit_pairs_script = r.register_script(COMMIT_PAIRS_LUA)
+    extend_script = r.register_script(EXTEND_LUA)
+    leader_script = r.register_script(LEADER_LUA)
+    migrate_script = r.register_script(MIGRATE_LUA)
+    rate_token_script = r.register_script(RATE_TOKEN_LUA)
+
+# ===== Несколько воркеров =====
+# Состояние пар, очереди и платежей меняется только атомарными скриптами, а
+# локальные кэши сбрасываются через pub/sub — поэтому воркеров может быть
+# сколько угодно. Фоновые задачи-синглтоны (пакетный матчинг и т.п.) крутит
+# только лидер: он держит аренду leader:{job} и продлевает её; если продлить
+# не удалось (завис, потерял Redis), задача останавливается и аренду берёт
+# другой воркер.
+#
+# Порядок апдейтов одного пользователя гарантирован только внутри процесса
+# (полосы OrderedApplication). С WEBHOOK_WORKERS > 1 соседние апдейты могут
+# попасть в разные воркеры и обработаться в другом порядке — например,
+# сообщение, отправленное сразу после /stop, может уйти собеседнику или
+# потеряться. Пары и очередь от этого не ломаются (скрипты атомарны).
+# Если порядок важнее пропускной способности — WEBHOOK_WORKERS=1.
+WORKER_ID     = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+LEADER_TTL_MS = int(os.environ.get("LEADER_TTL_MS", "10000"))
+WORKER_HEARTBEAT_S = 5  # живым считается воркер с heartbeat за последние 3 периода
+
+LEADER_LUA = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+if ARGV[2] == 'renew' then return redis.call('PEXPIRE', KEYS[1], ARGV[3]) end
+return redis.call('DEL', KEYS[1])
+"""
+leader_script = None  # регистрируется в connect_redis
+
+async def run_as_leader(job: str, factory):
+    key = LEADER_KEY.format(job=job)
+    while True:
+        try:
+            if await r.set(key, WORKER_ID, nx=True, px=LEADER_TTL_MS):
+                log.info(f"{job}: leader is {WORKER_ID}")
+                task = asyncio.create_task(factory())
+                try:
+                    while not task.done():
+                        await asyncio.sleep(LEADER_TTL_MS / 3000)
+                        if not await leader_script(keys=[key], args=[WORKER_ID, "renew", LEADER_TTL_MS]):
+                            log.warning(f"{job}: leadership lost by {WORKER_ID}");  break
+                finally:
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    await asyncio.shield(leader_script(keys=[key], args=[WORKER_ID, "release", 0]))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning(f"{job}: leader loop: {e}")
+        await asyncio.sleep(LEADER_TTL_MS / 3000)
+
+async def send_rate_share(conn, worker_id: str) -> float:
+    # Отметка отправителя в WORKERS_KEY; ответ — его доля TG_GLOBAL_RATE.
+    # Отмечаются воркеры бота и tools/broadcast — лимит у них один.
+    now = now_ms()
+    pipe = conn.pipeline(transaction=False)
+    pipe.zadd(WORKERS_KEY, {worker_id: now})
+    pipe.zremrangebyscore(WORKERS_KEY, "-inf", now - 3 * WORKER_HEARTBEAT_S * 1000)
+    pipe.zcard(WORKERS_KEY)
+    return TG_GLOBAL_RATE / max((await pipe.execute())[-1], 1)
+
+async def worker_heartbeat():
+    # Отмечаемся в WORKERS_KEY и делим глобальный лимит отправки на живых.
+    # Пока Redis недоступен, доля остаётся прежней.
+    try:
+        while True:
+            try:
+                share = await send_rate_share(r, WORKER_ID)
+                if outbox:
+                    outbox.set_global_rate(share)
+            except Exception as e:
+                log.warning(f"worker heartbeat: {e}")
+            await asyncio.sleep(WORKER_HEARTBEAT_S)
+    finally:
+        try:
+            await asyncio.shield(r.zrem(WORKERS_KEY, WORKER_ID))
+        except Exception:
+            pass
+
+# ===== Метрики (Prometheus) =====
+# Свой маленький реестр без зависимостей: серии — списки в памяти процесса,
+# наблюдение — bisect и пара сложений, так что на релее это незаметно.
+# Отдаются в текстовом формате Prometheus на http://METRICS_LISTEN:METRICS_PORT/metrics;
+# METRICS_PORT=0 — эндпоинт выключен. Webhook-воркеры слушают METRICS_PORT + номер.
+METRICS_PORT    = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_LISTEN  = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+WAIT_BUCKETS    = (.5, 1, 2, 5, 10, 15, 30, 60, 120, 300, 600)
+_metrics: list = []
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{v}"' for n, v in zip(names, values)] + ([extra] if extra else [])
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self.series: dict = {}
+        _metrics.append(self)
+
+    def inc(self, *values, by: float = 1):
+        self.series[values] = self.series.get(values, 0) + by
+
+    def render(self) -> list:
+        return [f"{self.name}{_labels(self.labels, v)} {n}" for v, n in self.series.items()]
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.series: dict = {}  # значения меток -> [по корзинам..., +Inf, sum]
+        _metrics.append(self)
+
+    def observe(self, value: float, *values):
+        s = self.series.get(values)
+        if s is None:
+            s = self.series[values] = [0] * (len(self.buckets) + 1) + [0.0]
+        s[bisect.bisect_left(self.buckets, value)] += 1
+        s[-1] += value
+
+    def render(self) -> list:
+        out = []
+        for v, s in self.series.items():
+            acc = 0
+            for le, n in zip(self.buckets + ("+Inf",), s):
+                acc += n
+                le = _labels(self.labels, v, f'le="{le}"')
+                out.append(f"{self.name}_bucket{le} {acc}")
+            out.append(f"{self.name}_sum{_labels(self.labels, v)} {s[-1]}")
+            out.append(f"{self.name}_count{_labels(self.labels, v)} {acc}")
+        return out
+
+class Gauge:
+    # Значение снимается в момент запроса /metrics: fn получает снимок из Redis
+    def __init__(self, name: str, help: str, fn):
+        self.name, self.help, self.fn = name, help, fn
+        self.value = 0
+        _metrics.append(self)
+
+    def render(self) -> list:
+        return [f"{self.name} {self.value}"]
+
+async def _redis_gauges():
+    pipe = r.pipeline(transaction=False)
+    pipe.hlen(QUEUE_WHERE)
+    pipe.get(PAIRS_COUNT)
+    waiting, pairs = await pipe.execute()
+    return {"queue": waiting, "pairs": int(pairs or 0), "relay": await relay_backlog()}
+
+handler_latency = Histogram("anonchat_handler_seconds", "Handler latency", ("handler",))
+handler_errors  = Counter("anonchat_handler_errors_total", "Handler exceptions", ("handler",))
+redis_latency   = Histogram("anonchat_redis_seconds", "Redis round trip latency", ("cmd",))
+bot_api_latency = Histogram("anonchat_bot_api_seconds", "Bot API call latency", ("method",))
+bot_api_codes   = Counter("anonchat_bot_api_responses_total", "Bot API responses", ("method", "code"))
+reaped          = Counter("anonchat_reaped_total", "Abandoned searches and pairs removed", ("kind",))
+relay_outcomes  = Counter("anonchat_relay_total", "Relayed messages by outcome", ("outcome",))
+events_dropped  = Counter("anonchat_events_dropped_total", "Analytics events lost to a full buffer")
+flood_dropped   = Counter("anonchat_flood_dropped_total", "Updates dropped before handlers", ("kind",))
+match_wait      = Histogram("anonchat_match_wait_seconds", "Time in queue before a match", (), WAIT_BUCKETS)
+Gauge("anonchat_queue_waiting", "Users waiting in the queue", lambda g: g["queue"])
+Gauge("anonchat_pairs_active", "Active pairs", lambda g: g["pairs"])
+Gauge("anonchat_relay_backlog", "Relayed messages not yet delivered", lambda g: g["relay"])
+Gauge("anonchat_send_queue", "Outgoing messages waiting in the scheduler", lambda g: outbox.queue_depth() if outbox else 0)
+Gauge("anonchat_online", "Users active recently", lambda g: counters["online"])
+Gauge("anonchat_pair_cache_size", "Pair cache entries", lambda g: len(_pair_cache))
+Gauge("anonchat_entitlement_cache_size", "Entitlement cache entries", lambda g: len(_ent_cache))
+
+def timed_handler(callback):
+    name = callback.__name__
+    async def wrapper(update, context):
+        t0 = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            handler_errors.inc(name);  raise
+        finally:
+            handler_latency.observe(time.perf_counter() - t0, name)
+    wrapper.__name__ = name
+    return wrapper
+
+def instrument_redis(client: redis.Redis):
+    # Каждый вызов execute_command (и скрипты тоже) и каждый execute пайплайна —
+    # один round trip
+    command = client.execute_command
+    async def execute_command(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return await command(*args, **kwargs)
+        finally:
+            redis_latency.observe(time.perf_counter() - t0, args[0])
+    client.execute_command = execute_command
+
+    pipeline = client.pipeline
+    def metered_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+        async def timed_execute(*a, **kw):
+            t0 = time.perf_counter()
+            try:
+                return await execute(*a, **kw)
+            finally:
+                redis_latency.observe(time.perf_counter() - t0, "PIPELINE")
+        pipe.execute = timed_execute
+        return pipe
+    client.pipeline = metered_pipeline
+
+class MeteredRequest(HTTPXRequest):
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api = url.rsplit("/", 1)[-1]
+        t0 = time.perf_counter()
+        code = "error"
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            return code, payload
+        finally:
+            bot_api_latency.observe(time.perf_counter() - t0, api)
+            bot_api_codes.inc(api, code)
+
+async def render_metrics() -> str:
+    try:
+        g = await _redis_gauges()
+    except Exception as e:
+        log.warning(f"metrics: redis gauges failed: {e}")
+        g = None
+    lines = []
+    for m in _metrics:
+        kind = type(m).__name__.lower()
+        if isinstance(m, Gauge):
+            try:
+                m.value = m.fn(g or {})
+            except KeyError:  # Redis не ответил — эти gauge пропускаем
+                continue
+        lines.append(f"# HELP {m.name} {m.help}")
+        lines.append(f"# TYPE {m.name} {kind}")
+        lines += m.render()
+    return "\n".join(lines) + "\n"
+
+async def handle_metrics_conn(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1")
+        path = head.split(" ", 2)[1] if head.count(" ") >= 2 else ""
+        if path.split("?", 1)[0] == "/metrics":
+            body, status = (await render_metrics()).encode(), "200 OK"
+        else:
+            body, status = b"", "404 Not Found"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def serve_metrics():
+    server = await asyncio.start_server(handle_metrics_conn, METRICS_LISTEN, METRICS_PORT)
+    log.info(f"metrics on http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+    async with server:
+        await server.serve_forever()
+
+# ===== Фоновые задачи =====
+_bg_tasks: list = []
+STATS_EVERY = int(os.environ.get("STATS_EVERY", "300"))  # сек
+
+async def log_stats():
+    while True:
+        await asyncio.sleep(STATS_EVERY)
+        log.info(
+            f"pair cache: hit_rate={pair_cache_hit_rate():.3f} "
+            f"hit={pair_cache_stats['hit']} miss={pair_cache_stats['miss']} "
+            f"inval={pair_cache_stats['inval']} size={len(_pair_cache)} seen_users={len(_seen_users)}"
+        )
+        log.info(f"entitlement cache: hit={ent_cache_stats['hit']} miss={ent_cache_stats['miss']} size={len(_ent_cache)}")
+        if outbox:
+            log.info(
+                f"send scheduler: queue={outbox.queue_depth()} sent={outbox.stats['sent']} "
+                f"failed={outbox.stats['failed']} retry_after={outbox.stats['retry_after']} "
+                f"global_pauses={outbox.stats['global_pauses']} "
+                f"wait_avg={outbox.avg_wait():.3f}s wait_max={outbox.stats['wait_max']:.3f}s"
+            )
 
 # ===== post_init / меню команд =====
 async def post_init(app: Application):
-    await app.bot.delete_webhook(drop_pending_updates=True)
-    if not REDIS_URL:
-        raise RuntimeError("REDIS_URL is not set")
-
-    global r
-    r = await redis.from_url(REDIS_URL, decode_responses=True)
-    await r.ping()
-    log.info("Redis connected OK")
+    if BOT_MODE == "webhook":
+        await app.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET,
+                                  allowed_updates=Update.ALL_TYPES)
+    else:
+        await app.bot.delete_webhook(drop_pending_updates=True)
+    if r is None:  # бенчмарк подключает Redis сам
+        if not REDIS_URL:
+            raise RuntimeError("REDIS_URL is not set")
+        await connect_redis(REDIS_URL)
+    log.info(f"Redis connected OK (worker {WORKER_ID})")
+
+    global outbox
+    # До первого heartbeat — доля по числу воркеров этого запуска
+    outbox = SendScheduler(TG_GLOBAL_RATE / max(WEBHOOK_WORKERS if BOT_MODE == "webhook" else 1, 1),
+                           TG_CHAT_RATE, TG_CHAT_BURST, SEND_CONCURRENCY)
+    _bg_tasks.append(asyncio.create_task(outbox.run()))
+    _bg_tasks.append(asyncio.create_task(worker_heartbeat()))
+
+    await refresh_counters()
+    _bg_tasks.append(asyncio.create_task(counters_loop()))
+    _bg_tasks.append(asyncio.create_task(invalidation_listener()))
+    _bg_tasks.append(asyncio.create_task(log_stats()))
+    if METRICS_PORT:
+        _bg_tasks.append(asyncio.create_task(serve_metrics()))
+    if MATCH_SCHEDULER == "batch":
+        _bg_tasks.append(asyncio.create_task(run_as_leader("batch_match", lambda: batch_matcher(app))))
+    _bg_tasks.append(asyncio.create_task(run_as_leader("reaper", lambda: reaper(app))))
+    for part in range(RELAY_PARTITIONS):
+        _bg_tasks.append(asyncio.create_task(
+            run_as_leader(f"relay:{part}", lambda part=part: relay_drainer(app, part))))
 
     try:
         commands = [
@@ -627,11 +2231,218 @@ async def post_init(app: Application):
     except Exception as e:
         log.warning(f"set_my_commands failed: {e}")
 
+async def post_shutdown(app: Application):
+    for t in _bg_tasks:
+        t.cancel()
+    await asyncio.gather(*_bg_tasks, return_exceptions=True)
+    _bg_tasks.clear()
+    await flush_activity()
+
+# ===== Защита от флуда =====
+# Входящие считаются ДО хендлеров, отдельно «сообщения» (релей и прочие
+# команды) и «поиски» (/search, /next, /stop, кнопки поиска — каждый стоит
+# нескольких скриптов Redis). Окно скользящее, приближённое двумя
+# фиксированными половинами (текущее окно + доля прошлого): O(1) памяти на
+# пользователя и никаких обращений к Redis на апдейт. Превысил лимит — пауза
+# FLOOD_COOLDOWN_S, всё от него выбрасывается, уведомление — одно на паузу.
+# Несколько воркеров: локальные счётчики уходят в Redis тем же пайплайном,
+# что и активность (HINCRBY в flood:{окно} возвращает сумму по всем), и если
+# сумма превысила лимит — пауза рассылается всем через FLOOD_CHANNEL.
+# Повторный /next, пока предыдущий ещё ждёт в полосе пользователя, просто
+# склеивается с ним (см. OrderedApplication).
+FLOOD_WINDOW_S   = float(os.environ.get("FLOOD_WINDOW_S", "10"))
+FLOOD_LIMITS     = {"msg": int(os.environ.get("FLOOD_MSG_LIMIT", "20")),      # за окно
+                    "search": int(os.environ.get("FLOOD_SEARCH_LIMIT", "6"))}
+FLOOD_COOLDOWN_S = float(os.environ.get("FLOOD_COOLDOWN_S", "15"))
+FLOOD_USERS_MAX  = 200_000
+SEARCH_COMMANDS  = ("/search", "/next", "/stop")
+_flood_windows: dict = {}  # (kind, uid) -> SlidingWindow
+_flood_mutes: dict = {}    # (kind, uid) -> пауза до (time.time())
+_flood_pending: dict = {}  # (kind, uid) -> апдейтов с прошлого сброса в Redis
+_flood_noticed: dict = {}  # uid -> конец паузы, о которой он уже предупреждён
+
+class SlidingWindow:
+    __slots__ = ("start", "cur", "prev")
+
+    def __init__(self):
+        self.start, self.cur, self.prev = 0.0, 0, 0
+
+    def hit(self, now: float, window: float) -> float:
+        # Засчитывает апдейт и возвращает оценку их числа за последние window секунд
+        start = now - now % window
+        if start != self.start:
+            self.prev = self.cur if start - self.start == window else 0
+            self.start, self.cur = start, 0
+        self.cur += 1
+        return self.prev * (1 - (now - start) / window) + self.cur
+
+def flood_kind(update: Update) -> Optional[str]:
+    # Платежи, pre-checkout и инлайн-кнопки не ограничиваются
+    msg = update.message
+    if msg is None or msg.successful_payment:
+        return None
+    text = msg.text or ""
+    if text in (BTN_ANY, BTN_F, BTN_M) or text.split("@")[0].split(" ")[0] in SEARCH_COMMANDS:
+        return "search"
+    return "msg"
+
+def muted_until(kind: str, uid: int, now: float) -> float:
+    until = _flood_mutes.get((kind, uid))
+    if until and until <= now:
+        del _flood_mutes[(kind, uid)]
+        return 0.0
+    return until or 0.0
+
+def mute(kind: str, uid: int, until: float):
+    if len(_flood_mutes) >= FLOOD_USERS_MAX:
+        _flood_mutes.clear()
+    _flood_mutes[(kind, uid)] = max(until, _flood_mutes.get((kind, uid), 0.0))
+
+def apply_mute(data: str):
+    kind, uid, until = data.split(":")
+    mute(kind, int(uid), float(until))
+
+def flood_allow(kind: str, uid: int) -> bool:
+    now = time.time()
+    if muted_until(kind, uid, now):
+        return False
+    w = _flood_windows.get((kind, uid))
+    if w is None:
+        if len(_flood_windows) >= FLOOD_USERS_MAX:
+            _flood_windows.clear()
+        w = _flood_windows[(kind, uid)] = SlidingWindow()
+    if w.hit(now, FLOOD_WINDOW_S) > FLOOD_LIMITS[kind]:
+        mute(kind, uid, now + FLOOD_COOLDOWN_S)
+        return False
+    if len(_flood_pending) < FLOOD_USERS_MAX:
+        _flood_pending[(kind, uid)] = _flood_pending.get((kind, uid), 0) + 1
+    return True
+
+def flood_report(pipe, flood: dict, now: int) -> str:
+    # Дописывает в пайплайн сброса HINCRBY по каждому (kind, uid) и EXPIRE
+    key = FLOOD_KEY.format(bucket=int(now // FLOOD_WINDOW_S))
+    for (kind, uid), n in flood.items():
+        pipe.hincrby(key, f"{kind}:{uid}", n)
+    if flood:
+        pipe.expire(key, int(FLOOD_WINDOW_S * 2) + 1)
+    return key
+
+async def flood_check(flood: dict, totals: list, key: str):
+    # totals — ответы HINCRBY: сколько апдейтов за окно насчитали все воркеры
+    until = time.time() + FLOOD_COOLDOWN_S
+    over = [f"{kind}:{uid}:{until}" for (kind, uid), total in zip(flood, totals) if total > FLOOD_LIMITS[kind]]
+    if not over:
+        return
+    try:
+        pipe = r.pipeline(transaction=False)
+        for data in over:
+            apply_mute(data)
+            pipe.publish(FLOOD_CHANNEL, data)
+        await pipe.execute()
+    except Exception as e:
+        log.warning(f"flood mute publish failed: {e}")
+
+async def notify_muted(bot, uid: int, kind: str):
+    # Одно уведомление на паузу, даже если апдейты раскиданы по воркерам: в
+    # Redis идём только с первым выброшенным апдейтом паузы, дальше — локально
+    now = time.time()
+    until = muted_until(kind, uid, now)
+    if until <= now or _flood_noticed.get(uid, 0.0) >= until:
+        return
+    if len(_flood_noticed) >= FLOOD_USERS_MAX:
+        _flood_noticed.clear()
+    _flood_noticed[uid] = until
+    left = until - now
+    try:
+        if not await r.set(FLOOD_NOTICE.format(uid=uid), 1, nx=True, px=int(left * 1000)):
+            return
+        await scheduled(uid, lambda: bot.send_message(
+            uid, f"⏳ Слишком часто. Подождите {int(left) + 1} сек — до тех пор сообщения не доставляются."))
+    except Exception as e:
+        log.warning(f"flood notice → {uid} failed: {e}")
+
 # ===== Application =====
-def main():
-    if not TOKEN:
-        raise RuntimeError("TELEGRAM_TOKEN is not set")
-    app = Application.builder().token(TOKEN).post_init(post_init).build()
+# Апдейты обрабатываются параллельно (до UPDATE_CONCURRENCY одновременно),
+# но у каждого пользователя своя «полоса» — очередь с одним обработчиком:
+# его апдейты идут строго по одному и в порядке получения, так что сообщения
+# и /stop//next не перемешиваются. PTB берёт свой слот конкурентности ДО
+# process_update, поэтому process_update только ставит апдейт в полосу и
+# сразу возвращается: ждущие в полосе апдейты не держат ни слот PTB, ни
+# слот обработки — слот (self._slots) берёт обработчик полосы на время
+# одного апдейта. Несколько пользователей с пачками сообщений больше не
+# занимают все слоты. UPDATE_CONCURRENCY=0 — прежний последовательный режим.
+# Полосы — в памяти процесса: между webhook-воркерами порядок апдейтов
+# пользователя не гарантирован (см. «Несколько воркеров»).
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "64"))
+
+class OrderedApplication(Application):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._lanes: dict = {}  # uid -> [deque (апдейт, команда, future), ждущие команды поиска, задача]
+        self._slots = asyncio.Semaphore(max(UPDATE_CONCURRENCY, 1))
+
+    async def process_update(self, update: object) -> None:
+        await self.submit(update)
+
+    async def submit(self, update: object) -> Optional[asyncio.Future]:
+        # -> future, который завершится после обработки апдейта; None — апдейт выброшен
+        done = asyncio.get_running_loop().create_future()
+        user = update.effective_user if isinstance(update, Update) else None
+        kind = flood_kind(update) if user else None
+        # Такая же команда поиска уже ждёт в полосе — она и выполнится
+        cmd = update.message.text if kind == "search" else None
+        lane = self._lanes.get(user.id) if user else None
+        if cmd and lane and cmd in lane[1]:
+            flood_dropped.inc("coalesced");  return None
+        if kind and not flood_allow(kind, user.id):
+            flood_dropped.inc(kind)
+            await notify_muted(self.bot, user.id, kind);  return None
+        if user is None or not UPDATE_CONCURRENCY:
+            async with self._slots:
+                await self._process(update, done)
+            return done
+        if lane is None:
+            lane = self._lanes[user.id] = [collections.deque(), set(), None]
+            lane[2] = asyncio.create_task(self._run_lane(user.id, lane))
+        lane[0].append((update, cmd, done))
+        if cmd:
+            lane[1].add(cmd)
+        return done
+
+    async def _process(self, update: object, done: asyncio.Future):
+        try:
+            await super().process_update(update)
+        except Exception as e:  # ошибки хендлеров PTB разбирает сам — это что-то ниже
+            log.error(f"update processing failed: {e}")
+        finally:
+            if not done.done():
+                done.set_result(None)
+
+    async def _run_lane(self, uid: int, lane: list):
+        queue, pending, _ = lane
+        try:
+            while queue:
+                update, cmd, done = queue.popleft()
+                pending.discard(cmd)
+                async with self._slots:
+                    await self._process(update, done)
+        finally:
+            self._lanes.pop(uid, None)
+
+    async def stop(self) -> None:
+        # PTB дожидается только своей очереди — полосы дорабатываем сами
+        await super().stop()
+        await asyncio.gather(*(lane[2] for lane in list(self._lanes.values())), return_exceptions=True)
+
+def build_app() -> Application:
+    app = (
+        Application.builder().token(TOKEN).base_url(BOT_API_URL)
+        .application_class(OrderedApplication)
+        .request(MeteredRequest(connection_pool_size=256))
+        .concurrent_updates(UPDATE_CONCURRENCY)
+        .post_init(post_init).post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Команды
     app.add_handler(CommandHandler("start", start))
@@ -661,7 +2472,7 @@ def main():
     app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_handler))
 
     # Оценки/жалобы
-    app.add_handler(CallbackQueryHandler(on_rate_or_report, pattern=r"^(rate:\+|rate:-|report:.*)$"))
+    app.add_handler(CallbackQueryHandler(on_rate_or_report, pattern=r"^(rate|report):"))
 
     # Кнопки Reply (текстовые)
     app.add_handler(MessageHandler(filters.Regex(f"^{re.escape(BTN_ANY)}$"), on_btn_any))
@@ -677,8 +2488,105 @@ def main():
     )
     app.add_handler(MessageHandler(~ignore, relay))
 
-    log.info("Bot starting (run_polling)…")
-    app.run_polling()
+    for group in app.handlers.values():
+        for h in group:
+            h.callback = timed_handler(h.callback)
+    return app
+
+# ===== Webhook =====
+# Встроенный HTTP-сервер: проверяет секрет, сразу отвечает 200 и только потом
+# кладёт апдейт в очередь приложения. Без секрета вебхук не запускается: иначе
+# любой, кто знает URL, мог бы прислать поддельный апдейт — например, оплату. Несколько процессов слушают один порт
+# через SO_REUSEPORT — ядро само раскидывает соединения между ними.
+WEBHOOK_MAX_BODY = 1 << 20
+
+async def handle_webhook_conn(app: Application, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while True:  # keep-alive
+            head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+            method, path, _ = head[0].split(" ", 2)
+            headers = {}
+            for line in head[1:]:
+                if ":" in line:
+                    k, v = line.split(":", 1);  headers[k.strip().lower()] = v.strip()
+            length = int(headers.get("content-length") or 0)
+            if length > WEBHOOK_MAX_BODY:
+                status = "413 Payload Too Large"
+            elif method != "POST" or path != WEBHOOK_PATH:
+                status = "404 Not Found"
+            elif not WEBHOOK_SECRET or not hmac.compare_digest(
+                    headers.get("x-telegram-bot-api-secret-token", ""), WEBHOOK_SECRET):
+                status = "403 Forbidden"
+            else:
+                status = "200 OK"
+            body = await reader.readexactly(length) if length <= WEBHOOK_MAX_BODY else b""
+            close = status.startswith("413") or headers.get("connection", "").lower() == "close"
+            resp = f"HTTP/1.1 {status}\r\nContent-Length: 0\r\n" + ("Connection: close\r\n" if close else "") + "\r\n"
+            writer.write(resp.encode())
+            await writer.drain()
+
+            if status == "200 OK":
+                try:
+                    await app.update_queue.put(Update.de_json(json.loads(body), app.bot))
+                except Exception as e:
+                    log.warning(f"bad webhook update: {e}")
+            if close:
+                break
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+async def serve_webhook(app: Application):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with app:
+        await app.post_init(app)
+        await app.start()
+        server = await asyncio.start_server(
+            lambda rd, wr: handle_webhook_conn(app, rd, wr),
+            WEBHOOK_LISTEN, WEBHOOK_PORT, reuse_port=True,
+        )
+        log.info(f"Webhook worker {os.getpid()} listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        async with server:
+            await stop.wait()
+        await app.stop()
+        await app.post_shutdown(app)
+
+def webhook_worker(index: int = 0):
+    global METRICS_PORT
+    if METRICS_PORT:
+        METRICS_PORT += index
+    asyncio.run(serve_webhook(build_app()))
+
+def main():
+    if not TOKEN:
+        raise RuntimeError("TELEGRAM_TOKEN is not set")
+    if BOT_MODE != "webhook":
+        log.info("Bot starting (run_polling)…")
+        build_app().run_polling()
+        return
+
+    if not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL is not set")
+    if not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET):
+        raise RuntimeError("WEBHOOK_SECRET is not set or invalid (A-Z, a-z, 0-9, _ and -, up to 256 chars)")
+    if WEBHOOK_WORKERS <= 1:
+        webhook_worker();  return
+
+    log.info(f"Bot starting (webhook, {WEBHOOK_WORKERS} workers)…")
+    procs = [multiprocessing.Process(target=webhook_worker, args=(i,)) for i in range(WEBHOOK_WORKERS)]
+    for p in procs: p.start()
+    def _terminate(*_):
+        for p in procs: p.terminate()
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        for p in procs: p.join()
+    except KeyboardInterrupt:
+        _terminate()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
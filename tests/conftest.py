@@ -0,0 +1,20 @@
+import fakeredis
+import pytest
+
+import main
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def rds():
+    # Свой in-process Redis (с Lua) на каждый тест и чистое состояние процесса
+    await main.connect_redis("", fakeredis.FakeAsyncRedis(decode_responses=True))
+    main._pair_cache.clear()
+    main._ent_cache.clear()
+    main._events_pending.clear()
+    yield main.r
+    await main.r.aclose()
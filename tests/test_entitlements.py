@@ -0,0 +1,102 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+
+async def fresh_state(uid: int) -> main.UserState:
+    # Новый апдейт — новый context, состояние читается заново
+    return await main.load_user_state(SimpleNamespace(), uid)
+
+
+def test_is_active_boundary():
+    until = 1_700_000_000
+    assert main.is_active(until, until - 1)
+    assert not main.is_active(until, until)
+    assert not main.is_active(0, 0)
+
+
+async def test_state_expires_on_the_clock(rds, monkeypatch):
+    monkeypatch.setattr(main, "_inval_live", True)
+    now = int(time.time())
+    await rds.hset(main.user_k(1), mapping={main.F_GENDER: "M", main.F_PREMIUM: now + 60, main.F_VIP: now - 1})
+    st = await fresh_state(1)
+    assert st.is_premium and not st.is_vip and st.has_gender_rights
+    monkeypatch.setattr(main.time, "time", lambda: now + 60)
+    assert not st.is_premium and not st.has_gender_rights
+    # Из кэша — тот же срок, и он тоже уже истёк
+    assert not (await fresh_state(1)).has_gender_rights
+
+
+async def test_cache_hit_skips_entitlement_fields(rds, monkeypatch):
+    monkeypatch.setattr(main, "_inval_live", True)
+    now = int(time.time())
+    await rds.hset(main.user_k(2), mapping={main.F_GENDER: "F", main.F_VIP: now + 3600})
+    assert (await fresh_state(2)).is_vip
+    hits = main.ent_cache_stats["hit"]
+    # Запись в обход продления (без публикации) кэш не видит — поля не читаются
+    await rds.hset(main.user_k(2), main.F_VIP, now - 1)
+    assert (await fresh_state(2)).is_vip
+    assert main.ent_cache_stats["hit"] == hits + 1
+    main.invalidate_entitlements(2)
+    assert not (await fresh_state(2)).is_vip
+
+
+async def test_cache_unused_without_subscription(rds):
+    now = int(time.time())
+    await rds.hset(main.user_k(3), mapping={main.F_GENDER: "F", main.F_PREMIUM: now + 3600})
+    assert (await fresh_state(3)).is_premium
+    assert 3 not in main._ent_cache
+    await rds.hset(main.user_k(3), main.F_PREMIUM, 0)
+    assert not (await fresh_state(3)).is_premium
+
+
+async def test_extend_invalidates_cache(rds, monkeypatch):
+    monkeypatch.setattr(main, "_inval_live", True)
+    await rds.hset(main.user_k(4), main.F_GENDER, "M")
+    assert not (await fresh_state(4)).has_gender_rights
+    until = await main.extend_premium(4, days=1, charge_id="c1")
+    st = await fresh_state(4)
+    assert st.is_premium and st.premium_until == until
+    # Повтор платежа срок не двигает
+    assert await main.extend_premium(4, days=1, charge_id="c1") == until
+
+
+async def test_remote_extend_invalidates_via_channel(rds):
+    listener = asyncio.create_task(main.invalidation_listener())
+    try:
+        for _ in range(100):
+            if main._inval_live:
+                break
+            await asyncio.sleep(0.01)
+        assert main._inval_live
+        await rds.hset(main.user_k(5), main.F_GENDER, "M")
+        assert not (await fresh_state(5)).is_vip
+        assert 5 in main._ent_cache
+        # Продление на другом воркере: тот же скрипт, локальный сброс не вызывается
+        await main.extend_script(keys=[main.user_k(5), "", main.ENT_CHANNEL],
+                                 args=[main.F_VIP, int(time.time()), 3600, main.PAYMENT_TTL, 5])
+        for _ in range(100):
+            if 5 not in main._ent_cache:
+                break
+            await asyncio.sleep(0.01)
+        assert (await fresh_state(5)).is_vip
+    finally:
+        listener.cancel()
+        await asyncio.gather(listener, return_exceptions=True)
+    assert not main._inval_live and not main._ent_cache
+
+
+async def test_stale_read_not_cached_after_invalidation(rds, monkeypatch):
+    monkeypatch.setattr(main, "_inval_live", True)
+    epoch = main._ent_epoch
+    main.invalidate_entitlements(6)  # сброс между чтением и записью в кэш
+    main.remember_entitlements(6, 0, 0, epoch)
+    assert 6 not in main._ent_cache
+    main.remember_entitlements(6, 0, 0, main._ent_epoch)
+    assert main._ent_cache[6] == (0, 0)
@@ -0,0 +1,29 @@
+import pytest
+
+import main
+from tools.events_rollup import ROLLUP_KEY, Rollup
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_events_roll_up_once(rds):
+    p = {"gender": "M", "age_range": "21-30"}
+    await main.match_or_enqueue(1, p)
+    await main.match_or_enqueue(2, p)
+    await main.clear_pair(2, reason="next")
+    await main.extend_premium(3, days=7, charge_id="c1", event={"x": "premium:7d", "a": 150})
+    await main.extend_premium(3, days=7, charge_id="c1", event={"x": "premium:7d", "a": 150})  # повтор
+    assert [e["e"] for e in main._events_pending] == ["queue", "pair", "end", "pay"]
+    await main.flush_activity()
+    assert await rds.xlen(main.EVENTS_STREAM) == 4
+
+    roll = Rollup(rds)
+    cursor, n = await roll.step("0-0", 100, None)
+    assert n == 4
+    assert (await roll.step(cursor, 100, None))[1] == 0
+    totals = {}
+    for k in await rds.keys(ROLLUP_KEY.format(minute="*")):
+        for f, v in (await rds.hgetall(k)).items():
+            totals[f] = totals.get(f, 0) + int(v)
+    assert totals["pairs"] == totals["queued"] == totals["ends"] == totals["end_next"] == totals["dialogs"] == 1
+    assert totals["waits"] == 2 and totals["pays"] == 1 and totals["stars"] == 150
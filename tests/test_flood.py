@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        self.sent.append(chat_id)
+
+
+@pytest.fixture
+def flood_state():
+    for d in (main._flood_windows, main._flood_mutes, main._flood_pending, main._flood_noticed):
+        d.clear()
+    yield
+    for d in (main._flood_windows, main._flood_mutes, main._flood_pending, main._flood_noticed):
+        d.clear()
+
+
+async def test_one_redis_call_and_notice_per_mute(rds, flood_state, monkeypatch):
+    calls = []
+    real_set = rds.set
+
+    async def counting_set(*args, **kwargs):
+        calls.append(args[0])
+        return await real_set(*args, **kwargs)
+    monkeypatch.setattr(rds, "set", counting_set)
+    bot = FakeBot()
+
+    main.mute("msg", 1, time.time() + 60)
+    for _ in range(50):
+        assert not main.flood_allow("msg", 1)
+        await main.notify_muted(bot, 1, "msg")
+    assert bot.sent == [1] and len(calls) == 1
+
+    # Новая пауза после окончания прежней — снова одно уведомление
+    main._flood_mutes.clear()
+    await rds.delete(main.FLOOD_NOTICE.format(uid=1))
+    main.mute("msg", 1, time.time() + 60)
+    for _ in range(10):
+        await main.notify_muted(bot, 1, "msg")
+    assert bot.sent == [1, 1] and len(calls) == 2
+
+
+async def test_notice_already_sent_by_another_worker(rds, flood_state):
+    bot = FakeBot()
+    main.mute("search", 2, time.time() + 60)
+    await rds.set(main.FLOOD_NOTICE.format(uid=2), 1, px=60_000)
+    await main.notify_muted(bot, 2, "search")
+    assert not bot.sent
+
+
+async def test_not_muted_means_no_notice(rds, flood_state):
+    bot = FakeBot()
+    await main.notify_muted(bot, 3, "msg")
+    assert not bot.sent and not main._flood_noticed
@@ -0,0 +1,80 @@
+import asyncio
+import random
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+
+async def pairs_and_queue(r) -> tuple:
+    peers = {}
+    for k in await r.keys(main.user_k("") + "*"):
+        peer = await r.hget(k, main.F_PEER)
+        if peer:
+            peers[int(k.split(":")[1])] = int(peer)
+    where = {int(u): k for u, k in (await r.hgetall(main.QUEUE_WHERE)).items()}
+    in_shards = {}
+    for k in main.all_shards():
+        for u in await r.zrange(k, 0, -1):
+            in_shards[int(u)] = k
+    return peers, where, in_shards
+
+
+async def test_overlapping_searches_never_double_pair(rds):
+    rnd = random.Random(1)
+    users = range(1, 2001)
+    profiles = {uid: {"gender": rnd.choice(main.GENDERS), "age_range": rnd.choice(main.AGE_RANGES)} for uid in users}
+    wants = {uid: rnd.choice((main.WANT_ANY, main.WANT_ANY) + main.GENDERS) for uid in users}
+
+    async def search(uid):
+        return uid, await main.match_or_enqueue(uid, profiles[uid], wants[uid], priority=uid % 7 == 0)
+
+    # Все поиски одновременно, плюс повторный поиск части пользователей и /stop
+    res = await asyncio.gather(*(search(uid) for uid in users), *(search(uid) for uid in users if uid % 5 == 0))
+    await asyncio.gather(*(main.clear_pair(uid) for uid in users if uid % 11 == 0))
+    await asyncio.gather(*(search(uid) for uid in users if uid % 11 == 0))
+
+    peers, where, in_shards = await pairs_and_queue(rds)
+    assert any(peer > 0 for _, peer in res)
+    assert all(peers.get(b) == a for a, b in peers.items()), "asymmetric pair"
+    assert not set(peers) & set(where), "paired and queued at once"
+    assert in_shards == where
+    assert int(await rds.get(main.PAIRS_COUNT)) == len(peers) // 2
+
+
+async def test_search_while_paired_is_rejected(rds):
+    p = {"gender": "M", "age_range": "21-30"}
+    assert await main.match_or_enqueue(1, p) == 0
+    assert await main.match_or_enqueue(2, p) == 1
+    assert await main.match_or_enqueue(1, p) == -1
+    assert await rds.hlen(main.QUEUE_WHERE) == 0
+
+
+async def waiters_for_overdue_test(t0: int, searcher_waited: int = 0):
+    # 2: премиум, другой возраст и дальний ярус, ждёт 1 с — ещё не просрочен;
+    # 3: тот же возраст и ярус, ждёт 10 с. Оба ищут только парней.
+    await main.match_or_enqueue(2, {"gender": "F", "age_range": "31-40"}, "M", priority=True, rep="0", at_ms=t0 - 1000)
+    await main.match_or_enqueue(3, {"gender": "F", "age_range": "12-20"}, "M", rep="2", at_ms=t0 - 10_000)
+    if searcher_waited:
+        await main.match_or_enqueue(1, {"gender": "M", "age_range": "12-20"}, rep="2", at_ms=t0 - searcher_waited)
+
+
+async def test_priority_waiter_is_not_overdue_on_enqueue(rds, monkeypatch):
+    monkeypatch.setattr(main, "MATCH_MODE", "reputation")
+    t0 = main.now_ms()
+    await waiters_for_overdue_test(t0)
+    assert await main.match_or_enqueue(1, {"gender": "M", "age_range": "12-20"}, rep="2", at_ms=t0) == 3
+    # Когда премиум действительно прождал дольше MATCH_MAX_WAIT_MS — он первый
+    t1 = t0 + main.MATCH_MAX_WAIT_MS
+    await main.match_or_enqueue(4, {"gender": "F", "age_range": "12-20"}, "M", rep="2", at_ms=t1 - 100)
+    assert await main.match_or_enqueue(5, {"gender": "M", "age_range": "12-20"}, rep="2", at_ms=t1) == 2
+
+
+async def test_batch_priority_waiter_is_not_overdue_on_enqueue(rds, monkeypatch):
+    monkeypatch.setattr(main, "MATCH_MODE", "reputation")
+    monkeypatch.setattr(main, "MATCH_SCHEDULER", "batch")
+    t0 = main.now_ms()
+    await waiters_for_overdue_test(t0, searcher_waited=12_000)
+    assert await main.batch_match_tick(at_ms=t0) == [(1, 3)]
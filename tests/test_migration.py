@@ -0,0 +1,124 @@
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from tools.migrate_users import migrate_batch
+
+pytestmark = pytest.mark.anyio
+
+
+async def legacy_user(r, uid: int, peer: int = 0, vip_until: int = 0):
+    # Пользователь на старых ключах, в хэш которого flush_activity уже записал seen
+    await r.set(main.PROFILE_KEY.format(uid=uid), json.dumps({"gender": "F", "age_range": "21-30"}))
+    if peer:
+        await r.set(main.PAIR_KEY.format(uid=uid), peer)
+    if vip_until:
+        await r.set(main.VIP_KEY.format(uid=uid), vip_until)
+    await r.hset(main.user_k(uid), main.F_SEEN, int(time.time()))
+
+
+async def test_load_state_migrates_despite_activity_fields(rds):
+    until = int(time.time()) + 3600
+    await legacy_user(rds, 1, peer=2, vip_until=until)
+    st = await main.load_user_state(SimpleNamespace(), 1)
+    assert st.profile == {"gender": "F", "age_range": "21-30"}
+    assert st.peer == 2 and st.vip_until == until
+    assert not await rds.exists(main.PROFILE_KEY.format(uid=1), main.PAIR_KEY.format(uid=1))
+    assert await rds.hget(main.user_k(1), main.F_MIGRATED)
+
+
+async def test_relay_peer_lookup_migrates(rds):
+    await legacy_user(rds, 3, peer=4)
+    assert await main.get_peer(3) == 4
+    assert await rds.hget(main.user_k(3), main.F_PEER) == "4"
+    assert not await rds.exists(main.PAIR_KEY.format(uid=3))
+
+
+async def test_extend_builds_on_legacy_expiry(rds):
+    until = int(time.time()) + 86400
+    await legacy_user(rds, 5, vip_until=until)
+    new_until = await main.extend_vip(5, months=1, charge_id="c5")
+    assert new_until == until + main._add_months_or_days(0, months=1)
+
+
+async def test_migrated_users_are_not_rechecked(rds, monkeypatch):
+    assert await main.get_peer(6) is None  # новый пользователь — тоже помечается
+    assert await rds.hget(main.user_k(6), main.F_MIGRATED)
+
+    async def fail(uid):
+        raise AssertionError("migrate_user called again")
+    monkeypatch.setattr(main, "migrate_user", fail)
+    assert await main.get_peer(6) is None
+    await main.load_user_state(SimpleNamespace(), 6)
+
+
+async def test_batch_migration_sets_marker(rds, monkeypatch):
+    await legacy_user(rds, 7, peer=8)
+    assert await migrate_batch(rds, ["7"], keep=False) == 1
+    assert await rds.hget(main.user_k(7), main.F_MIGRATED)
+
+    async def fail(uid):
+        raise AssertionError("migrate_user called again")
+    monkeypatch.setattr(main, "migrate_user", fail)
+    assert await main.get_peer(7) == 8
+
+
+async def legacy_pair(r, a: int, b: int):
+    await legacy_user(r, a, peer=b)
+    await legacy_user(r, b, peer=a)
+
+
+async def test_stop_clears_unmigrated_pair(rds):
+    await legacy_pair(rds, 11, 12)
+    assert await main.clear_pair(11) == 12
+    assert await main.get_peer(11) is None and await main.get_peer(12) is None
+    assert not await rds.exists(main.PAIR_KEY.format(uid=11), main.PAIR_KEY.format(uid=12))
+
+
+async def test_half_migrated_pair_does_not_come_back(rds):
+    await legacy_pair(rds, 21, 22)
+    assert await main.get_peer(21) == 22  # 21 перенесён релеем, 22 — ещё нет
+    assert await main.clear_pair(21) == 22
+    await main.match_or_enqueue(23, {"gender": "F", "age_range": "21-30"})
+    await rds.hset(main.user_k(21), main.F_GENDER, "M")
+    assert await main.match_or_enqueue(21, {"gender": "M", "age_range": "21-30"}) == 23
+    # 22 вернулся: старый pair:22 не должен снова связать его с 21
+    assert await main.get_peer(22) is None
+    assert (await main.load_user_state(SimpleNamespace(), 22)).peer is None
+    assert await main.get_peer(21) == 23
+
+
+async def test_batch_migration_skips_users_the_bot_already_moved(rds):
+    # Бот перенёс 31 лениво, пара закончилась, а старый pair:31 остался
+    # (например, после прогона с --keep) — перенос не должен её вернуть
+    await legacy_pair(rds, 31, 32)
+    await main.migrate_user(31)
+    await main.migrate_user(32)
+    await main.clear_pair(31)
+    await rds.set(main.PAIR_KEY.format(uid=31), 32)
+    assert await migrate_batch(rds, ["31", "32"], keep=False) == 0
+    assert await main.get_peer(31) is None
+    assert not await rds.exists(main.PAIR_KEY.format(uid=31))
+
+
+async def test_batch_migration_keep_leaves_legacy_keys(rds):
+    await legacy_user(rds, 41, peer=42)
+    assert await migrate_batch(rds, ["41"], keep=True) == 1
+    assert await rds.get(main.PAIR_KEY.format(uid=41)) == "42"
+    assert await rds.hget(main.user_k(41), main.F_PEER) == "42"
+
+
+async def test_pair_counter_ignores_pairs_it_never_counted(rds):
+    # Пара со старых ключей не была учтена в счётчике — её конец его не уменьшает
+    await legacy_pair(rds, 51, 52)
+    await main.match_or_enqueue(53, {"gender": "F", "age_range": "21-30"})
+    assert await main.match_or_enqueue(54, {"gender": "M", "age_range": "21-30"}) == 53
+    assert await rds.get(main.PAIRS_COUNT) == "1"
+    assert await main.clear_pair(51) == 52
+    assert await rds.get(main.PAIRS_COUNT) == "1"
+    assert await main.clear_pair(53) == 54
+    assert await rds.get(main.PAIRS_COUNT) == "0"
+    assert (await main._redis_gauges())["pairs"] == 0
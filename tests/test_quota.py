@@ -0,0 +1,37 @@
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+M = {"gender": "M", "age_range": "21-30"}
+F = {"gender": "F", "age_range": "21-30"}
+
+
+async def chats(r, uid: int, at_ms: int) -> int:
+    k = main.quota_prefix(at_ms / 1000) + str(uid // main.QUOTA_SHARD)
+    return int(await r.hget(k, uid % main.QUOTA_SHARD) or 0)
+
+
+@pytest.mark.parametrize("shard", [100, 7])
+async def test_daily_limit_counts_both_sides(rds, monkeypatch, shard):
+    monkeypatch.setattr(main, "QUOTA_SHARD", shard)
+    t = main.now_ms()
+    for n, girl in enumerate((101, 102), 1):
+        await main.match_or_enqueue(girl, F, at_ms=t)
+        assert await main.match_or_enqueue(1, M, at_ms=t, quota=2) == girl
+        await main.clear_pair(1)
+        assert await chats(rds, 1, t) == n and await chats(rds, girl, t) == 1
+    await main.match_or_enqueue(103, F, at_ms=t)
+    assert await main.match_or_enqueue(1, M, at_ms=t, quota=2) == -2
+    assert await main.match_or_enqueue(1, M, at_ms=t) == 103  # премиум — без лимита
+
+
+async def test_batch_pairs_count_toward_limit(rds, monkeypatch):
+    monkeypatch.setattr(main, "QUOTA_SHARD", 7)
+    monkeypatch.setattr(main, "MATCH_SCHEDULER", "batch")
+    t = main.now_ms()
+    await main.match_or_enqueue(201, F, at_ms=t)
+    await main.match_or_enqueue(2, M, at_ms=t)
+    assert await main.batch_match_tick(at_ms=t) == [(2, 201)]
+    assert await chats(rds, 2, t) == 1 and await chats(rds, 201, t) == 1
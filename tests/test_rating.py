@@ -0,0 +1,77 @@
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeQuery:
+    def __init__(self, uid: int, data: str):
+        self.from_user, self.data = SimpleNamespace(id=uid), data
+        self.text = self.markup = None
+
+    async def answer(self):
+        pass
+
+    async def edit_message_text(self, text):
+        self.text = text
+
+    async def edit_message_reply_markup(self, markup):
+        self.markup = markup
+
+
+async def press(uid: int, data: str) -> FakeQuery:
+    q = FakeQuery(uid, data)
+    await main.on_rate_or_report(SimpleNamespace(callback_query=q), SimpleNamespace())
+    return q
+
+
+async def test_old_prompt_rates_its_own_dialog(rds):
+    first = await main.issue_rate_token(1, 2)   # диалог с 2
+    second = await main.issue_rate_token(1, 3)  # потом с 3
+    await press(1, f"rate:-:{first}")
+    assert await main.get_feedback_counts(2) == (0, 1, 0)
+    assert await main.get_feedback_counts(3) == (0, 0, 0)
+    await press(1, f"report:open:{second}")
+    await press(1, f"report:Реклама:{second}")
+    assert await main.get_feedback_counts(3) == (0, 0, 1)
+
+
+async def test_token_is_single_use_and_bound_to_user(rds):
+    token = await main.issue_rate_token(1, 2)
+    q = await press(4, f"rate:+:{token}")  # чужой токен
+    assert "недоступна" in q.text
+    await press(1, f"rate:+:{token}")
+    q = await press(1, f"rate:+:{token}")
+    assert "недоступна" in q.text
+    assert await main.get_feedback_counts(2) == (1, 0, 0)
+
+
+async def test_menu_navigation_keeps_token(rds):
+    token = await main.issue_rate_token(1, 2)
+    q = await press(1, f"report:open:{token}")
+    datas = [b.callback_data for row in q.markup.inline_keyboard for b in row]
+    assert all(d.endswith(token) and len(d.encode()) <= 64 for d in datas)
+    q = await press(1, f"report:back:{token}")
+    assert q.markup.inline_keyboard[0][0].callback_data == f"rate:+:{token}"
+    assert await rds.hexists(main.rate_tokens_k(1), token)
+
+
+async def test_untokened_and_forged_data_rejected(rds):
+    for data in ("rate:+", "report:Реклама", "rate:+:2", "rate:+:zzzzzzzzzzzz"):
+        q = await press(1, data)
+        assert "недоступна" in q.text
+    assert await main.get_feedback_counts(2) == (0, 0, 0)
+
+
+async def test_only_last_prompts_keep_tokens(rds):
+    tokens = [await main.issue_rate_token(1, peer) for peer in range(100, 100 + main.RATE_TOKENS_MAX + 2)]
+    assert await rds.hlen(main.rate_tokens_k(1)) == main.RATE_TOKENS_MAX
+    assert 0 < await rds.ttl(main.rate_tokens_k(1)) <= main.RATE_TOKEN_TTL_S
+    q = await press(1, f"rate:+:{tokens[1]}")  # вытеснен более новыми
+    assert "недоступна" in q.text
+    await press(1, f"rate:+:{tokens[2]}")
+    assert await main.get_feedback_counts(102) == (1, 0, 0)
+    assert await rds.hlen(main.rate_tokens_k(1)) == main.RATE_TOKENS_MAX - 1
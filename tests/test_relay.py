@@ -0,0 +1,124 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+SLOW, FAST = 17, 33  # получатели в одной партиции
+PART = SLOW % main.RELAY_PARTITIONS
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent, self.release = [], asyncio.Event()
+
+    async def copy_message(self, to, chat, mid):
+        if to == SLOW:
+            await self.release.wait()
+        self.sent.append((to, mid))
+
+
+async def pair(r, a: int, b: int):
+    await r.hset(main.user_k(a), mapping={main.F_PEER: b, main.F_MIGRATED: 1})
+    await r.hset(main.user_k(b), mapping={main.F_PEER: a, main.F_MIGRATED: 1})
+
+
+async def wait_for(cond, timeout: float = 2.0):
+    # cond — функция, возвращающая bool или корутину с ним
+    for _ in range(int(timeout / 0.01)):
+        res = cond()
+        if await res if asyncio.iscoroutine(res) else res:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("condition not reached")
+
+
+async def backlog(r, n: int) -> bool:
+    return await r.xlen(main.relay_k(PART)) == n
+
+
+async def test_slow_chat_does_not_hold_back_others(rds):
+    bot = FakeBot()
+    app = SimpleNamespace(context_types=SimpleNamespace(context=lambda app: SimpleNamespace(bot=bot)))
+    await pair(rds, 1, SLOW)
+    await pair(rds, 2, FAST)
+    for mid in range(3):
+        await main.relay_enqueue(1, SLOW, SimpleNamespace(chat_id=1, message_id=mid))
+        await main.relay_enqueue(2, FAST, SimpleNamespace(chat_id=2, message_id=mid))
+
+    drainer = asyncio.create_task(main.relay_drainer(app, PART))
+    try:
+        # Первое сообщение SLOW висит, а FAST доставлен и удалён из стрима
+        await wait_for(lambda: len(bot.sent) == 3)
+        assert bot.sent == [(FAST, 0), (FAST, 1), (FAST, 2)]
+        await wait_for(lambda: backlog(rds, 3))
+
+        # Новые сообщения FAST, пришедшие после, тоже не ждут SLOW
+        await main.relay_enqueue(2, FAST, SimpleNamespace(chat_id=2, message_id=3))
+        await wait_for(lambda: (FAST, 3) in bot.sent)
+
+        bot.release.set()
+        await wait_for(lambda: backlog(rds, 0))
+        assert [mid for to, mid in bot.sent if to == SLOW] == [0, 1, 2]
+    finally:
+        drainer.cancel()
+        await asyncio.gather(drainer, return_exceptions=True)
+
+
+async def test_undelivered_entries_survive_leader_loss(rds):
+    bot = FakeBot()
+    app = SimpleNamespace(context_types=SimpleNamespace(context=lambda app: SimpleNamespace(bot=bot)))
+    await pair(rds, 1, SLOW)
+    await main.relay_enqueue(1, SLOW, SimpleNamespace(chat_id=1, message_id=0))
+    drainer = asyncio.create_task(main.relay_drainer(app, PART))
+    await asyncio.sleep(0.05)
+    drainer.cancel()
+    await asyncio.gather(drainer, return_exceptions=True)
+    assert await rds.xlen(main.relay_k(PART)) == 1 and not bot.sent
+
+
+
+async def test_failure_midway_does_not_resend_delivered(rds, monkeypatch):
+    bot = FakeBot()
+    app = SimpleNamespace(context_types=SimpleNamespace(context=lambda app: SimpleNamespace(bot=bot)))
+    await pair(rds, 2, FAST)
+    for mid in range(3):
+        await main.relay_enqueue(2, FAST, SimpleNamespace(chat_id=2, message_id=mid))
+    real_get_peer, calls = main.get_peer, []
+
+    async def flaky_get_peer(uid):
+        calls.append(uid)
+        if len(calls) == 2:  # Redis отвалился на второй записи
+            raise ConnectionError("redis down")
+        return await real_get_peer(uid)
+    monkeypatch.setattr(main, "get_peer", flaky_get_peer)
+    monkeypatch.setattr(main.asyncio, "sleep", lambda s, _real=asyncio.sleep: _real(0))
+
+    drainer = asyncio.create_task(main.relay_drainer(app, PART))
+    try:
+        await wait_for(lambda: backlog(rds, 0))
+        assert bot.sent == [(FAST, 0), (FAST, 1), (FAST, 2)]
+    finally:
+        drainer.cancel()
+        await asyncio.gather(drainer, return_exceptions=True)
+
+
+async def test_leader_loss_keeps_only_undelivered(rds):
+    bot = FakeBot()
+    app = SimpleNamespace(context_types=SimpleNamespace(context=lambda app: SimpleNamespace(bot=bot)))
+    await pair(rds, 2, FAST)
+    await pair(rds, 1, SLOW)
+    for mid in range(2):
+        await main.relay_enqueue(2, FAST, SimpleNamespace(chat_id=2, message_id=mid))
+    await main.relay_enqueue(1, SLOW, SimpleNamespace(chat_id=1, message_id=0))
+    drainer = asyncio.create_task(main.relay_drainer(app, PART))
+    await wait_for(lambda: len(bot.sent) == 2)
+    await wait_for(lambda: backlog(rds, 1))
+    drainer.cancel()
+    await asyncio.gather(drainer, return_exceptions=True)
+    # Остался только висевший SLOW — новый лидер не повторит доставленное
+    entries = await rds.xrange(main.relay_k(PART))
+    assert [int(f["to"]) for _, f in entries] == [SLOW]
@@ -0,0 +1,88 @@
+import asyncio
+import gc
+import time
+
+import pytest
+from telegram.error import RetryAfter
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def outbox():
+    s = main.SendScheduler(global_rate=1000, chat_rate=1000, chat_burst=1000, concurrency=16)
+    task = asyncio.create_task(s.run())
+    yield s
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+def flaky(fails: int, retry_after: float = 0.3):
+    # factory: первые fails вызовов — 429, потом успех
+    calls = []
+
+    async def factory():
+        calls.append(time.monotonic())
+        if len(calls) <= fails:
+            raise RetryAfter(retry_after)
+        return len(calls)
+    return factory, calls
+
+
+async def test_chat_retry_after_pauses_only_that_chat(outbox):
+    factory, calls = flaky(1)
+    t0 = time.monotonic()
+    slow = asyncio.create_task(outbox.send(1, factory))
+
+    async def ok():
+        return "ok"
+    await asyncio.sleep(0.01)
+    assert await asyncio.wait_for(outbox.send(2, ok), 0.1) == "ok"  # чат 2 не ждёт
+    assert await slow == 2
+    assert calls[1] - t0 >= 0.3
+    assert outbox.stats["global_pauses"] == 0
+
+
+async def test_retry_after_from_many_chats_pauses_everything(outbox):
+    sends = [asyncio.create_task(outbox.send(chat, flaky(1)[0])) for chat in range(main.RETRY_GLOBAL_CHATS)]
+    await asyncio.sleep(0.05)
+    assert outbox.stats["global_pauses"] == 1
+
+    async def ok():
+        return time.monotonic()
+    t0 = time.monotonic()
+    assert await outbox.send(100, ok) - t0 >= 0.2
+    await asyncio.gather(*sends)
+
+
+async def test_cancelled_caller_does_not_break_scheduler(outbox):
+    started, release = asyncio.Event(), asyncio.Event()
+    loop_errors = []
+    asyncio.get_running_loop().set_exception_handler(lambda loop, ctx: loop_errors.append(ctx))
+
+    async def slow():
+        started.set()
+        await release.wait()
+        return 1
+
+    async def failing():
+        started.set()
+        await release.wait()
+        raise RuntimeError("boom")
+    for factory in (slow, failing):
+        started.clear();  release.clear()
+        caller = asyncio.create_task(outbox.send(1, factory))
+        await started.wait()
+        caller.cancel()
+        await asyncio.gather(caller, return_exceptions=True)
+        release.set()
+        await asyncio.sleep(0.01)
+
+    async def ok():
+        return "ok"
+    assert await outbox.send(1, ok) == "ok"
+    gc.collect()
+    await asyncio.sleep(0)
+    assert not loop_errors
@@ -0,0 +1,54 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+UPDATE = json.dumps({"update_id": 1, "message": {
+    "message_id": 1, "date": 0, "chat": {"id": 5, "type": "private"}, "from": {"id": 5, "is_bot": False, "first_name": "x"},
+    "successful_payment": {"currency": "XTR", "total_amount": 1, "invoice_payload": "vip:1",
+                           "telegram_payment_charge_id": "c", "provider_payment_charge_id": "p"}}}).encode()
+
+
+async def post(port: int, secret: str = "") -> str:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    head = (f"POST {main.WEBHOOK_PATH} HTTP/1.1\r\nHost: x\r\nContent-Length: {len(UPDATE)}\r\nConnection: close\r\n"
+            + (f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n" if secret else "") + "\r\n")
+    writer.write(head.encode() + UPDATE)
+    await writer.drain()
+    status = (await reader.readline()).decode().split(" ", 1)[1].strip()
+    writer.close()
+    return status
+
+
+@pytest.mark.parametrize("configured, sent, expected", [
+    ("", "", "403 Forbidden"),             # секрет не задан — не принимаем ничего
+    ("", "guess", "403 Forbidden"),
+    ("s3cret", "", "403 Forbidden"),
+    ("s3cret", "wrong", "403 Forbidden"),
+    ("s3cret", "s3cret", "200 OK"),
+])
+async def test_webhook_requires_secret(monkeypatch, configured, sent, expected):
+    monkeypatch.setattr(main, "WEBHOOK_SECRET", configured)
+    queue = asyncio.Queue()
+    app = SimpleNamespace(update_queue=queue, bot=None)
+    server = await asyncio.start_server(lambda rd, wr: main.handle_webhook_conn(app, rd, wr), "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    async with server:
+        assert await post(port, sent) == expected
+    assert queue.qsize() == (1 if expected == "200 OK" else 0)
+
+
+@pytest.mark.parametrize("secret", ["", "has space", "x" * 257])
+def test_webhook_mode_refuses_to_start_without_valid_secret(monkeypatch, secret):
+    monkeypatch.setattr(main, "TOKEN", "1:x")
+    monkeypatch.setattr(main, "BOT_MODE", "webhook")
+    monkeypatch.setattr(main, "WEBHOOK_URL", "https://example.org/telegram")
+    monkeypatch.setattr(main, "WEBHOOK_SECRET", secret)
+    monkeypatch.setattr(main, "webhook_worker", lambda *a: pytest.fail("worker started"))
+    with pytest.raises(RuntimeError, match="WEBHOOK_SECRET"):
+        main.main()
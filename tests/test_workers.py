@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_global_send_rate_is_split_between_live_workers(rds, monkeypatch):
+    outbox = main.SendScheduler(global_rate=main.TG_GLOBAL_RATE)
+    monkeypatch.setattr(main, "outbox", outbox)
+    monkeypatch.setattr(main, "WORKER_HEARTBEAT_S", 0.05)
+    now = main.now_ms()
+    await rds.zadd(main.WORKERS_KEY, {"other:1": now, "other:2": now, "gone:3": now - 60_000})
+
+    task = asyncio.create_task(main.worker_heartbeat())
+    await asyncio.sleep(0.02)
+    assert outbox._global.rate == pytest.approx(main.TG_GLOBAL_RATE / 3)
+    assert await rds.zscore(main.WORKERS_KEY, "gone:3") is None
+    # Соседи перестали отмечаться — через 3 периода лимит снова весь наш
+    await asyncio.sleep(0.2)
+    assert outbox._global.rate == pytest.approx(main.TG_GLOBAL_RATE)
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    assert await rds.zscore(main.WORKERS_KEY, main.WORKER_ID) is None
+
+
+def test_set_rate_keeps_tokens_within_new_burst():
+    b = main.TokenBucket(30, 30)
+    b.set_rate(10, 10)
+    assert b.tokens == 10
+    for _ in range(10):
+        assert b.reserve() == 0.0
+    assert b.reserve() == pytest.approx(0.1, abs=0.01)
+
+
+async def test_broadcast_takes_a_share_of_the_bot_budget(rds, monkeypatch):
+    from tools.broadcast import Broadcast
+    outbox = main.SendScheduler(global_rate=main.TG_GLOBAL_RATE)
+    monkeypatch.setattr(main, "outbox", outbox)
+    monkeypatch.setattr(main, "WORKER_HEARTBEAT_S", 0.05)
+    worker = asyncio.create_task(main.worker_heartbeat())
+    b = Broadcast(rds, bot=None, run="t", rate=main.TG_GLOBAL_RATE, concurrency=1, batch=10)
+    heartbeat = asyncio.create_task(b.share_budget())
+    await asyncio.sleep(0.12)
+    # Рассылка и воркер вместе не выходят за общий лимит
+    assert b.bucket.rate == pytest.approx(main.TG_GLOBAL_RATE / 2)
+    assert outbox._global.rate + b.bucket.rate == pytest.approx(main.TG_GLOBAL_RATE)
+
+    heartbeat.cancel()
+    await asyncio.gather(heartbeat, return_exceptions=True)
+    assert await rds.zscore(main.WORKERS_KEY, b.worker_id) is None
+    await asyncio.sleep(0.1)
+    assert outbox._global.rate == pytest.approx(main.TG_GLOBAL_RATE)
+    worker.cancel()
+    await asyncio.gather(worker, return_exceptions=True)
@@ -0,0 +1,114 @@
+"""Перенос старых списков rates:{uid}/reports:{uid} в агрегаты по оцененному.
+
+Старые списки лежат у того, КТО оценивал, и содержат {"peer", "v"|"reason",
+"ts"}. Каждая запись с известным peer превращается в HINCRBY счётчика в
+u:{peer} и попадает в окно последних событий fb:{peer}; ярус репутации
+затронутых пользователей пересчитывается после каждого куска. Списки читаются
+кусками с конца (от новых к старым) и дописываются в хвост окна, так что
+живые события, записанные ботом во время переноса, остаются свежее.
+
+Прогресс по каждому списку пишется в той же MULTI-транзакции, что и сами
+агрегаты, поэтому после падения перенос продолжается без двойного счёта.
+
+    REDIS_URL=... python -m tools.backfill_feedback --batch 500
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import redis.asyncio as redis
+
+import main
+
+PROGRESS_KEY = "fb:backfill"  # HASH: ключ старого списка -> сколько записей перенесено
+
+SOURCES = (
+    (main.RATES_KEY, lambda rec: main.F_UP if rec.get("v", 0) > 0 else main.F_DOWN),
+    (main.REPORTS_KEY, lambda rec: main.F_REPORTS),
+)
+
+
+async def refresh_tiers(r: redis.Redis, uids: set):
+    uids = list(uids)
+    pipe = r.pipeline(transaction=False)
+    for uid in uids:
+        pipe.hmget(main.user_k(uid), main.F_UP, main.F_DOWN, main.F_REPORTS)
+    counts = await pipe.execute()
+    pipe = r.pipeline(transaction=False)
+    for uid, c in zip(uids, counts):
+        pipe.hset(main.user_k(uid), main.F_REP_TIER, main.rep_tier(*(int(x or 0) for x in c)))
+    await pipe.execute()
+
+
+async def backfill_list(r: redis.Redis, key: str, rater: int, counter_of, batch: int, keep: bool) -> int:
+    done = int(await r.hget(PROGRESS_KEY, key) or 0)
+    moved = 0
+    while True:
+        chunk = await r.lrange(key, -(done + batch), -(done + 1))
+        if not chunk:
+            break
+        pipe = r.pipeline(transaction=True)
+        touched = set()
+        for raw in reversed(chunk):
+            try:
+                rec = json.loads(raw)
+            except ValueError:
+                continue
+            peer = int(rec.get("peer") or 0)
+            if not peer:
+                continue
+            event = {k: v for k, v in rec.items() if k != "peer"}
+            event["from"] = rater
+            fb = main.feedback_k(peer)
+            pipe.hincrby(main.user_k(peer), counter_of(rec), 1)
+            pipe.rpush(fb, json.dumps(event, separators=(",", ":")))
+            pipe.ltrim(fb, 0, main.FEEDBACK_RECENT - 1)
+            touched.add(peer)
+            moved += 1
+        done += len(chunk)
+        pipe.hset(PROGRESS_KEY, key, done)
+        await pipe.execute()
+        await refresh_tiers(r, touched)
+        if len(chunk) < batch:
+            break
+
+    if not keep:  # с --keep прогресс остаётся, чтобы повторный запуск не считал дважды
+        pipe = r.pipeline(transaction=True)
+        pipe.delete(key)
+        pipe.hdel(PROGRESS_KEY, key)
+        await pipe.execute()
+    return moved
+
+
+async def backfill(r: redis.Redis, batch: int, keep: bool):
+    t0 = time.perf_counter()
+    lists = events = 0
+    for pattern, counter_of in SOURCES:
+        prefix = pattern.format(uid="")
+        cursor = 0
+        while True:
+            cursor, keys = await r.scan(cursor, match=prefix + "*", count=batch)
+            for key in keys:
+                events += await backfill_list(r, key, int(key[len(prefix):]), counter_of, batch, keep)
+                lists += 1
+            if cursor == 0:
+                break
+        elapsed = time.perf_counter() - t0
+        print(f"{prefix}*: lists={lists} events={events} {elapsed:.1f}s ({events / max(elapsed, 1e-9):.0f} ev/s)")
+
+
+async def run(args):
+    r = redis.from_url(os.environ["REDIS_URL"], decode_responses=True)
+    try:
+        await backfill(r, args.batch, args.keep)
+    finally:
+        await r.close()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--batch", type=int, default=500, help="записей за один LRANGE / COUNT для SCAN")
+    ap.add_argument("--keep", action="store_true", help="не удалять старые списки")
+    asyncio.run(run(ap.parse_args()))
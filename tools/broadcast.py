@@ -0,0 +1,215 @@
+"""Рассылка всем пользователям из множества users с возобновлением.
+
+Получатели читаются SSCAN-ом страницами (SMEMBERS на миллионах не нужен),
+отправка идёт множеством запросов одновременно; на 429 вся рассылка встаёт
+на паузу retry_after. Лимит Telegram на бота у рассылки общий с воркерами:
+она отмечается в WORKERS_KEY, как воркер, и шлёт не быстрее своей доли
+TG_GLOBAL_RATE (и не быстрее --rate), а воркеры на это время уменьшают свои.
+Поэтому TG_GLOBAL_RATE здесь должен быть тем же, что у бота. Первые
+сообщения уходят через WORKER_HEARTBEAT_S — когда воркеры уже заметили
+рассылку. Прогресс
+пишется в Redis: bc:{run} — курсор SSCAN и счётчики, bc:{run}:page — кому
+уже отправлено из текущей страницы. После падения тот же --run продолжает с
+места остановки; повторно могут уйти только сообщения, бывшие в полёте в
+момент падения (не больше --concurrency). Заблокировавшие бота удаляются
+из users.
+
+    REDIS_URL=... TELEGRAM_TOKEN=... python -m tools.broadcast --run promo-0917 \\
+        --text "Премиум со скидкой: /pay" --concurrency 50
+    REDIS_URL=... TELEGRAM_TOKEN=... python -m tools.broadcast --run promo-0917 --copy 12345:678
+    REDIS_URL=... python -m tools.broadcast --run promo-0917 --status
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import redis.asyncio as redis
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.request import HTTPXRequest
+
+import main
+
+STATE_KEY = "bc:{run}"       # HASH: cursor, sent, failed, blocked, done, что отправлять
+PAGE_KEY  = "bc:{run}:page"  # SET: uid текущей страницы, которым уже отправлено
+MAX_RETRIES = 3
+
+
+class Broadcast:
+    def __init__(self, r: redis.Redis, bot: Bot, run: str, rate: float, concurrency: int, batch: int):
+        self.r, self.bot, self.batch = r, bot, batch
+        self.state_k, self.page_k = STATE_KEY.format(run=run), PAGE_KEY.format(run=run)
+        self.worker_id = f"broadcast:{run}:{os.getpid()}"
+        self.max_rate = rate
+        self.bucket = main.TokenBucket(rate, max(1.0, rate))
+        self.sem = asyncio.Semaphore(concurrency)
+        self.paused_until = 0.0
+        self.spec: dict = {}
+        self.stats = {"sent": 0, "failed": 0, "blocked": 0}
+
+    async def share_budget(self):
+        # Heartbeat, как у воркера бота: скорость — доля общего лимита, но не
+        # больше --rate. Пока Redis недоступен, доля остаётся прежней.
+        try:
+            while True:
+                try:
+                    rate = min(self.max_rate, await main.send_rate_share(self.r, self.worker_id))
+                    self.bucket.set_rate(rate, max(1.0, rate))
+                except Exception as e:
+                    print(f"  heartbeat: {e}", file=sys.stderr)
+                await asyncio.sleep(main.WORKER_HEARTBEAT_S)
+        finally:
+            try:
+                await asyncio.shield(self.r.zrem(main.WORKERS_KEY, self.worker_id))
+            except Exception:
+                pass
+
+    async def send(self, uid: int):
+        if "copy" in self.spec:
+            chat, mid = self.spec["copy"].split(":")
+            await self.bot.copy_message(uid, int(chat), int(mid))
+        else:
+            await self.bot.send_message(uid, self.spec["text"], parse_mode=self.spec.get("parse_mode") or None)
+
+    async def deliver(self, uid: int):
+        outcome = "failed"
+        try:
+            for attempt in range(MAX_RETRIES + 1):
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                try:
+                    await self.send(uid)
+                    outcome = "sent";  break
+                except RetryAfter as e:
+                    self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                except Forbidden:
+                    outcome = "blocked";  break
+                except BadRequest:
+                    break
+                except Exception as e:
+                    if attempt == MAX_RETRIES:
+                        print(f"  {uid}: {e}", file=sys.stderr)
+                    await asyncio.sleep(2 ** attempt)
+            # Итог и отметка «отправлено» — одной транзакцией, чтобы счётчики
+            # не разъехались с тем, что уже не будет отправлено повторно
+            pipe = self.r.pipeline(transaction=True)
+            pipe.sadd(self.page_k, uid)
+            pipe.hincrby(self.state_k, outcome, 1)
+            if outcome == "blocked":
+                pipe.srem(main.USERS_SET, uid)
+            await pipe.execute()
+            self.stats[outcome] += 1
+        finally:
+            self.sem.release()
+
+    async def run(self, spec: dict):
+        st = await self.r.hgetall(self.state_k)
+        if st.get("done"):
+            print("рассылка уже завершена");  return
+        if st:
+            self.spec = {k: st[k] for k in ("text", "copy", "parse_mode") if st.get(k)}
+            print(f"продолжаем с курсора {st.get('cursor', 0)}: sent={st.get('sent', 0)} "
+                  f"failed={st.get('failed', 0)} blocked={st.get('blocked', 0)}")
+        else:
+            if not spec:
+                sys.exit("нужен --text или --copy")
+            self.spec = spec
+            await self.r.hset(self.state_k, mapping={**spec, "cursor": 0, "started": int(time.time())})
+        cursor = int(st.get("cursor", 0))
+
+        # Ждём, пока воркеры бота увидят рассылку в WORKERS_KEY и уменьшат свои доли
+        heartbeat = asyncio.create_task(self.share_budget())
+        try:
+            await asyncio.sleep(main.WORKER_HEARTBEAT_S)
+            await self.send_all(cursor)
+        finally:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+
+    async def send_all(self, cursor: int):
+        while True:
+            cursor_next, uids = await self.r.sscan(main.USERS_SET, cursor, count=self.batch)
+            done = await self.r.smembers(self.page_k)
+            tasks = []
+            try:
+                for uid in uids:
+                    if uid in done:
+                        continue
+                    delay = self.bucket.reserve()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    await self.sem.acquire()
+                    tasks.append(asyncio.create_task(self.deliver(int(uid))))
+                await asyncio.gather(*tasks)
+            except BaseException:  # Ctrl+C и т.п.: неотмеченные дошлёт следующий запуск
+                for t in tasks:
+                    t.cancel()
+                raise
+            # Страница отправлена — двигаем курсор и забываем её
+            pipe = self.r.pipeline(transaction=True)
+            pipe.hset(self.state_k, "cursor", cursor_next)
+            pipe.delete(self.page_k)
+            if cursor_next == 0:
+                pipe.hset(self.state_k, "done", int(time.time()))
+            await pipe.execute()
+            if cursor_next == 0:
+                return
+            cursor = cursor_next
+
+
+async def report(b: Broadcast, every: float):
+    total = await b.r.scard(main.USERS_SET)
+    t0, prev = time.monotonic(), 0
+    while True:
+        await asyncio.sleep(every)
+        st = await b.r.hgetall(b.state_k)
+        n = sum(b.stats.values())
+        rate = (n - prev) / every
+        prev = n
+        done = sum(int(st.get(k, 0)) for k in ("sent", "failed", "blocked"))
+        eta = (total - done) / rate if rate else float("inf")
+        print(f"[{time.monotonic() - t0:7.0f}s] {done}/{total} sent={st.get('sent', 0)} failed={st.get('failed', 0)} "
+              f"blocked={st.get('blocked', 0)} {rate:.1f} msg/s ETA {eta / 60:.0f} min")
+
+
+async def run(args):
+    r = redis.from_url(os.environ["REDIS_URL"], decode_responses=True)
+    try:
+        if args.status:
+            print(await r.hgetall(STATE_KEY.format(run=args.run)) or "нет такой рассылки");  return
+        spec = {"text": args.text} if args.text else {"copy": args.copy} if args.copy else {}
+        if spec and args.parse_mode:
+            spec["parse_mode"] = args.parse_mode
+        bot = Bot(os.environ["TELEGRAM_TOKEN"], base_url=main.BOT_API_URL,
+                  request=HTTPXRequest(connection_pool_size=args.concurrency))
+        b = Broadcast(r, bot, args.run, args.rate, args.concurrency, args.batch)
+        async with bot:
+            t0 = time.monotonic()
+            reporter = asyncio.create_task(report(b, args.report))
+            try:
+                await b.run(spec)
+            finally:
+                reporter.cancel()
+            elapsed = time.monotonic() - t0
+            n = sum(b.stats.values())
+            print(f"готово за {elapsed:.0f}s: {b.stats} ({n / max(elapsed, 1e-9):.1f} msg/s)")
+    finally:
+        await r.close()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--run", required=True, help="имя рассылки — ключ прогресса")
+    ap.add_argument("--text")
+    ap.add_argument("--copy", help="CHAT_ID:MESSAGE_ID готового сообщения для copyMessage")
+    ap.add_argument("--parse-mode", choices=("HTML", "MarkdownV2"))
+    ap.add_argument("--rate", type=float, default=main.TG_GLOBAL_RATE,
+                    help="потолок сообщений/с; фактически — не больше доли TG_GLOBAL_RATE")
+    ap.add_argument("--concurrency", type=int, default=50)
+    ap.add_argument("--batch", type=int, default=1000, help="COUNT для SSCAN")
+    ap.add_argument("--report", type=float, default=10, help="период отчёта, с")
+    ap.add_argument("--status", action="store_true", help="только показать прогресс")
+    asyncio.run(run(ap.parse_args()))
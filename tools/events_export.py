@@ -0,0 +1,105 @@
+"""Выгрузка аналитики в CSV: поминутные агрегаты или сырые события.
+
+Агрегаты берутся из ev:min:{минута}, которые пишет tools.events_rollup;
+по строке на минуту или час (--by), столбцы — счётчики плюс посчитанные
+средние: ожидание в очереди, длительность диалога, доля /next среди
+разрывов. --raw выгружает сами события из стрима за тот же период (пока
+они не вытеснены MAXLEN). Время — UTC.
+
+    REDIS_URL=... python -m tools.events_export --hours 24 --by hour --out day.csv
+    REDIS_URL=... python -m tools.events_export --since "2026-10-01 00:00" --until "2026-10-02 00:00" --out oct1.csv
+    REDIS_URL=... python -m tools.events_export --hours 1 --raw --out events.csv
+"""
+import argparse
+import asyncio
+import csv
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+import redis.asyncio as redis
+
+import main
+from tools.events_rollup import FIELDS, ROLLUP_KEY
+
+RAW_COLUMNS = ("t", "e", "u", "p", "wu", "wp", "x", "a")
+CHUNK = 1000  # HGETALL в одном пайплайне
+
+
+def parse_ts(s: str) -> int:
+    return int(datetime.strptime(s, "%Y-%m-%d %H:%M").replace(tzinfo=timezone.utc).timestamp())
+
+
+def fmt_ts(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%d %H:%M")
+
+
+def derived(row: dict) -> dict:
+    return {
+        "avg_wait_s": round(row["wait_ms"] / row["waits"] / 1000, 2) if row["waits"] else "",
+        "avg_dialog_s": round(row["dialog_ms"] / row["dialogs"] / 1000, 1) if row["dialogs"] else "",
+        "next_share": round(row["end_next"] / row["ends"], 3) if row["ends"] else "",
+    }
+
+
+async def export_rollup(r: redis.Redis, since: int, until: int, step_min: int, out):
+    w = csv.writer(out)
+    w.writerow(("time",) + FIELDS + ("avg_wait_s", "avg_dialog_s", "next_share"))
+    minutes = range(since // 60, until // 60)
+    rows: dict = {}
+    for i in range(0, len(minutes), CHUNK):
+        chunk = minutes[i:i + CHUNK]
+        pipe = r.pipeline(transaction=False)
+        for m in chunk:
+            pipe.hgetall(ROLLUP_KEY.format(minute=m))
+        for m, vals in zip(chunk, await pipe.execute()):
+            row = rows.setdefault(m - m % step_min, dict.fromkeys(FIELDS, 0))
+            for f, v in vals.items():
+                if f in row:
+                    row[f] += int(v)
+    for m, row in sorted(rows.items()):
+        w.writerow([fmt_ts(m * 60)] + [row[f] for f in FIELDS] + list(derived(row).values()))
+    return len(rows)
+
+
+async def export_raw(r: redis.Redis, since: int, until: int, out):
+    w = csv.writer(out)
+    w.writerow(RAW_COLUMNS)
+    start, n = f"{since * 1000}-0", 0
+    while True:
+        entries = await r.xrange(main.EVENTS_STREAM, start, f"{until * 1000}-0", count=CHUNK)
+        for _, ev in entries:
+            w.writerow([ev.get(c, "") for c in RAW_COLUMNS])
+        n += len(entries)
+        if len(entries) < CHUNK:
+            return n
+        start = "(" + entries[-1][0]
+
+
+async def run(args):
+    until = parse_ts(args.until) if args.until else int(time.time()) // 60 * 60
+    since = parse_ts(args.since) if args.since else until - int(args.hours * 3600)
+    r = redis.from_url(os.environ["REDIS_URL"], decode_responses=True)
+    out = open(args.out, "w", newline="") if args.out else sys.stdout
+    try:
+        if args.raw:
+            n = await export_raw(r, since, until, out)
+        else:
+            n = await export_rollup(r, since, until, 60 if args.by == "hour" else 1, out)
+        print(f"{n} строк за {fmt_ts(since)} — {fmt_ts(until)} UTC", file=sys.stderr)
+    finally:
+        if args.out:
+            out.close()
+        await r.close()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--since", help='начало, UTC: "YYYY-MM-DD HH:MM"')
+    ap.add_argument("--until", help="конец (не включая), по умолчанию — текущая минута")
+    ap.add_argument("--hours", type=float, default=24, help="период, если --since не задан")
+    ap.add_argument("--by", choices=("minute", "hour"), default="minute")
+    ap.add_argument("--raw", action="store_true", help="сырые события из стрима вместо агрегатов")
+    ap.add_argument("--out", help="файл CSV (по умолчанию stdout)")
+    asyncio.run(run(ap.parse_args()))
@@ -0,0 +1,113 @@
+"""Свёртка потока событий бота в поминутные агрегаты.
+
+Читает стрим events (см. «Поток событий» в main.py) с места, где
+остановился прошлый раз, и складывает события в HASH ev:min:{минута}:
+сколько пар создано и разорвано (по причинам: stop/next/idle/blocked),
+встало в очередь, суммы ожиданий и длительностей диалогов, оплаты. Счётчики
+пачки и курсор стрима пишутся одной транзакцией, так что после падения
+ничего не считается дважды. Длительность диалога — от события pair до
+end; пары, начатые до запуска свёртки, в длительность не попадают.
+
+    REDIS_URL=... python -m tools.events_rollup
+    REDIS_URL=... python -m tools.events_rollup --once   # дочитать и выйти
+"""
+import argparse
+import asyncio
+import os
+import time
+from typing import Optional
+
+import redis.asyncio as redis
+
+import main
+
+ROLLUP_KEY = "ev:min:{minute}"   # HASH: поле -> значение за минуту
+CURSOR_KEY = "ev:rollup:cursor"  # id последнего свёрнутого события
+ROLLUP_TTL_S = 90 * 86400
+OPEN_MAX = 1_000_000             # незакрытых пар в памяти
+DIALOG_MAX_MS = 86400 * 1000     # дольше — считаем, что end потерялся
+# Поля агрегата; *_ms — суммы (среднее = сумма / число)
+FIELDS = ("pairs", "queued", "waits", "wait_ms", "ends", "end_stop", "end_next", "end_idle",
+          "end_blocked", "dialogs", "dialog_ms", "pays", "stars")
+
+
+class Rollup:
+    def __init__(self, r: redis.Redis):
+        self.r = r
+        self.open: dict = {}  # uid -> (начало пары, мс; собеседник)
+
+    def fold(self, ev: dict, agg: dict):
+        t, kind, uid = int(ev["t"]), ev["e"], int(ev["u"])
+        m = agg.setdefault(t // 60000, {})
+
+        def add(field: str, n: int = 1):
+            m[field] = m.get(field, 0) + n
+
+        if kind == "queue":
+            add("queued")
+        elif kind == "pair":
+            peer = int(ev["p"])
+            add("pairs")
+            if "wu" in ev:
+                add("waits", 2);  add("wait_ms", int(ev["wu"]) + int(ev["wp"]))
+            if len(self.open) >= OPEN_MAX:
+                self.open = {u: v for u, v in self.open.items() if t - v[0] < DIALOG_MAX_MS}
+            self.open[uid], self.open[peer] = (t, peer), (t, uid)
+        elif kind == "end":
+            peer = int(ev["p"])
+            add("ends");  add(f"end_{ev.get('x', 'stop')}")
+            start = self.open.pop(uid, None)
+            self.open.pop(peer, None)
+            if start and start[1] == peer and t - start[0] < DIALOG_MAX_MS:
+                add("dialogs");  add("dialog_ms", t - start[0])
+        elif kind == "pay":
+            add("pays");  add("stars", int(ev.get("a", 0)))
+
+    async def step(self, cursor: str, batch: int, block_ms: Optional[int]) -> tuple:
+        # -> (новый курсор, сколько событий свёрнуто)
+        res = await self.r.xread({main.EVENTS_STREAM: cursor}, count=batch, block=block_ms)
+        if not res:
+            return cursor, 0
+        entries = res[0][1]
+        agg: dict = {}
+        for _, ev in entries:
+            self.fold(ev, agg)
+        cursor = entries[-1][0]
+        pipe = self.r.pipeline(transaction=True)
+        for minute, fields in agg.items():
+            k = ROLLUP_KEY.format(minute=minute)
+            for f, n in fields.items():
+                pipe.hincrby(k, f, n)
+            pipe.expire(k, ROLLUP_TTL_S)
+        pipe.set(CURSOR_KEY, cursor)
+        await pipe.execute()
+        return cursor, len(entries)
+
+
+async def run(args):
+    r = redis.from_url(os.environ["REDIS_URL"], decode_responses=True)
+    try:
+        roll = Rollup(r)
+        cursor = await r.get(CURSOR_KEY) or "0-0"
+        total, t0 = 0, time.monotonic()
+        while True:
+            cursor, n = await roll.step(cursor, args.batch, None if args.once else args.block)
+            total += n
+            if args.once and not n:
+                break
+            if not args.once and time.monotonic() - t0 >= args.report:
+                print(f"свёрнуто {total} событий, курсор {cursor}, открытых пар {len(roll.open)}")
+                total, t0 = 0, time.monotonic()
+        if args.once:
+            print(f"свёрнуто {total} событий, курсор {cursor}")
+    finally:
+        await r.close()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--batch", type=int, default=5000, help="событий за XREAD")
+    ap.add_argument("--block", type=int, default=5000, help="ожидание новых событий, мс")
+    ap.add_argument("--report", type=float, default=60, help="период отчёта, с")
+    ap.add_argument("--once", action="store_true", help="свернуть накопленное и выйти")
+    asyncio.run(run(ap.parse_args()))
@@ -0,0 +1,113 @@
+"""Онлайн-миграция пользователей со старых ключей в хэш u:{uid}.
+
+Старые ключи profile:/pair:/vip_until:/premium_until: обходятся SCAN-ом
+пачками; каждая пачка переносится одним скриптом — тем же, которым
+переносит сам бот. Для каждого пользователя чтение старых ключей и запись
+в хэш атомарны, поля пишутся через HSETNX, а уже перенесённые (поле
+F_MIGRATED) пропускаются — так что значения, записанные работающим ботом,
+не затираются и не возвращаются устаревшими. Бот можно не останавливать.
+
+    REDIS_URL=... python -m tools.migrate_users --batch 1000
+    REDIS_URL=... python -m tools.migrate_users --report --sample 2000
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+
+import redis.asyncio as redis
+
+import main
+
+LEGACY = {
+    "profile": main.PROFILE_KEY,
+    "pair": main.PAIR_KEY,
+    "vip": main.VIP_KEY,
+    "premium": main.PREMIUM_KEY,
+}
+
+
+def legacy_keys(uid: str) -> list:
+    return [k.format(uid=uid) for k in LEGACY.values()]
+
+
+async def migrate_batch(r: redis.Redis, uids: list, keep: bool) -> int:
+    # Один скрипт на пачку: тот же перенос, что делает бот (main.MIGRATE_LUA),
+    # атомарно на каждого пользователя — уже перенесённых ботом он не трогает
+    return int(await r.register_script(main.MIGRATE_LUA)(args=[int(keep), *uids]))
+
+
+async def migrate(r: redis.Redis, batch: int, keep: bool, pause: float):
+    t0 = time.perf_counter()
+    total = 0
+    for name, pattern in LEGACY.items():
+        prefix = pattern.format(uid="")
+        cursor = 0
+        while True:
+            cursor, keys = await r.scan(cursor, match=prefix + "*", count=batch)
+            uids = [k[len(prefix):] for k in keys]
+            if uids:
+                total += await migrate_batch(r, uids, keep)
+            if cursor == 0:
+                break
+            if pause:
+                await asyncio.sleep(pause)
+        print(f"{name}: done, users migrated so far {total}, {time.perf_counter() - t0:.1f}s")
+
+
+async def sample_usage(r: redis.Redis, match: str, sample: int) -> list:
+    keys, cursor = [], 0
+    while len(keys) < sample:
+        cursor, batch = await r.scan(cursor, match=match, count=1000)
+        keys += batch
+        if cursor == 0:
+            break
+    keys = random.sample(keys, min(sample, len(keys)))
+    pipe = r.pipeline(transaction=False)
+    for k in keys:
+        pipe.memory_usage(k)
+    return [(k, b or 0) for k, b in zip(keys, await pipe.execute())]
+
+
+async def report(r: redis.Redis, sample: int):
+    # Байт на пользователя: по хэшам u:* и по старым ключам тех же
+    # (или случайных, если старых уже нет) пользователей.
+    new = await sample_usage(r, main.user_k("") + "*", sample)
+    if new:
+        avg = sum(b for _, b in new) / len(new)
+        enc = await r.object("encoding", new[0][0])
+        print(f"hash u:*      : {avg:8.1f} B/user  (sample {len(new)}, encoding {enc})")
+    old = await sample_usage(r, main.PROFILE_KEY.format(uid="") + "*", sample)
+    if old:
+        pipe = r.pipeline(transaction=False)
+        for k, _ in old:
+            uid = k[len(main.PROFILE_KEY.format(uid="")):]
+            for lk in legacy_keys(uid)[1:]:
+                pipe.memory_usage(lk)
+        extra = await pipe.execute()
+        avg = (sum(b for _, b in old) + sum(b or 0 for b in extra)) / len(old)
+        print(f"legacy keys   : {avg:8.1f} B/user  (sample {len(old)})")
+    if not (new or old):
+        print("no users found")
+
+
+async def run(args):
+    r = redis.from_url(os.environ["REDIS_URL"], decode_responses=True)
+    try:
+        if args.report:
+            await report(r, args.sample)
+        else:
+            await migrate(r, args.batch, args.keep, args.pause)
+    finally:
+        await r.close()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--batch", type=int, default=1000, help="COUNT для SCAN")
+    ap.add_argument("--pause", type=float, default=0.0, help="пауза между пачками, с")
+    ap.add_argument("--keep", action="store_true", help="не удалять старые ключи")
+    ap.add_argument("--report", action="store_true", help="только отчёт о памяти")
+    ap.add_argument("--sample", type=int, default=1000)
+    asyncio.run(run(ap.parse_args()))
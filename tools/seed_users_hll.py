@@ -0,0 +1,49 @@
+"""Заполнение HLL «всего пользователей» из старого множества users.
+
+Бот добавляет в users:hll только тех, кто проявил активность после
+обновления; чтобы счётчик сразу показывал всех, множество обходится SSCAN-ом
+пачками и каждая пачка уходит одним PFADD. Повторный запуск безопасен.
+
+    REDIS_URL=... python -m tools.seed_users_hll --batch 5000
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import redis.asyncio as redis
+
+import main
+
+
+async def seed(r: redis.Redis, batch: int, pause: float):
+    t0 = time.perf_counter()
+    cursor, seen = 0, 0
+    while True:
+        cursor, uids = await r.sscan(main.USERS_SET, cursor, count=batch)
+        if uids:
+            await r.pfadd(main.USERS_HLL, *uids)
+            seen += len(uids)
+        if cursor == 0:
+            break
+        if pause:
+            await asyncio.sleep(pause)
+    exact = await r.scard(main.USERS_SET)
+    approx = await r.pfcount(main.USERS_HLL)
+    print(f"seeded {seen} uids in {time.perf_counter() - t0:.1f}s; "
+          f"SCARD={exact} PFCOUNT={approx} ({(approx - exact) / max(exact, 1):+.2%})")
+
+
+async def run(args):
+    r = redis.from_url(os.environ["REDIS_URL"], decode_responses=True)
+    try:
+        await seed(r, args.batch, args.pause)
+    finally:
+        await r.close()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--batch", type=int, default=5000, help="COUNT для SSCAN")
+    ap.add_argument("--pause", type=float, default=0.0, help="пауза между пачками, с")
+    asyncio.run(run(ap.parse_args()))